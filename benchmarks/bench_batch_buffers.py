@@ -0,0 +1,107 @@
+"""Compare batch decoding with and without re-used batch buffers.
+
+Writes a temporary uint16 recording, then loads every padded batch with
+`BinaryRWFile.padded_batch_to_torch` the old way (new tensor per batch,
+channel selection after loading) and with a `BatchBufferPool` (re-used
+buffer, channel selection during decoding). Reports time per batch and the
+peak size of temporary numpy arrays, measured with tracemalloc.
+
+Usage:
+    python benchmarks/bench_batch_buffers.py [--n_chan 385] [--n_batches 20]
+"""
+
+import argparse
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+import torch
+
+from kilosort.io import BinaryRWFile, BatchBufferPool
+
+
+def legacy_batch(bfile, ibatch, chan_map):
+    # Same steps as padded_batch_to_torch before batch buffers were added.
+    data, bstart, bend = bfile.read_padded_batch(ibatch)
+    data = data.T
+    data = data.astype('float32')
+    data = data - 2**15
+    nsamp = data.shape[-1]
+    X = torch.zeros((bfile.n_chan_bin, bfile.NT + 2*bfile.nt), device=bfile.device)
+    if ibatch == 0:
+        X[:, bfile.nt:bfile.nt+nsamp] = torch.from_numpy(data).to(bfile.device)
+        X[:, :bfile.nt] = X[:, bfile.nt:bfile.nt+1]
+    elif ibatch == bfile.n_batches-1:
+        X[:, :nsamp] = torch.from_numpy(data).to(bfile.device)
+        X[:, nsamp:] = X[:, nsamp-1:nsamp]
+    else:
+        X[:] = torch.from_numpy(data).to(bfile.device)
+    return X[chan_map]
+
+
+def buffered_batch(bfile, ibatch, chan_map, buffers):
+    return bfile.padded_batch_to_torch(ibatch, chan_map=chan_map, buffers=buffers)
+
+
+def measure(fn, bfile, *args):
+    # Warm-up so that one-time allocations are not counted.
+    fn(bfile, 1, *args)
+    n = bfile.n_batches
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    for i in range(n):
+        fn(bfile, i, *args)
+    if bfile.device.type == 'cuda':
+        torch.cuda.synchronize()
+    elapsed = time.perf_counter() - t0
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return elapsed / n, peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_chan', type=int, default=385)
+    parser.add_argument('--n_batches', type=int, default=20)
+    parser.add_argument('--NT', type=int, default=60000)
+    parser.add_argument('--device', type=str, default='cpu')
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    nt = 61
+    n_samples = args.NT * args.n_batches
+    chan_map = np.arange(args.n_chan - 1)  # e.g. drop a sync channel
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / 'bench.bin'
+        rng = np.random.default_rng(0)
+        mm = np.memmap(path, dtype='uint16', mode='w+',
+                       shape=(n_samples, args.n_chan))
+        for i in range(args.n_batches):
+            mm[i*args.NT:(i+1)*args.NT] = rng.integers(
+                0, 2**16, size=(args.NT, args.n_chan), dtype=np.uint16
+                )
+        mm.flush()
+        del mm
+
+        bfile = BinaryRWFile(path, n_chan_bin=args.n_chan, dtype='uint16',
+                             NT=args.NT, nt=nt, device=device)
+        buffers = BatchBufferPool(device=device)
+        results = {
+            'legacy': measure(legacy_batch, bfile, chan_map),
+            'buffered': measure(buffered_batch, bfile, chan_map, buffers),
+        }
+        bfile.close()
+
+    print(f'{args.n_batches} batches of {args.NT} samples x {args.n_chan} '
+          f'channels on {device}')
+    print(f'{"":>10} {"ms/batch":>10} {"peak numpy MB":>14}')
+    for name, (t, peak) in results.items():
+        print(f'{name:>10} {t*1000:>10.2f} {peak/2**20:>14.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,7 @@
 import os
+import json
+import time
+from pathlib import Path
 
 import torch
 import numpy as np
@@ -6,8 +9,10 @@ from torch.fft import fft, ifft, fftshift
 from scipy.interpolate import interp1d
 from tqdm import trange
 
-from kilosort import preprocessing
+from kilosort import preprocessing, template_matching
+from kilosort.utils import compiled
 from kilosort.io import BinaryFiltered
+from kilosort.spikedetect import SCORE_DTYPES
 
 
 if torch.cuda.is_available():
@@ -204,3 +209,178 @@ def load_phy(filename, fpath, ops):
     yclu_new, Wsub = clu_ypos(filename, ops, st_new - 20, clu_new)
 
     return st_new, clu_new, yclu_new, Wsub
+
+
+def _throughput(func, args, n_samples, n_repeats, device):
+    func(*args)  # warm-up, includes compilation
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    t0 = time.perf_counter()
+    for _ in range(n_repeats):
+        func(*args)
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return n_repeats * n_samples / (time.perf_counter() - t0)
+
+
+def reference_throughput(n_chans=(384, 1536, 4096), n_samples=60122,
+                         modes=None, n_shanks=4, n_repeats=5, device=dev):
+    """Samples per second for each common-reference mode and channel count.
+
+    Uses random data with `n_shanks` equally sized shanks for the 'shank_'
+    modes. Returns a dictionary with `(n_chans, mode)` keys.
+
+    """
+    if modes is None:
+        modes = preprocessing.CommonReference.modes
+    results = {}
+    for c in n_chans:
+        X = torch.randn((c, n_samples), device=device)
+        groups = np.arange(c) * n_shanks // c
+        for mode in modes:
+            car = preprocessing.CommonReference(mode, groups)
+            results[(c, mode)] = _throughput(
+                car, (X,), n_samples, n_repeats, device
+                )
+
+    return results
+
+
+def _complex_fft_filter(X, hp_filter):
+    # High-pass filtering as done before `FFTFilter`, with a complex FFT and
+    # the filter spectrum recomputed for every batch.
+    fwav = preprocessing.fft_highpass(hp_filter, NT=X.shape[-1])
+    X = torch.real(ifft(fft(X) * torch.conj(fwav)))
+    return fftshift(X, dim=-1)
+
+
+def filter_throughput(n_chans=(384, 1536), n_samples=60122, fs=30000,
+                      n_repeats=5, device=dev):
+    """Samples per second for each high-pass filtering method and channel count.
+
+    Compares complex FFT filtering with `fft_highpass` (as used before
+    `FFTFilter`), `FFTFilter.filter` and `FFTFilter.overlap_save` on random
+    data. Returns a dictionary with `(n_chans, method)` keys.
+
+    """
+    hp_filter = preprocessing.get_highpass_filter(fs=fs, device=device)
+    fft_filter = preprocessing.FFTFilter(hp_filter)
+    methods = {
+        'complex_fft': lambda X: _complex_fft_filter(X, hp_filter),
+        'fft': fft_filter.filter,
+        'overlap_save': fft_filter.overlap_save,
+        }
+    results = {}
+    for c in n_chans:
+        X = torch.randn((c, n_samples), device=device)
+        for name, func in methods.items():
+            results[(c, name)] = _throughput(
+                func, (X,), n_samples, n_repeats, device
+                )
+
+    return results
+
+
+def compile_throughput(n_chans=384, n_samples=60122, n_units=500, nt=61,
+                       n_repeats=5, device=torch.device('cpu')):
+    """Samples per second for eager and `torch.compile`d kernels.
+
+    Compares the fused preprocessing step (`center_channels`) and the
+    template matching scores (`_peel_scores`) on random data. Returns a
+    dictionary with `(kernel, 'eager' or 'compiled')` keys.
+
+    """
+    X = torch.randn((n_chans, n_samples), device=device)
+    B = torch.randn((n_units, n_samples), device=device)
+    nm = torch.rand(n_units, device=device) + 1
+    kernels = {
+        'center_channels': (preprocessing.center_channels, (X, True)),
+        'peel_scores': (template_matching._peel_scores, (B, nm, nt, 8.0)),
+        }
+    results = {}
+    for name, (func, args) in kernels.items():
+        for mode in ['eager', 'compiled']:
+            f = compiled(func, enabled=(mode == 'compiled'))
+            results[(name, mode)] = _throughput(
+                f, args, n_samples, n_repeats, device
+                )
+
+    return results
+
+
+def compare_precision(settings, probe, filename, results_dir,
+                      dtypes=('bfloat16',), device=dev, **kwargs):
+    """Compare sorting with reduced-precision score maps against float32.
+
+    Runs `run_kilosort` once with `score_dtype = 'float32'` and once for each
+    entry of `dtypes`, saving results to `results_dir / <dtype>`. Units from
+    the float32 run are matched to units from each reduced-precision run
+    with `compare_recordings`. Additional keyword arguments are passed to
+    `run_kilosort`. A summary (median `fmax`, fraction of units with
+    `fmax > 0.9`, counts, runtime and memory) is also written to
+    `results_dir / 'precision_report.json'`.
+
+    Returns
+    -------
+    report : dict
+        Keyed by dtype name. Each entry contains the matched fraction of
+        float32 units (`fmax`, `fmiss`, `fpos` per unit), the number of
+        spikes and units found, the runtime in seconds, the peak CUDA memory
+        in bytes (None on CPU) and the storage size in bytes of one batch of
+        universal-template score maps (at most, since templates far from any
+        channel are dropped).
+
+    """
+    from kilosort.run_kilosort import run_kilosort
+
+    results = {}
+    for name in ('float32',) + tuple(d for d in dtypes if d != 'float32'):
+        s = {**settings, 'score_dtype': name}
+        if device.type == 'cuda':
+            torch.cuda.reset_peak_memory_stats(device)
+        t0 = time.perf_counter()
+        ops, st, clu = run_kilosort(
+            s, probe=probe, filename=filename, device=device,
+            results_dir=Path(results_dir) / name, **kwargs
+            )[:3]
+        runtime = time.perf_counter() - t0
+        peak = torch.cuda.max_memory_allocated(device) \
+            if device.type == 'cuda' else None
+
+        st_i = st[:,0].astype('int64') - ops['nt0min']
+        yclu, _ = clu_ypos(filename, ops, st_i, clu)
+        # As and Amaxs in `spikedetect.template_match`, one row per position.
+        n_positions = ops['yup'].size * ops['xup'].size
+        score_bytes = 2 * n_positions * ops['batch_size'] \
+            * torch.tensor([], dtype=SCORE_DTYPES[name]).element_size()
+        results[name] = {
+            'st': st_i, 'clu': clu, 'yclu': yclu, 'runtime': runtime,
+            'peak_memory': peak, 'score_bytes': score_bytes
+            }
+
+    ref = results['float32']
+    report = {}
+    for name, r in results.items():
+        fmax, fmiss, fpos = compare_recordings(
+            ref['st'], ref['clu'], ref['yclu'], r['st'], r['clu'], r['yclu']
+            )[:3]
+        report[name] = {
+            'fmax': fmax, 'fmiss': fmiss, 'fpos': fpos,
+            'n_spikes': r['st'].size, 'n_units': int(r['clu'].max()) + 1,
+            'runtime': r['runtime'], 'peak_memory': r['peak_memory'],
+            'score_bytes': r['score_bytes']
+            }
+
+    summary = {
+        name: {
+            'median_fmax': float(np.median(r['fmax'])),
+            'frac_fmax_above_0.9': float((r['fmax'] > 0.9).mean()),
+            **{k: r[k] for k in ['n_spikes', 'n_units', 'runtime',
+                                 'peak_memory', 'score_bytes']}
+            }
+        for name, r in report.items()
+        }
+    with open(Path(results_dir) / 'precision_report.json', 'w') as f:
+        json.dump(summary, f, indent=1, default=int)
+
+    return report
@@ -19,7 +19,7 @@ def mean_waveform(cluster_id, results_dir, n_spikes=np.inf, bfile=None, best=Tru
         assigned to `cluster_id` are used.
     bfile : kilosort.io.BinaryFiltered; optional
         Kilosort4 data file object. By default, this will be loaded using the
-        information in `ops.npy` in the saved results.
+        information in the saved `ops`.
     best : bool; default=True
         If True, return the mean single-channel waveform using the best channel
         for `cluster_id`. Otherwise, return the multi-channel waveform with
@@ -53,18 +53,25 @@ def mean_waveform(cluster_id, results_dir, n_spikes=np.inf, bfile=None, best=Tru
 
 def get_best_channels(results_dir):
     """Get channel numbers with largest template norm for each cluster."""
-    templates = np.load(results_dir / 'templates.npy')
+    templates = io.load_result(results_dir, 'templates')
     best_chans = (templates**2).sum(axis=1).argmax(axis=-1)
     return best_chans
 
 def get_best_channel(results_dir, cluster_id):
     return get_best_channels(results_dir)[cluster_id]
 
-def get_cluster_spikes(cluster_id, results_dir, n_spikes=np.inf):
-    """Get `n_spikes` random spike times assigned to `cluster_id`."""
-    spike_times = np.load(results_dir / 'spike_times.npy')
-    spike_clusters = np.load(results_dir / 'spike_clusters.npy')
-    spike_idx = (spike_clusters == cluster_id).nonzero()[0]
+def get_cluster_spikes(cluster_id, results_dir, n_spikes=np.inf, mmap_mode='r'):
+    """Get `n_spikes` random spike times assigned to `cluster_id`.
+
+    If the per-cluster spike index saved by `kilosort.io.save_to_phy` is
+    present, only the spikes for this cluster are read from disk. Set
+    `mmap_mode=None` to read full arrays into memory instead.
+
+    """
+    results_dir = Path(results_dir)
+    spike_times = io.load_result(results_dir, 'spike_times',
+                                 lazy=mmap_mode is not None)
+    spike_idx = io.load_cluster_spike_idx(results_dir, cluster_id, mmap_mode)
     if n_spikes != np.inf:
         spike_subset = np.random.choice(
             np.arange(spike_idx.size), min(spike_idx.size, n_spikes), replace=False
@@ -73,7 +80,7 @@ def get_cluster_spikes(cluster_id, results_dir, n_spikes=np.inf):
         spike_subset = np.arange(spike_idx.size)
     spike_idx = spike_idx[spike_subset]
     spike_idx.sort()
-    spikes = spike_times[spike_idx]
+    spikes = np.asarray(spike_times[spike_idx])
 
     return spikes, spike_subset
 
@@ -90,7 +97,7 @@ def get_spike_waveforms(spikes, results_dir, bfile=None, chan=None):
         Path to directory where Kilosort4 sorting results were saved.
     bfile : kilosort.io.BinaryFiltered; optional
         Kilosort4 data file object. By default, this will be loaded using the
-        information in `ops.npy` in the saved results.
+        information in the saved `ops`.
     chan : int; optional.
         Channel to use for single-channel waveforms. If not specified, all
         channels will be returned.
@@ -105,9 +112,8 @@ def get_spike_waveforms(spikes, results_dir, bfile=None, chan=None):
         spikes = [spikes]
 
     if bfile is None:
-        ops = io.load_ops(results_dir / 'ops.npy')
-        bfile = io.bfile_from_ops(ops)
-    whitening_mat_inv = np.load(results_dir / 'whitening_mat_inv.npy')
+        bfile = io.bfile_from_ops(ops_path=results_dir)
+    whitening_mat_inv = io.load_result(results_dir, 'whitening_mat_inv')
 
     waves = []
     for t in spikes:
@@ -128,7 +134,8 @@ def get_spike_waveforms(spikes, results_dir, bfile=None, chan=None):
     return waves
 
 
-def cluster_templates(cluster_id, results_dir, mean=False, best=False, spike_subset=None):
+def cluster_templates(cluster_id, results_dir, mean=False, best=False,
+                      spike_subset=None, mmap_mode='r'):
     """Get template-like centroid for this `cluster_id`, scaled for each spike.
     
     Note that template here actually refers to the final clusters. The
@@ -157,6 +164,10 @@ def cluster_templates(cluster_id, results_dir, mean=False, best=False, spike_sub
         For example, `spike_subset = [0,2,5]` would use the first, third,
         and sixth spike (in order of increasing spike time), regardless of
         what the actual spike times are.
+    mmap_mode : str; default='r'.
+        If not None, per-spike arrays are memory-mapped (or read lazily from
+        a sorting container), so that only the spikes assigned to
+        `cluster_id` are read. Use None to load full arrays.
 
     Return
     ------
@@ -167,11 +178,10 @@ def cluster_templates(cluster_id, results_dir, mean=False, best=False, spike_sub
         
     """
     results_dir = Path(results_dir)
-    spike_clusters = np.load(results_dir / 'spike_clusters.npy')
-    spike_idx = (spike_clusters == cluster_id).nonzero()[0]
+    spike_idx = io.load_cluster_spike_idx(results_dir, cluster_id, mmap_mode)
     if spike_subset is not None:
         spike_idx = spike_idx[spike_subset]
-    temps = get_templates(spike_idx, results_dir)
+    temps = get_templates(spike_idx, results_dir, mmap_mode=mmap_mode)
     if best:
         chan = get_best_channel(results_dir, cluster_id)
         temps = temps[:,:,chan]
@@ -181,7 +191,7 @@ def cluster_templates(cluster_id, results_dir, mean=False, best=False, spike_sub
     return temps
 
 
-def get_templates(spike_idx, results_dir):
+def get_templates(spike_idx, results_dir, mmap_mode='r'):
     """Get template-like centroids for clusters assigned to one or more spikes.
     
     Parameters
@@ -190,6 +200,10 @@ def get_templates(spike_idx, results_dir):
         Index or list/array of indices into `spike_times.npy`
     results_dir : str or Path
         Path to directory where Kilosort4 sorting results were saved.
+    mmap_mode : str; default='r'.
+        If not None, `spike_clusters` and `amplitudes` are memory-mapped (or
+        read lazily from a sorting container). Use None to load full arrays
+        into memory.
     
     Returns
     -------
@@ -202,13 +216,15 @@ def get_templates(spike_idx, results_dir):
     results_dir = Path(results_dir)
     if isinstance(spike_idx, int):
         spike_idx = [spike_idx]
-    templates = np.load(results_dir / 'templates.npy')
+    lazy = mmap_mode is not None
+    templates = io.load_result(results_dir, 'templates')
     # Note that spike_clusters.npy is identical to spike_templates.npy for KS4
-    spike_templates = np.load(results_dir / 'spike_clusters.npy')
-    amplitudes = np.load(results_dir / 'amplitudes.npy')
-    template_idx = spike_templates[spike_idx]
+    spike_templates = io.load_result(results_dir, 'spike_clusters', lazy=lazy)
+    amplitudes = io.load_result(results_dir, 'amplitudes', lazy=lazy)
+    spike_idx = np.asarray(spike_idx)
+    template_idx = np.asarray(spike_templates[spike_idx])
     temps = templates[template_idx, :, :]
-    scaled = amplitudes[spike_idx, np.newaxis, np.newaxis] * temps
+    scaled = np.asarray(amplitudes[spike_idx])[:, np.newaxis, np.newaxis] * temps
 
     return scaled
 
@@ -237,3 +253,228 @@ def get_labels(results_dir):
     labels = [r.split('\t') for r in rows[1:]][:-1]
 
     return labels
+
+
+class SpikeTrains:
+    def __init__(self, spike_times, spike_clusters, order=None, offsets=None,
+                 bucket_size=4096):
+        """Time-window queries over sorted spike trains.
+
+        Spikes for each cluster are looked up with the per-cluster index from
+        `kilosort.io.cluster_spike_index`, and their (sorted) spike times are
+        gathered once per cluster and cached. Queries over all clusters use a
+        coarse index with every `bucket_size`-th spike time, so that only one
+        bucket of `spike_times` is read to find each window boundary. All
+        times are in units of samples, like `spike_times.npy`.
+
+        Parameters
+        ----------
+        spike_times : np.ndarray
+            Sorted spike times for all spikes, with shape (n_spikes,). This
+            can be a memmap.
+        spike_clusters : np.ndarray
+            Cluster id for each spike, with shape (n_spikes,). This can be a
+            memmap.
+        order, offsets : np.ndarray; optional.
+            Per-cluster spike index, as returned by `cluster_spike_index`.
+            Computed from `spike_clusters` if not specified.
+        bucket_size : int; default=4096.
+            Number of spikes per bucket in the global time index.
+
+        """
+        if order is None or offsets is None:
+            order, offsets = io.cluster_spike_index(spike_clusters)
+        self.spike_times = spike_times
+        self.spike_clusters = spike_clusters
+        self.order = order
+        self.offsets = np.asarray(offsets)
+        self.n_clusters = self.offsets.size - 1
+        self.bucket_size = bucket_size
+        self.bucket_times = np.asarray(spike_times[::bucket_size])
+        self._cluster_times = {}
+
+    @classmethod
+    def from_results(cls, results_dir, mmap_mode='r', **kwargs):
+        """Load spike trains from saved sorting results in `results_dir`.
+
+        Works with .npy files or a sorting container. The saved per-cluster
+        index is only used if `spike_clusters` hasn't changed since it was
+        saved (see `kilosort.io.load_cluster_index`), otherwise the index is
+        rebuilt from the current (possibly curated) `spike_clusters`.
+
+        """
+        results_dir = Path(results_dir)
+        lazy = mmap_mode is not None
+        spike_times = io.load_result(results_dir, 'spike_times', lazy=lazy)
+        spike_clusters = io.load_result(results_dir, 'spike_clusters',
+                                        lazy=lazy)
+        order, offsets = io.load_cluster_index(results_dir, mmap_mode=mmap_mode)
+
+        return cls(spike_times, spike_clusters, order=order, offsets=offsets,
+                   **kwargs)
+
+    def _get_clusters(self, clusters):
+        if clusters is None:
+            return np.arange(self.n_clusters)
+        return np.atleast_1d(np.asarray(clusters, dtype='int64'))
+
+    def cluster_times(self, cluster_id):
+        """Sorted spike times for `cluster_id`, with shape (n_cluster_spikes,)."""
+        if cluster_id not in self._cluster_times:
+            if 0 <= cluster_id < self.n_clusters:
+                a, b = self.offsets[cluster_id], self.offsets[cluster_id+1]
+                idx = np.asarray(self.order[a:b])
+                t = np.asarray(self.spike_times[idx]).astype('int64')
+            else:
+                t = np.zeros(0, dtype='int64')
+            self._cluster_times[cluster_id] = t
+        return self._cluster_times[cluster_id]
+
+    def window_slice(self, t0, t1):
+        """Slice into `spike_times` for all spikes with `t0 <= t < t1`."""
+        return slice(self._search(t0), self._search(t1))
+
+    def _search(self, t):
+        # Find the bucket from the coarse index, then search only that bucket.
+        b = max(np.searchsorted(self.bucket_times, t, side='left') - 1, 0)
+        start = b * self.bucket_size
+        stop = min(start + self.bucket_size + 1, len(self.spike_times))
+        bucket = np.asarray(self.spike_times[start:stop])
+        return start + int(np.searchsorted(bucket, t, side='left'))
+
+    def window(self, t0, t1, clusters=None):
+        """Get all spikes in `[t0, t1)`, optionally only for `clusters`.
+
+        Parameters
+        ----------
+        t0, t1 : int
+            Start (inclusive) and end (exclusive) of the window, in samples.
+        clusters : int or array-like; optional.
+            Cluster ids to include. By default, spikes from all clusters
+            are returned.
+
+        Returns
+        -------
+        times : np.ndarray
+            Spike times in the window, in ascending order.
+        spike_clusters : np.ndarray
+            Cluster id for each spike in `times`.
+
+        """
+        if clusters is None:
+            s = self.window_slice(t0, t1)
+            return (np.asarray(self.spike_times[s]),
+                    np.asarray(self.spike_clusters[s]))
+
+        # Start from empty arrays so that an empty `clusters` returns no spikes.
+        times, ids = [np.zeros(0, dtype='int64')], [np.zeros(0, dtype='int64')]
+        for c in self._get_clusters(clusters):
+            t = self.cluster_times(c)
+            t = t[np.searchsorted(t, t0):np.searchsorted(t, t1)]
+            times.append(t)
+            ids.append(np.full(t.size, c, dtype='int64'))
+        times = np.concatenate(times)
+        ids = np.concatenate(ids)
+        isort = np.argsort(times, kind='stable')
+
+        return times[isort], ids[isort]
+
+    def align(self, event_times, window, clusters=None):
+        """Get spike times relative to each of many events.
+
+        Parameters
+        ----------
+        event_times : array-like
+            Event times in samples, with shape (n_events,).
+        window : tuple of int
+            `(before, after)` offsets relative to each event, in samples. For
+            example, `(-300, 600)` includes spikes from 300 samples before
+            until 600 samples after each event.
+        clusters : int or array-like; optional.
+            Cluster ids to include. By default, all clusters are used.
+
+        Returns
+        -------
+        rel_times : np.ndarray
+            Spike times relative to their event, in samples.
+        events : np.ndarray
+            Index into `event_times` for each spike in `rel_times`.
+        spike_clusters : np.ndarray
+            Cluster id for each spike in `rel_times`.
+
+        Notes
+        -----
+        Spikes in overlapping windows are included once for each event.
+
+        """
+        event_times = np.asarray(event_times, dtype='int64')
+        rel_times, events, ids = [[np.zeros(0, dtype='int64')] for _ in range(3)]
+        for c in self._get_clusters(clusters):
+            t = self.cluster_times(c)
+            lo = np.searchsorted(t, event_times + window[0], side='left')
+            hi = np.searchsorted(t, event_times + window[1], side='left')
+            counts = hi - lo
+            n = counts.sum()
+            ev = np.repeat(np.arange(event_times.size), counts)
+            # Position of each spike within its event's window.
+            pos = np.arange(n) - np.repeat(np.cumsum(counts) - counts, counts)
+            rel_times.append(t[lo[ev] + pos] - event_times[ev])
+            events.append(ev)
+            ids.append(np.full(n, c, dtype='int64'))
+
+        return (np.concatenate(rel_times), np.concatenate(events),
+                np.concatenate(ids))
+
+    def psth(self, event_times, window, bin_size, clusters=None):
+        """Count spikes in bins around each of many events.
+
+        Parameters
+        ----------
+        event_times : array-like
+            Event times in samples, with shape (n_events,).
+        window : tuple of int
+            `(before, after)` offsets relative to each event, in samples.
+        bin_size : int
+            Bin width in samples. The last bin is dropped if it would extend
+            past `window[1]`.
+        clusters : int or array-like; optional.
+            Cluster ids to include. By default, all clusters are used.
+
+        Returns
+        -------
+        counts : np.ndarray
+            Spike counts with shape (n_clusters, n_events, n_bins). Divide by
+            `bin_size / fs` to convert to rates in Hz.
+
+        """
+        clusters = self._get_clusters(clusters)
+        event_times = np.asarray(event_times, dtype='int64')
+        n_bins = (window[1] - window[0]) // bin_size
+        edges = (event_times[:, np.newaxis] + window[0]
+                 + np.arange(n_bins + 1) * bin_size)
+        counts = np.zeros((clusters.size, event_times.size, n_bins),
+                          dtype='int32')
+        for i, c in enumerate(clusters):
+            idx = np.searchsorted(self.cluster_times(c), edges, side='left')
+            counts[i] = np.diff(idx, axis=1)
+
+        return counts
+
+    def binned_counts(self, bin_size, t0=0, t1=None, clusters=None):
+        """Count spikes in consecutive bins, with shape (n_clusters, n_bins).
+
+        Bins start at `t0` and extend up to `t1`, which defaults to the time
+        of the last spike. Divide by `bin_size / fs` for rates in Hz.
+
+        """
+        clusters = self._get_clusters(clusters)
+        if t1 is None:
+            t1 = int(self.spike_times[-1]) + 1 if len(self.spike_times) else t0
+        n_bins = int(np.ceil((t1 - t0) / bin_size))
+        counts = np.zeros((clusters.size, n_bins), dtype='int32')
+        for i, c in enumerate(clusters):
+            t = self.cluster_times(c)
+            t = t[np.searchsorted(t, t0):np.searchsorted(t, t1)]
+            counts[i] = np.bincount((t - t0) // bin_size, minlength=n_bins)
+
+        return counts
@@ -9,10 +9,19 @@ import torch
 from kilosort import spikedetect
 
 
-def bin_spikes(ops, st):
-    """ for each batch, the spikes in that batch are binned to a 2D matrix by amplitude and depth
-    """
+def fingerprint_bins(ops):
+    """Depth binning used by `bin_spikes`.
+
+    Returns
+    -------
+    dmin : float
+        Lower edge of the first depth bin, 1um below the lowest channel.
+    dmax : int
+        Number of depth bins.
+    ysamp : np.ndarray
+        Center of each depth bin.
 
+    """
     # the bin edges are based on min and max of channel y positions
     ymin = ops['yc'].min()
     ymax = ops['yc'].max()
@@ -24,6 +33,61 @@ def bin_spikes(ops, st):
     # dmax is how many bins to use
     dmax = 1 + np.ceil((ymax-dmin)/dd).astype('int32')
 
+    # center of each vertical sampling bin
+    ysamp = dmin + dd * np.arange(dmax) - dd/2
+
+    return dmin, dmax, ysamp
+
+
+def bin_batch(ops, depths, amps, dmin, dmax):
+    """Fingerprint of one batch: log2 counts of spikes by depth and amplitude.
+
+    Parameters
+    ----------
+    ops : dict
+        Dictionary storing settings and results for all algorithmic steps.
+    depths, amps : np.ndarray
+        Depth (in microns) and amplitude of each spike in the batch, as in
+        columns 1 and 2 of the spike table returned by `spikedetect.run`.
+    dmin, dmax : float, int
+        Depth binning returned by `fingerprint_bins`.
+
+    Returns
+    -------
+    np.ndarray
+        Shape (dmax, 20).
+
+    """
+    dd = ops['binning_depth']
+
+    # their depth relative to the minimum
+    dep = depths - dmin
+
+    # the amplitude binnning is logarithmic, goes from the Th_universal minimum value to 100. 
+    amp = np.log10(np.minimum(99, amps)) - np.log10(ops['Th_universal'])
+
+    # amplitudes get normalized from 0 to 1
+    amp = amp / (np.log10(100)-np.log10(ops['Th_universal']))
+
+    # rows are divided by the vertical binning depth
+    rows = (dep/dd).astype('int32')
+
+    # columns are from 0 to 20
+    cols = (1e-5 + amp * 20).astype('int32')
+
+    # for efficient binning, use sparse matrix computation in scipy
+    cou = np.ones(len(dep))
+    M = coo_matrix((cou, (rows, cols)), (dmax, 20))
+
+    # the 2D histogram counts are transformed to logarithm
+    return np.log2(1+M.todense())
+
+
+def bin_spikes(ops, st):
+    """ for each batch, the spikes in that batch are binned to a 2D matrix by amplitude and depth
+    """
+
+    dmin, dmax, ysamp = fingerprint_bins(ops)
     Nbatches = ops['Nbatches']
     
     batch_id = st[:,4].copy()
@@ -34,31 +98,7 @@ def bin_spikes(ops, st):
         # consider only spikes from this batch
         ix = (batch_id==t).nonzero()[0]
         sst = st[ix]
-
-        # their depth relative to the minimum
-        dep = sst[:,1] - dmin
-
-        # the amplitude binnning is logarithmic, goes from the Th_universal minimum value to 100. 
-        amp = np.log10(np.minimum(99, sst[:,2])) - np.log10(ops['Th_universal'])
-
-        # amplitudes get normalized from 0 to 1
-        amp = amp / (np.log10(100)-np.log10(ops['Th_universal']))
-
-        # rows are divided by the vertical binning depth
-        rows = (dep/dd).astype('int32')
-
-        # columns are from 0 to 20
-        cols = (1e-5 + amp * 20).astype('int32')
-
-        # for efficient binning, use sparse matrix computation in scipy
-        cou = np.ones(len(ix))
-        M = coo_matrix((cou, (rows, cols)), (dmax, 20))
-
-        # the 2D histogram counts are transformed to logarithm
-        F[t] = np.log2(1+M.todense())
-
-    # center of each vertical sampling bin
-    ysamp = dmin + dd * np.arange(dmax) - dd/2
+        F[t] = bin_batch(ops, sst[:,1], sst[:,2], dmin, dmax)
 
     return F, ysamp
 
@@ -197,14 +237,27 @@ def run(ops, bfile, device=torch.device('cuda'), progress_bar=None,
         logger.info('nblocks = 0, skipping drift correction')
         return ops, None
     
-    # the first step is to extract all spikes using the universal templates
-    st, _, ops  = spikedetect.run(
-        ops, bfile, device=device, progress_bar=progress_bar,
-        clear_cache=clear_cache, verbose=verbose
-        )
-
-    # spikes are binned by amplitude and y-position to construct a "fingerprint" for each batch
-    F, ysamp = bin_spikes(ops, st)
+    if ops['settings'].get('drift_only_detection', False):
+        # spikes are binned into fingerprints as each batch is detected,
+        # without storing spike times or PC features
+        dmin, dmax, ysamp = fingerprint_bins(ops)
+        F = np.zeros((ops['Nbatches'], dmax, 20))
+        def bin_callback(ibatch, stt):
+            F[ibatch] = bin_batch(ops, stt[:,1], stt[:,2], dmin, dmax)
+
+        st, _, ops = spikedetect.run(
+            ops, bfile, device=device, progress_bar=progress_bar,
+            clear_cache=clear_cache, verbose=verbose, batch_callback=bin_callback
+            )
+    else:
+        # the first step is to extract all spikes using the universal templates
+        st, _, ops  = spikedetect.run(
+            ops, bfile, device=device, progress_bar=progress_bar,
+            clear_cache=clear_cache, verbose=verbose
+            )
+
+        # spikes are binned by amplitude and y-position to construct a "fingerprint" for each batch
+        F, ysamp = bin_spikes(ops, st)
 
     # the fingerprints are iteratively aligned to each other vertically
     imin, yblk, _, _ = align_block2(F, ysamp, ops, device=device)
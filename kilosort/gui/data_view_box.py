@@ -1,5 +1,8 @@
+import threading
+
 import numpy as np
 import pyqtgraph as pg
+from kilosort.io import TracePyramid
 from kilosort.gui.logger import setup_logger
 from kilosort.gui.palettes import COLORMAP_COLORS
 from qtpy import QtCore, QtWidgets
@@ -64,6 +67,12 @@ class DataViewBox(QtWidgets.QGroupBox):
         self.primary_channel = 0
         self.current_time = 0
         self.plot_range = 0.1  # seconds
+        self.max_raw_plot_range = 1.0  # seconds, without a trace pyramid
+
+        # Min/max/RMS of traces at several decimation levels, used to draw
+        # zoomed-out views without reading the full time range.
+        self.pyramids = {"raw": None, "whitened": None}
+        self.pyramid_workers = []
 
         self.highpass_filter = None
 
@@ -336,7 +345,7 @@ class DataViewBox(QtWidgets.QGroupBox):
         current_range = self.plot_range
         # neg sign to reverse scrolling behaviour
         new_range = current_range * (1.2 ** -direction)
-        if 0.005 < new_range < 1.0:
+        if 0.005 < new_range < self.get_max_plot_range():
             diff_range = new_range - current_range
             current_time = self.current_time
             new_time = current_time - diff_range/2.
@@ -374,7 +383,9 @@ class DataViewBox(QtWidgets.QGroupBox):
         if self.context_set():
             if ev.button() == QtCore.Qt.LeftButton:
                 sample_rate = self.get_context().params["fs"]
-                x_pos = self.colormap_image.mapFromScene(ev.pos()).x()
+                # Map to samples through the view box, since images drawn from
+                # a trace pyramid are scaled along the time axis.
+                x_pos = self.data_view_box.mapSceneToView(ev.pos()).x()
                 plot_range = self.plot_range * sample_rate
                 fraction = x_pos / plot_range
                 if fraction > 0.5:
@@ -413,6 +424,48 @@ class DataViewBox(QtWidgets.QGroupBox):
         self.time_seek.setBounds((min_time, max_time))
         self.seek_range = (min_time, max_time)
 
+    def get_max_plot_range(self):
+        view = "raw" if self.raw_button.isChecked() else "whitened"
+        pyramid = self.pyramids[view]
+        if pyramid is not None and pyramid.complete:
+            return self.seek_range[1] - self.seek_range[0]
+        return self.max_raw_plot_range
+
+    def load_pyramids(self, context):
+        """Open or build trace pyramids for the raw and whitened views."""
+        self.stop_pyramid_builds()
+        files = {
+            "raw": context.binary_file,
+            "whitened": context.filt_binary_file,
+        }
+        for view, bfile in files.items():
+            if bfile is None:
+                continue
+            try:
+                pyramid = TracePyramid.from_bfile(bfile, view)
+            except OSError:
+                logger.exception(f'Could not open trace pyramid for {view} data.')
+                continue
+            self.pyramids[view] = pyramid
+            if not pyramid.complete:
+                worker = PyramidWorker(view, pyramid, bfile)
+                worker.finishedPyramid.connect(self.on_pyramid_finished)
+                self.pyramid_workers.append(worker)
+                worker.start()
+
+    def stop_pyramid_builds(self):
+        for worker in self.pyramid_workers:
+            worker.stop_event.set()
+            worker.wait()
+        self.pyramid_workers = []
+        self.pyramids = {"raw": None, "whitened": None}
+
+    @QtCore.Slot(str, bool)
+    def on_pyramid_finished(self, view, success):
+        if success:
+            logger.info(f'Finished building trace pyramid for {view} data.')
+            self.update_plot()
+
     def update_seek_text(self, seek):
         position = seek.pos()[0]
         self.time_label.setText("t={0:.2f} s".format(position))
@@ -447,10 +500,12 @@ class DataViewBox(QtWidgets.QGroupBox):
     def reset(self):
         self.plot_item.clear()
         self.clear_cached_whitening_matrix()
+        self.stop_pyramid_builds()
 
     def prepare_for_new_context(self):
         self.plot_item.clear()
         self.clear_cached_whitening_matrix()
+        self.stop_pyramid_builds()
 
     def clear_cached_whitening_matrix(self):
         self.whitening_matrix = None
@@ -461,7 +516,7 @@ class DataViewBox(QtWidgets.QGroupBox):
         color_map = pg.ColorMap(pos=positions, color=self._colors)
         return color_map.getLookupTable(nPts=num_points)
 
-    def add_image_to_plot(self, raw_traces, level_min, level_max):
+    def add_image_to_plot(self, raw_traces, level_min, level_max, factor=1):
         image_item = pg.ImageItem(setPxMode=False)
         image_item.setImage(
             raw_traces,
@@ -470,6 +525,12 @@ class DataViewBox(QtWidgets.QGroupBox):
             levels=(level_min, level_max),
             autoDownsample=False,
         )
+        if factor > 1:
+            # Each pixel of a pyramid level spans `factor` samples.
+            n_blocks, n_channels = raw_traces.shape
+            image_item.setRect(
+                QtCore.QRectF(0, 0, n_blocks * factor, n_channels)
+            )
         self.colormap_image = image_item
         self.plot_item.addItem(image_item)
 
@@ -557,7 +618,19 @@ class DataViewBox(QtWidgets.QGroupBox):
             end_time
     ):
 
+        n_pixels = self.data_view_widget.width()
         if self.raw_button.isChecked():
+            pyramid_traces, factor = self.get_pyramid_traces(
+                "raw", to_display, start_time, end_time, n_pixels
+            )
+            if pyramid_traces is not None:
+                colormap_min = np.percentile(pyramid_traces, 0.5)
+                colormap_max = np.percentile(pyramid_traces, 99.5)
+                self.add_image_to_plot(
+                    pyramid_traces, colormap_min, colormap_max, factor=factor
+                )
+                return
+
             raw_traces = binary_file[start_time:end_time].cpu().numpy()
             colormap_min = np.percentile(raw_traces, 0.5)
             colormap_max = np.percentile(raw_traces, 99.5)
@@ -568,14 +641,64 @@ class DataViewBox(QtWidgets.QGroupBox):
             )
 
         elif self.whitened_button.isChecked():
-            whitened_traces = filt_binary_file[start_time:end_time].cpu().numpy()
             colormap_min, colormap_max = -4.0, 4.0
+            pyramid_traces, factor = self.get_pyramid_traces(
+                "whitened", to_display, start_time, end_time, n_pixels
+            )
+            if pyramid_traces is not None:
+                self.add_image_to_plot(
+                    pyramid_traces, colormap_min, colormap_max, factor=factor
+                )
+                return
+
+            whitened_traces = filt_binary_file[start_time:end_time].cpu().numpy()
             self.add_image_to_plot(
                 whitened_traces[to_display, :].T,
                 colormap_min,
                 colormap_max,
             )
 
+    def get_pyramid_traces(self, view, to_display, start_time, end_time,
+                           n_pixels):
+        """Get the peak of each block from the coarsest level that fills
+        `n_pixels`, or (None, None) if the traces should be read directly."""
+        pyramid = self.pyramids[view]
+        if pyramid is None:
+            return None, None
+        factor = pyramid.level_for(end_time - start_time, n_pixels)
+        if factor is None:
+            return None, None
+
+        stats = pyramid.read(factor, start_time, end_time, channels=to_display)
+        # Show whichever of min or max is further from 0, so that spikes
+        # stay visible after decimation.
+        mins, maxs = stats[..., 0], stats[..., 1]
+        traces = np.where(np.abs(maxs) >= np.abs(mins), maxs, mins)
+        return traces, factor
+
+
+class PyramidWorker(QtCore.QThread):
+    finishedPyramid = QtCore.Signal(str, bool)
+
+    def __init__(self, view, pyramid, binary_file, *args, **kwargs):
+        super(PyramidWorker, self).__init__(*args, **kwargs)
+        self.view = view
+        self.pyramid = pyramid
+        self.binary_file = binary_file
+        self.stop_event = threading.Event()
+
+    def run(self):
+        logger.info(f'Building trace pyramid for {self.view} data in '
+                    f'{self.pyramid.directory}.')
+        try:
+            success = self.pyramid.build(
+                self.binary_file, stop_event=self.stop_event
+            )
+        except Exception:
+            logger.exception(f'Could not build trace pyramid for {self.view} data.')
+            success = False
+        self.finishedPyramid.emit(self.view, success)
+
 
 class KSPlotWidget(pg.PlotWidget):
     signalChangeTimePoint = QtCore.Signal(float)
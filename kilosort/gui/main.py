@@ -365,7 +365,9 @@ class KilosortGUI(QtWidgets.QMainWindow):
             'fs': sample_rate, 'chan_map': chan_map, 'device': self.device,
             'tmin': tmin, 'tmax': tmax, 'shift': shift, 'scale': scale,
             'artifact_threshold': artifact, 'dtype': data_dtype,
-            'file_object': self.file_object
+            'file_object': self.file_object,
+            'car_mode': self.params.get('car_mode', 'median'),
+            'channel_groups': self.probe_layout.get('kcoords')
         }
 
         if chan_map.max() >= n_channels:
@@ -393,10 +395,12 @@ class KilosortGUI(QtWidgets.QMainWindow):
             )
         del bfile_whiten  # only used for computing whitening matrix
 
+        # Views can be any length, so filter them in fast-length blocks.
         filt_binary_file = BinaryFiltered(
             *args, **kwargs,
             hp_filter=self.context.highpass_filter,
             whiten_mat=self.context.whitening_matrix,
+            filter_mode='overlap_save',
             )
         self.context.filt_binary_file = filt_binary_file
 
@@ -417,6 +421,7 @@ class KilosortGUI(QtWidgets.QMainWindow):
 
     def setup_data_view(self):
         self.data_view_box.setup_seek(self.context)
+        self.data_view_box.load_pyramids(self.context)
         self.data_view_box.enable_view_buttons()
 
     def setup_context(self):
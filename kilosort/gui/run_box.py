@@ -249,7 +249,8 @@ class RunBox(QtWidgets.QGroupBox):
             dshift = self.current_worker.dshift
             st0 = self.current_worker.st0
             plot_drift_amount(plot_window1, dshift, settings)
-            plot_drift_scatter(plot_window2, st0, settings)
+            if st0 is not None:
+                plot_drift_scatter(plot_window2, st0, settings)
 
         elif plot_type == 'diagnostics':
             plot_window = self.plots['diagnostics']
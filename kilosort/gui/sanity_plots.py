@@ -7,6 +7,7 @@ import matplotlib
 import torch
 from qtpy import QtWidgets
 
+from kilosort.io import load_result
 from kilosort.postprocessing import compute_spike_positions
 from kilosort.plots import COLOR_CODES, PROBE_PLOT_COLORS
 
@@ -179,7 +180,7 @@ def plot_spike_positions(plot_window, clu, is_refractory, settings):
 
     # Get x, y positions, add to scatterplot
     results_dir = Path(settings['results_dir'])
-    positions = np.load(results_dir / 'spike_positions.npy')
+    positions = load_result(results_dir, 'spike_positions')
     xs, ys = positions[:,0], positions[:,1]
     scatter = pg.ScatterPlotItem(ys, xs, symbol='o', size=3, pen=None,
                                  brush=brushes)
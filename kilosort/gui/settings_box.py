@@ -973,7 +973,7 @@ def _check_parameter(sender_obj, main_obj, k, p):
             v = None
         else:
             v = _str_to_type(value, p['type'])
-            if isinstance(v, bool) or isinstance(v, list):
+            if isinstance(v, (bool, list, str)):
                 pass
             else:
                 assert v >= p['min']
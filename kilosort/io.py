@@ -1,23 +1,34 @@
 import json
+import hashlib
+import zlib
+import base64
+import pickle
 from pathlib import Path
 from typing import Tuple, Union
 import os, shutil
 import warnings
-from concurrent.futures import ThreadPoolExecutor
+import bisect
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import time
 import logging
 logger = logging.getLogger(__name__)
 
 from scipy.io import loadmat
+import scipy.sparse
 import numpy as np
 import torch
-from torch.fft import fft, ifft, fftshift
 
 from kilosort import CCG
-from kilosort.preprocessing import get_drift_matrix, fft_highpass
+from kilosort.preprocessing import (
+    get_drift_matrix, get_drift_matrices, FFTFilter, CommonReference,
+    SparseOperator, center_channels, exceeds_threshold
+    )
 from kilosort.postprocessing import (
     remove_duplicates, compute_spike_positions, make_pc_features
     )
+from kilosort.utils import compiled
 
 _torch_warning = ".*PyTorch does not support non-writable tensors"
 
@@ -28,15 +39,19 @@ def find_binary(data_dir: Union[str, os.PathLike]) -> Path:
     data_dir = Path(data_dir)
     filenames = list(data_dir.glob('*.bin')) + list(data_dir.glob('*.bat')) \
                 + list(data_dir.glob('*.dat')) + list(data_dir.glob('*.raw'))
+    if len(filenames) == 0:
+        # Only use compressed files if there is no uncompressed copy.
+        filenames = list(data_dir.glob('*.cbin'))
     if len(filenames) == 0:
         raise FileNotFoundError(
             f'No binary file found in {data_dir}. Expected extensions are:\n'
-            '*.bin, *.bat, *.dat, or *.raw.'
+            '*.bin, *.bat, *.dat, *.raw, or *.cbin.'
             )
 
     # If there are multiple binary files, find one with "ap" tag
     if len(filenames) > 1:
-        filenames = [f for f in filenames if 'ap.bin' in f.as_posix()]
+        filenames = [f for f in filenames
+                     if 'ap.bin' in f.as_posix() or 'ap.cbin' in f.as_posix()]
 
     # If there is still more than one, raise an error, user needs to specify
     # full path.
@@ -246,7 +261,7 @@ def select_shank(probe, shank_idx):
 
 def save_to_phy(st, clu, tF, Wall, probe, ops, imin, results_dir=None,
                 data_dtype=None, save_extra_vars=False,
-                save_preprocessed_copy=False):
+                save_preprocessed_copy=False, n_workers=None):
     """Save sorting results to disk in a format readable by Phy.
 
     Parameters
@@ -282,6 +297,9 @@ def save_to_phy(st, clu, tF, Wall, probe, ops, imin, results_dir=None,
         If True, save a pre-processed copy of the data (including drift
         correction) to `temp_wh.dat` in the results directory and format Phy
         output to use that copy of the data.
+    n_workers : int; optional.
+        Number of threads used to compute outputs and write files concurrently.
+        Defaults to the number of CPUs, up to 8.
     
     Returns
     -------
@@ -329,6 +347,17 @@ def save_to_phy(st, clu, tF, Wall, probe, ops, imin, results_dir=None,
     cluster_ContamPct.tsv : shape (n_templates,)
         Contamination rate for each template, computed as fraction of refractory
         period violations relative to expectation based on a Poisson process.
+    cluster_spike_offsets.npy : shape (n_templates + 1,)
+        Offsets into `cluster_spike_order.npy`, such that the spikes assigned
+        to cluster `i` are `order[offsets[i]:offsets[i+1]]`.
+    cluster_spike_order.npy : shape (n_spikes,)
+        Spike indices sorted by cluster, used with
+        `cluster_spike_offsets.npy` to look up one cluster's spikes without
+        scanning `spike_clusters.npy`. See `cluster_spike_index`.
+    cluster_spike_index.json
+        Size and modification time of `spike_clusters.npy` when the index
+        was saved, so that the index is ignored after Phy curation. See
+        `save_cluster_index`.
     cluster_KSLabel.tsv : shape (n_templates,)
         Label indicating whether each template is 'mua' (multi-unit activity)
         or 'good' (refractory).
@@ -337,10 +366,10 @@ def save_to_phy(st, clu, tF, Wall, probe, ops, imin, results_dir=None,
     kept_spikes.npy : shape (n_spikes,)
         Boolean mask that is False for spikes that were removed by
         `kilosort.postprocessing.remove_duplicate_spikes` and True otherwise.
-    ops.npy : shape N/A
+    ops : directory
         Dictionary containing a number of state variables saved throughout
-        the sorting process (see `run_kilosort`). We recommend loading with
-        `kilosort.io.load_ops`.
+        the sorting process (see `run_kilosort`), saved by
+        `kilosort.io.save_ops`. Load with `kilosort.io.load_ops`.
     params.py : shape N/A
         Settings used by Phy, like data location and sampling rate.
     pc_features.npy : shape (n_spikes, n_pcs, nearest_chans)
@@ -369,6 +398,10 @@ def save_to_phy(st, clu, tF, Wall, probe, ops, imin, results_dir=None,
         Matrix applied to data for whitening.
     whitening_mat_inv.npy : shape (n_channels, n_channels)
         Inverse of whitening matrix.
+    whitening_mat_sparse.npz : shape (n_channels, n_channels)
+        Only saved if `settings['sparse_preprocessing']` is True. Same as
+        `whitening_mat.npy`, as a `scipy.sparse.csr_matrix` without entries
+        that were treated as zero (load with `scipy.sparse.load_npz`).
     whitening_mat_dat.npy : shape (n_channels, n_channels)
         matrix applied to data for whitening. Currently this is the same as
         `whitening_mat.npy`, but was added because the latter was previously
@@ -383,16 +416,27 @@ def save_to_phy(st, clu, tF, Wall, probe, ops, imin, results_dir=None,
     results_dir = Path(results_dir)
     results_dir.mkdir(exist_ok=True)
 
+    results_format = ops['settings'].get('results_format', 'phy')
+    if results_format not in ['phy', 'container', 'both']:
+        raise ValueError(
+            f"results_format must be 'phy', 'container' or 'both', "
+            f"got {results_format}."
+            )
+    # Arrays saved as `{name}.npy` for Phy, or as columns in the container.
+    results = {}
+    if n_workers is None:
+        n_workers = min(os.cpu_count() or 1, 8)
+
     # probe properties
     chan_map = probe['chanMap']
     channel_positions = np.stack((probe['xc'], probe['yc']), axis=-1)
-    np.save((results_dir / 'channel_map.npy'), chan_map)
-    np.save((results_dir / 'channel_positions.npy'), channel_positions)
-    np.save((results_dir / 'channel_shanks.npy'), probe['kcoords'])
+    results['channel_map'] = chan_map
+    results['channel_positions'] = channel_positions
+    results['channel_shanks'] = probe['kcoords']
 
     # whitening matrix
     whitening_mat = ops['Wrot']
-    np.save((results_dir / 'whitening_mat_dat.npy'), whitening_mat.cpu())
+    results['whitening_mat_dat'] = whitening_mat.cpu().numpy()
     # NOTE: commented out for reference, this was different in KS 2.5 because
     #       the binary file was already whitened.
     # whitening_mat = 0.005 * np.eye(len(chan_map), dtype='float32')
@@ -400,78 +444,143 @@ def save_to_phy(st, clu, tF, Wall, probe, ops, imin, results_dir=None,
         whitening_mat
         + 1e-5 * torch.eye(whitening_mat.shape[0]).to(whitening_mat.device)
         )
-    np.save((results_dir / 'whitening_mat.npy'), whitening_mat.cpu())
-    np.save((results_dir / 'whitening_mat_inv.npy'), whitening_mat_inv.cpu())
-
-    # spike properties
-    spike_times = st[:,0].astype('int64') + imin  # shift by minimum sample index
-    spike_templates = st[:,1].astype('int32')
-    spike_clusters = clu
-    xs, ys = compute_spike_positions(st, tF, ops)
-    spike_positions = np.vstack([xs, ys]).T
-    amplitudes = ((tF**2).sum(axis=(-2,-1))**0.5).cpu().numpy()
-    # remove duplicate (artifact) spikes
-    spike_times, spike_clusters, kept_spikes = remove_duplicates(
-        spike_times, spike_clusters, dt=ops['duplicate_spike_bins']
-    )
-    amp = amplitudes[kept_spikes]
-    spike_templates = spike_templates[kept_spikes]
-    spike_positions = spike_positions[kept_spikes]
-    np.save((results_dir / 'spike_times.npy'), spike_times)
-    np.save((results_dir / 'spike_templates.npy'), spike_clusters)
-    np.save((results_dir / 'spike_clusters.npy'), spike_clusters)
-    np.save((results_dir / 'spike_positions.npy'), spike_positions)
-    np.save((results_dir / 'spike_detection_templates.npy'), spike_templates)
-    np.save((results_dir / 'amplitudes.npy'), amp)
-    # Save spike mask so that it can be applied to other variables if needed
-    # when loading results.
-    np.save((results_dir / 'kept_spikes.npy'), kept_spikes)
-
-    # template properties
-    similar_templates = CCG.similarity(Wall, ops['wPCA'].contiguous(), nt=ops['nt'])
-    template_amplitudes = ((Wall**2).sum(axis=(-2,-1))**0.5).cpu().numpy()
-    templates = (Wall.unsqueeze(-1).cpu() * ops['wPCA'].cpu()).sum(axis=-2).numpy()
-    templates = templates.transpose(0,2,1)
-    templates_ind = np.tile(np.arange(Wall.shape[1])[np.newaxis, :], (templates.shape[0],1))
-    np.save((results_dir / 'similar_templates.npy'), similar_templates)
-    np.save((results_dir / 'templates.npy'), templates)
-    np.save((results_dir / 'templates_ind.npy'), templates_ind)
-    
-    # pc features
-    if save_extra_vars:
-        # Save tF first since it gets updated in-place
-        np.save(results_dir / 'tF.npy', tF.cpu().numpy())
-    # This will momentarily copy tF which is pretty large, but it's on CPU
-    # so the extra memory hopefully won't be an issue.
-    tF = tF[kept_spikes]
-    pc_features, pc_feature_ind = make_pc_features(
-        ops, spike_templates, spike_clusters, tF
+    results['whitening_mat'] = whitening_mat.cpu().numpy()
+    results['whitening_mat_inv'] = whitening_mat_inv.cpu().numpy()
+    if ops['settings'].get('sparse_preprocessing', False):
+        # Sparsity detected the same way as when whitening was applied.
+        whitening_op = SparseOperator(
+            whitening_mat, probe['kcoords'], tol=SPARSE_OPS_TOL
+            )
+        scipy.sparse.save_npz(
+            results_dir / 'whitening_mat_sparse.npz', whitening_op.to_scipy()
+            )
+
+    # Outputs that don't depend on each other are computed concurrently, and
+    # each .npy file is written in the background as soon as it's ready.
+    save_npy = results_format in ['phy', 'both']
+    timings = {}
+    executor = ThreadPoolExecutor(max_workers=n_workers)
+    writes = []
+
+    def add_result(name, x):
+        results[name] = x
+        if save_npy and name not in _TSV_VARIABLES:
+            writes.append(executor.submit(
+                _timed, timings, f'{name}.npy', np.save,
+                results_dir / f'{name}.npy', x
+                ))
+
+    try:
+        for name, x in list(results.items()):
+            add_result(name, x)
+
+        # spike properties
+        spike_times = st[:,0].astype('int64') + imin  # shift by minimum sample index
+        spike_templates = st[:,1].astype('int32')
+        # remove duplicate (artifact) spikes
+        spike_times, spike_clusters, kept_spikes = remove_duplicates(
+            spike_times, clu, dt=ops['duplicate_spike_bins']
         )
-    np.save(results_dir / 'pc_features.npy', pc_features)
-    np.save(results_dir / 'pc_feature_ind.npy', pc_feature_ind)
 
-    # contamination ratio
-    acg_threshold = ops['settings']['acg_threshold']
-    ccg_threshold = ops['settings']['ccg_threshold']
-    is_ref, est_contam_rate = CCG.refract(spike_clusters, spike_times / ops['fs'],
-                                          acg_threshold=acg_threshold,
-                                          ccg_threshold=ccg_threshold)
+        acg_threshold = ops['settings']['acg_threshold']
+        ccg_threshold = ops['settings']['ccg_threshold']
+        # pc features are written directly to disk, a chunk at a time. If only
+        # the container is saved, the file is removed after it's written.
+        pc_path = results_dir / 'pc_features.npy' if save_npy \
+                  else results_dir / 'pc_features_tmp.npy'
+        futures = {
+            'spike_positions': executor.submit(
+                _timed, timings, 'spike_positions', _spike_positions,
+                st, tF, ops, kept_spikes
+                ),
+            'amplitudes': executor.submit(
+                _timed, timings, 'amplitudes', _spike_amplitudes, tF
+                ),
+            'templates': executor.submit(
+                _timed, timings, 'templates', _template_properties, Wall, ops
+                ),
+            'refract': executor.submit(
+                _timed, timings, 'refract', CCG.refract, spike_clusters,
+                spike_times / ops['fs'], acg_threshold=acg_threshold,
+                ccg_threshold=ccg_threshold
+                ),
+            'cluster_index': executor.submit(
+                _timed, timings, 'cluster_index', cluster_spike_index,
+                spike_clusters, Wall.shape[0]
+                ),
+            'pc_features': executor.submit(
+                _timed, timings, 'pc_features', _stream_pc_features, ops,
+                spike_templates, clu, tF, kept_spikes, pc_path
+                ),
+        }
 
-    # write properties to *.tsv
-    stypes = ['ContamPct', 'Amplitude', 'KSLabel']
-    ks_labels = [['mua', 'good'][int(r)] for r in is_ref]
-    props = [est_contam_rate*100, template_amplitudes, ks_labels]
-    for stype, prop in zip(stypes, props):
-        with open((results_dir / f'cluster_{stype}.tsv'), 'w') as f:
-            f.write(f'cluster_id\t{stype}\n')
-            for i,p in enumerate(prop):
-                if stype != 'KSLabel':
-                    f.write(f'{i}\t{p:.1f}\n')
-                else:
-                    f.write(f'{i}\t{p}\n')
-        if stype == 'KSLabel':
-            shutil.copyfile((results_dir / f'cluster_{stype}.tsv'), 
-                            (results_dir / f'cluster_group.tsv'))
+        add_result('spike_times', spike_times)
+        add_result('spike_templates', spike_clusters)
+        add_result('spike_clusters', spike_clusters)
+        add_result('spike_positions', futures['spike_positions'].result())
+        add_result('spike_detection_templates', spike_templates[kept_spikes])
+        amplitudes = futures['amplitudes'].result()
+        add_result('amplitudes', amplitudes[kept_spikes])
+        # Save spike mask so that it can be applied to other variables if needed
+        # when loading results.
+        add_result('kept_spikes', kept_spikes)
+        # Per-cluster spike index, see `cluster_spike_index`.
+        order, offsets = futures['cluster_index'].result()
+        add_result('cluster_spike_order', order)
+        add_result('cluster_spike_offsets', offsets)
+
+        # template properties
+        similar_templates, template_amplitudes, templates, templates_ind = \
+            futures['templates'].result()
+        add_result('similar_templates', similar_templates)
+        add_result('templates', templates)
+        add_result('templates_ind', templates_ind)
+
+        # pc features
+        if save_extra_vars:
+            add_result('tF', tF.cpu().numpy())
+        pc_features, pc_feature_ind = futures['pc_features'].result()
+        # Already saved to `pc_path`.
+        results['pc_features'] = pc_features
+        add_result('pc_feature_ind', pc_feature_ind)
+
+        # contamination ratio
+        is_ref, est_contam_rate = futures['refract'].result()
+        add_result('is_ref', is_ref)
+        add_result('est_contam_rate', est_contam_rate)
+        add_result('template_amplitudes', template_amplitudes)
+
+        if save_extra_vars:
+            # Also save Wall, for easier debugging/analysis
+            add_result('Wall', Wall.cpu().numpy())
+            # And full st, clu, amp arrays with no spikes removed
+            add_result('full_st', st)
+            add_result('full_clu', clu)
+            add_result('full_amp', amplitudes)
+
+        for f in writes:
+            f.result()
+    finally:
+        executor.shutdown(wait=True)
+
+    if save_npy:
+        # Index files are already written, record which spike_clusters.npy
+        # they belong to.
+        save_cluster_index(results_dir)
+
+    if save_npy:
+        _save_cluster_tsv(results_dir, results)
+    if results_format in ['container', 'both']:
+        _timed(timings, SortingContainer.FILENAME, SortingContainer.write,
+               results_dir / SortingContainer.FILENAME, results)
+    if not save_npy:
+        # Release all references to the memmap before removing the file.
+        del results['pc_features'], pc_features
+        futures.clear()
+        pc_path.unlink()
+
+    for name, t in sorted(timings.items(), key=lambda x: -x[1]):
+        logger.info(f'{name}: {t:.2f}s')
 
     # params.py
     dtype = "'int16'" if data_dtype is None else f"'{data_dtype}'"
@@ -498,14 +607,6 @@ def save_to_phy(st, clu, tF, Wall, probe, ops, imin, results_dir=None,
         for key in params.keys():
             f.write(f'{key} = {params[key]}\n')
 
-    if save_extra_vars:
-        # Also save Wall, for easier debugging/analysis
-        np.save(results_dir / 'Wall.npy', Wall.cpu().numpy())
-        # And full st, clu, amp arrays with no spikes removed
-        np.save(results_dir / 'full_st.npy', st)
-        np.save(results_dir / 'full_clu.npy', clu)
-        np.save(results_dir / 'full_amp.npy', amplitudes)
-
     # Remove cached .phy results if present from running Phy on a previous
     # version of results in the same directory.
     phy_cache_path = Path(results_dir / '.phy')
@@ -515,8 +616,525 @@ def save_to_phy(st, clu, tF, Wall, probe, ops, imin, results_dir=None,
     return results_dir, similar_templates, is_ref, est_contam_rate, kept_spikes
 
 
-def save_ops(ops, results_dir=None):
-    """Save intermediate `ops` dictionary to `results_dir/ops.npy`."""
+# Variables used to write cluster_*.tsv files rather than .npy files.
+_TSV_VARIABLES = ['is_ref', 'est_contam_rate', 'template_amplitudes']
+
+
+def _timed(timings, name, func, *args, **kwargs):
+    """Call `func` and store its runtime in seconds as `timings[name]`."""
+    t0 = time.time()
+    out = func(*args, **kwargs)
+    timings[name] = time.time() - t0
+    return out
+
+
+def _spike_positions(st, tF, ops, kept_spikes, chunk_size=2**20):
+    """Compute positions of kept spikes, a chunk of spikes at a time."""
+    positions = []
+    for i in range(0, st.shape[0], chunk_size):
+        xs, ys = compute_spike_positions(
+            st[i:i+chunk_size], tF[i:i+chunk_size], ops
+            )
+        keep = kept_spikes[i:i+chunk_size]
+        positions.append(np.vstack([xs[keep], ys[keep]]).T)
+    if len(positions) == 0:
+        return np.zeros((0, 2), dtype='float32')
+    return np.concatenate(positions, axis=0)
+
+
+def _spike_amplitudes(tF, chunk_size=2**20):
+    """L2 norm of PC features for each spike, a chunk of spikes at a time."""
+    amplitudes = [((tF[i:i+chunk_size]**2).sum(axis=(-2,-1))**0.5).cpu().numpy()
+                  for i in range(0, tF.shape[0], chunk_size)]
+    if len(amplitudes) == 0:
+        return np.zeros(0, dtype='float32')
+    return np.concatenate(amplitudes)
+
+
+def _template_properties(Wall, ops):
+    """Similarity, amplitudes, waveforms and channel indices of templates."""
+    similar_templates = CCG.similarity(Wall, ops['wPCA'].contiguous(), nt=ops['nt'])
+    template_amplitudes = ((Wall**2).sum(axis=(-2,-1))**0.5).cpu().numpy()
+    templates = (Wall.unsqueeze(-1).cpu() * ops['wPCA'].cpu()).sum(axis=-2).numpy()
+    templates = templates.transpose(0,2,1)
+    templates_ind = np.tile(np.arange(Wall.shape[1])[np.newaxis, :], (templates.shape[0],1))
+    return similar_templates, template_amplitudes, templates, templates_ind
+
+
+def _stream_pc_features(ops, spike_templates, spike_clusters, tF, kept_spikes,
+                        filename):
+    """Write pc features for kept spikes to `filename` without copying tF."""
+    n_spikes, n_chans, n_pcs = tF.shape
+    out = np.lib.format.open_memmap(
+        filename, mode='w+', dtype=np.dtype(str(tF.dtype).split('.')[-1]),
+        shape=(int(kept_spikes.sum()), n_pcs, n_chans)
+        )
+    pc_features, pc_feature_ind = make_pc_features(
+        ops, spike_templates, spike_clusters, tF, kept_spikes=kept_spikes,
+        out=out
+        )
+    pc_features.flush()
+    return pc_features, pc_feature_ind
+
+
+def _save_phy_arrays(results_dir, results):
+    """Save each array in `results` as .npy, and write cluster .tsv files."""
+    for name, x in results.items():
+        if name not in _TSV_VARIABLES:
+            np.save(results_dir / f'{name}.npy', x)
+    _save_cluster_tsv(results_dir, results)
+
+
+def _save_cluster_tsv(results_dir, results):
+    """Write cluster properties in `results` to cluster_*.tsv files."""
+    # write properties to *.tsv
+    stypes = ['ContamPct', 'Amplitude', 'KSLabel']
+    ks_labels = [['mua', 'good'][int(r)] for r in results['is_ref']]
+    props = [results['est_contam_rate']*100, results['template_amplitudes'],
+             ks_labels]
+    for stype, prop in zip(stypes, props):
+        with open((results_dir / f'cluster_{stype}.tsv'), 'w') as f:
+            f.write(f'cluster_id\t{stype}\n')
+            for i,p in enumerate(prop):
+                if stype != 'KSLabel':
+                    f.write(f'{i}\t{p:.1f}\n')
+                else:
+                    f.write(f'{i}\t{p}\n')
+        if stype == 'KSLabel':
+            shutil.copyfile((results_dir / f'cluster_{stype}.tsv'), 
+                            (results_dir / f'cluster_group.tsv'))
+
+
+class SortingContainer:
+    # Magic bytes at the start and end of the file.
+    MAGIC = b'KS4SORT1'
+    FILENAME = 'sorting.ks4'
+    # Column codecs used by `write` unless others are specified.
+    DEFAULT_CODECS = {
+        'spike_times': 'delta', 'spike_clusters': 'zlib',
+        'spike_templates': 'zlib', 'spike_detection_templates': 'zlib',
+        'kept_spikes': 'zlib', 'full_clu': 'zlib'
+        }
+    _ALIGN = 64
+
+    def __init__(self, filename):
+        """Single-file, chunked, columnar storage for sorting results.
+
+        Each column is an array stored as consecutive chunks of rows, either
+        uncompressed ('raw'), compressed with zlib ('zlib'), or delta-encoded
+        and then compressed ('delta', for sorted integer columns like spike
+        times). Raw columns can be memory-mapped, compressed columns are
+        decompressed one chunk at a time when indexed, so loading one column
+        never requires reading the others.
+
+        File layout: `MAGIC`, column data, a JSON header describing each
+        column, the header length as a little-endian uint64, `MAGIC`.
+
+        Parameters
+        ----------
+        filename : str or pathlib.Path
+            Path to a container written by `SortingContainer.write`.
+
+        """
+        self.filename = Path(filename)
+        with open(self.filename, 'rb') as f:
+            if f.read(len(self.MAGIC)) != self.MAGIC:
+                raise ValueError(f'{self.filename} is not a sorting container.')
+            f.seek(-(8 + len(self.MAGIC)), os.SEEK_END)
+            n = int(np.frombuffer(f.read(8), dtype='<u8')[0])
+            if f.read(len(self.MAGIC)) != self.MAGIC:
+                raise ValueError(f'{self.filename} is incomplete or corrupted.')
+            f.seek(-(n + 8 + len(self.MAGIC)), os.SEEK_END)
+            header = json.loads(f.read(n).decode())
+        self.chunk_size = header['chunk_size']
+        self.columns = header['columns']
+
+    def keys(self):
+        return list(self.columns.keys())
+
+    def __contains__(self, name):
+        return name in self.columns
+
+    def __getitem__(self, name):
+        return self.load(name, lazy=True)
+
+    @classmethod
+    def write(cls, filename, columns, codecs=None, chunk_size=2**16,
+              compression_level=6):
+        """Write a dictionary of arrays to a new container.
+
+        Parameters
+        ----------
+        filename : str or pathlib.Path
+            Path of the container file. An existing file is replaced.
+        columns : dict
+            Arrays to store, keyed by column name.
+        codecs : dict; optional.
+            Codec to use for each column, one of 'raw', 'zlib' or 'delta'.
+            Overrides `SortingContainer.DEFAULT_CODECS`, columns not listed in
+            either are stored as 'raw'.
+        chunk_size : int; default=2**16.
+            Number of rows in each chunk.
+        compression_level : int; default=6.
+            Compression level passed to `zlib.compress`.
+
+        """
+        codecs = {**cls.DEFAULT_CODECS, **(codecs or {})}
+        filename = Path(filename)
+        header = {'version': 1, 'chunk_size': chunk_size, 'columns': {}}
+        # Write to a temporary file so that an interrupted write never leaves
+        # a partial container in place of a complete one.
+        tmp = filename.with_name(filename.name + '.tmp')
+        with open(tmp, 'wb') as f:
+            f.write(cls.MAGIC)
+            for name, x in columns.items():
+                if isinstance(x, torch.Tensor):
+                    x = x.cpu().numpy()
+                x = np.asarray(x)
+                if x.ndim == 0:
+                    x = x.reshape(1)
+                codec = codecs.get(name, 'raw')
+                if codec == 'delta' and x.dtype.kind not in 'iu':
+                    raise ValueError(
+                        f'Delta encoding requires an integer column, but '
+                        f'{name} has dtype {x.dtype}.'
+                        )
+                info = {'dtype': x.dtype.str, 'shape': list(x.shape),
+                        'codec': codec}
+
+                if codec == 'raw':
+                    f.write(b'\0' * (-f.tell() % cls._ALIGN))
+                    info['offset'] = f.tell()
+                    for i in range(0, x.shape[0], chunk_size):
+                        f.write(np.ascontiguousarray(x[i:i+chunk_size]).tobytes())
+                elif codec in ['zlib', 'delta']:
+                    chunks = []
+                    for i in range(0, x.shape[0], chunk_size):
+                        c = np.ascontiguousarray(x[i:i+chunk_size])
+                        if codec == 'delta':
+                            c = np.diff(c, axis=0, prepend=np.zeros_like(c[:1]))
+                        b = zlib.compress(c.tobytes(), compression_level)
+                        chunks.append([f.tell(), len(b)])
+                        f.write(b)
+                    info['chunks'] = chunks
+                else:
+                    raise ValueError(f'Unrecognized codec {codec} for {name}.')
+                header['columns'][name] = info
+
+            h = json.dumps(header).encode()
+            f.write(h)
+            f.write(np.array([len(h)], dtype='<u8').tobytes())
+            f.write(cls.MAGIC)
+        os.replace(tmp, filename)
+
+    def load(self, name, lazy=False):
+        """Load column `name`.
+
+        Parameters
+        ----------
+        name : str
+            Column to load.
+        lazy : bool; default=False.
+            If True, raw columns are returned as read-only memmaps and
+            compressed columns as a `LazyColumn` that only decompresses the
+            chunks needed for each indexing operation. Otherwise, the full
+            column is read into memory.
+
+        """
+        if name not in self.columns:
+            raise KeyError(f'{name} is not in {self.filename}.')
+        info = self.columns[name]
+        shape = tuple(info['shape'])
+        dtype = np.dtype(info['dtype'])
+
+        if info['codec'] == 'raw':
+            if np.prod(shape) == 0:
+                return np.zeros(shape, dtype=dtype)
+            x = np.memmap(self.filename, dtype=dtype, mode='r',
+                          offset=info['offset'], shape=shape)
+            return x if lazy else np.array(x)
+        else:
+            x = LazyColumn(self, name)
+            return x if lazy else x[:]
+
+    def read_chunk(self, name, ichunk):
+        """Decompress and decode one chunk of a compressed column."""
+        info = self.columns[name]
+        dtype = np.dtype(info['dtype'])
+        offset, nbytes = info['chunks'][ichunk]
+        with open(self.filename, 'rb') as f:
+            f.seek(offset)
+            b = zlib.decompress(f.read(nbytes))
+        c = np.frombuffer(b, dtype=dtype).reshape(-1, *info['shape'][1:])
+        if info['codec'] == 'delta':
+            c = np.cumsum(c, axis=0, dtype=dtype)
+        return c
+
+
+class LazyColumn:
+    def __init__(self, container, name, n_cached=4):
+        """Array-like view of a compressed `SortingContainer` column.
+
+        Indexing along the first axis (with an int, slice, integer array or
+        boolean mask) only decompresses the chunks containing the requested
+        rows. The most recently used chunks are kept in memory.
+
+        """
+        self.container = container
+        self.name = name
+        info = container.columns[name]
+        self.shape = tuple(info['shape'])
+        self.dtype = np.dtype(info['dtype'])
+        self.ndim = len(self.shape)
+        self.chunk_size = container.chunk_size
+        self.n_cached = n_cached
+        self._cache = OrderedDict()
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        x = self[:]
+        return x if dtype is None else x.astype(dtype)
+
+    def _chunk(self, ichunk):
+        if ichunk in self._cache:
+            self._cache.move_to_end(ichunk)
+        else:
+            self._cache[ichunk] = self.container.read_chunk(self.name, ichunk)
+            if len(self._cache) > self.n_cached:
+                self._cache.popitem(last=False)
+        return self._cache[ichunk]
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            rows, rest = key[0], key[1:]
+        else:
+            rows, rest = key, ()
+
+        n = self.shape[0]
+        if isinstance(rows, slice):
+            idx = np.arange(*rows.indices(n))
+        elif isinstance(rows, (int, np.integer)):
+            if not -n <= rows < n:
+                raise IndexError(f'Index {rows} out of range for {n} rows.')
+            idx = np.array(rows % n)
+        else:
+            idx = np.arange(n)[rows]
+        scalar = idx.ndim == 0
+        idx = np.atleast_1d(idx)
+
+        out = np.empty((idx.size, *self.shape[1:]), dtype=self.dtype)
+        ichunk = idx // self.chunk_size
+        for c in np.unique(ichunk):
+            m = ichunk == c
+            out[m] = self._chunk(int(c))[idx[m] - c*self.chunk_size]
+        if scalar:
+            out = out[0]
+
+        return out[rest] if len(rest) > 0 else out
+
+
+def load_result(results_dir, name, lazy=False):
+    """Load one saved result variable, from the container or a .npy file.
+
+    Parameters
+    ----------
+    results_dir : str or pathlib.Path
+        Directory where results were saved.
+    name : str
+        Variable to load, like 'spike_times' or 'pc_features'. This is the
+        name of the corresponding Phy file without '.npy'.
+    lazy : bool; default=False.
+        If True, return a memmap or `LazyColumn` instead of reading the full
+        array into memory.
+
+    Notes
+    -----
+    If both the container and `<name>.npy` exist, the .npy file is used
+    unless it is older than the container. Phy only rewrites .npy files
+    (like 'spike_clusters.npy') when curation is saved, so this returns the
+    curated results for `results_format='both'`.
+
+    """
+    path = result_source(results_dir, name)
+    if path.name == SortingContainer.FILENAME:
+        return SortingContainer(path).load(name, lazy=lazy)
+    return np.load(path, mmap_mode='r' if lazy else None)
+
+
+def result_source(results_dir, name):
+    """Path of the file that `load_result` reads `name` from.
+
+    This is either the sorting container or `<name>.npy`, see `load_result`.
+
+    """
+    results_dir = Path(results_dir)
+    path = results_dir / SortingContainer.FILENAME
+    npy_path = results_dir / f'{name}.npy'
+    if path.exists():
+        stale = npy_path.exists() \
+            and npy_path.stat().st_mtime_ns >= path.stat().st_mtime_ns
+        if not stale and name in SortingContainer(path):
+            return path
+    return npy_path
+
+
+def cluster_spike_index(spike_clusters, n_clusters=None):
+    """Build a per-cluster index into `spike_clusters`, in CSR format.
+
+    Parameters
+    ----------
+    spike_clusters : np.ndarray
+        1D vector of cluster ids for each spike.
+    n_clusters : int; optional.
+        Number of clusters. By default, this is `spike_clusters.max() + 1`.
+
+    Returns
+    -------
+    order : np.ndarray
+        Spike indices sorted by cluster id, with shape (n_spikes,). Within
+        each cluster, indices are in ascending order (and so in order of
+        increasing spike time).
+    offsets : np.ndarray
+        Offsets into `order` with shape (n_clusters + 1,), such that the
+        spikes assigned to cluster `i` are `order[offsets[i]:offsets[i+1]]`.
+
+    """
+    spike_clusters = np.asarray(spike_clusters)
+    if n_clusters is None:
+        n_clusters = int(spike_clusters.max()) + 1 if spike_clusters.size else 0
+    order = np.argsort(spike_clusters, kind='stable').astype('int64')
+    counts = np.bincount(spike_clusters, minlength=n_clusters)
+    offsets = np.zeros(counts.size + 1, dtype='int64')
+    np.cumsum(counts, out=offsets[1:])
+
+    return order, offsets
+
+
+def _spike_clusters_fingerprint(results_dir):
+    stat = (Path(results_dir) / 'spike_clusters.npy').stat()
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def save_cluster_index(results_dir, order=None, offsets=None):
+    """Save a per-cluster spike index for `spike_clusters.npy` in `results_dir`.
+
+    The index is saved as `cluster_spike_order.npy` and
+    `cluster_spike_offsets.npy` (see `cluster_spike_index`), along with
+    the size and modification time of `spike_clusters.npy` in
+    `cluster_spike_index.json`. If `spike_clusters.npy` changes afterwards,
+    for example when Phy saves curated clusters, the index is no longer used.
+    If `order` and `offsets` are not specified, they must already be saved and
+    only the json file is written.
+
+    """
+    results_dir = Path(results_dir)
+    if order is not None and offsets is not None:
+        np.save(results_dir / 'cluster_spike_order.npy', order)
+        np.save(results_dir / 'cluster_spike_offsets.npy', offsets)
+    with open(results_dir / 'cluster_spike_index.json', 'w') as f:
+        json.dump(_spike_clusters_fingerprint(results_dir), f)
+
+
+def load_cluster_index(results_dir, mmap_mode='r'):
+    """Load the per-cluster spike index saved by `save_cluster_index`.
+
+    Returns
+    -------
+    order, offsets : np.ndarray or None
+        As returned by `cluster_spike_index`. Both are None if no index was
+        saved, or if `spike_clusters.npy` has changed since it was saved.
+
+    """
+    results_dir = Path(results_dir)
+    paths = [results_dir / f for f in [
+        'cluster_spike_order.npy', 'cluster_spike_offsets.npy',
+        'cluster_spike_index.json', 'spike_clusters.npy'
+        ]]
+    if not all([p.exists() for p in paths]):
+        return None, None
+    with open(paths[2]) as f:
+        saved = json.load(f)
+    if saved != _spike_clusters_fingerprint(results_dir):
+        logger.debug('spike_clusters.npy changed, not using cluster index.')
+        return None, None
+
+    return np.load(paths[0], mmap_mode=mmap_mode), np.load(paths[1])
+
+
+def load_cluster_spike_idx(results_dir, cluster_id, mmap_mode='r'):
+    """Get indices of all spikes assigned to `cluster_id`.
+
+    Uses the index saved by `save_cluster_index` if it exists and is still
+    current, so that only the spikes for this cluster are read. Otherwise,
+    `spike_clusters` is scanned.
+
+    Parameters
+    ----------
+    results_dir : str or pathlib.Path
+        Directory where results were saved.
+    cluster_id : int
+        Cluster id to look up.
+    mmap_mode : str; default='r'.
+        Passed to `np.load`. Use None to read files into memory.
+
+    Returns
+    -------
+    spike_idx : np.ndarray
+        Indices into `spike_times.npy` (and other per-spike arrays) for spikes
+        assigned to `cluster_id`, in ascending order.
+
+    """
+    results_dir = Path(results_dir)
+    order, offsets = load_cluster_index(results_dir, mmap_mode=mmap_mode)
+    if order is not None:
+        if cluster_id < 0 or cluster_id + 1 >= offsets.size:
+            return np.zeros(0, dtype='int64')
+        return np.array(order[offsets[cluster_id]:offsets[cluster_id+1]])
+
+    spike_clusters = load_result(
+        results_dir, 'spike_clusters', lazy=mmap_mode is not None
+        )
+    return (np.asarray(spike_clusters) == cluster_id).nonzero()[0]
+
+
+def container_to_phy(results_dir):
+    """Generate Phy .npy and .tsv files from `sorting.ks4` in `results_dir`."""
+    results_dir = Path(results_dir)
+    sorting = SortingContainer(results_dir / SortingContainer.FILENAME)
+    # Write one column at a time to avoid loading all of them into memory.
+    for name in sorting.keys():
+        if name not in _TSV_VARIABLES:
+            x = sorting.load(name, lazy=True)
+            np.save(results_dir / f'{name}.npy', np.asarray(x))
+            del x
+    if 'cluster_spike_order' in sorting:
+        save_cluster_index(results_dir)
+    _save_phy_arrays(
+        results_dir, {k: sorting.load(k) for k in _TSV_VARIABLES}
+        )
+
+
+# Top-level `ops` keys needed by `bfile_from_ops`.
+_BFILE_OPS_KEYS = [
+    'filename', 'n_chan_bin', 'fs', 'batch_size', 'nt', 'nt0min', 'probe',
+    'fwav', 'Wrot', 'dshift', 'do_CAR', 'artifact_threshold', 'invert_sign',
+    'data_dtype', 'tmin', 'tmax', 'shift', 'scale', 'settings'
+    ]
+
+
+def save_ops(ops, results_dir=None, legacy=True):
+    """Save intermediate `ops` dictionary to `results_dir/ops`.
+
+    Scalars, strings, lists and nested dictionaries are saved to a JSON header,
+    `ops/ops.json`, and each array or tensor is saved to its own .npy file in
+    the same directory so that it can be loaded separately.
+    If `legacy` is True (default), the full dictionary is also pickled to
+    `results_dir/ops.npy` as in previous versions of Kilosort4, for code that
+    loads it with `np.load` directly.
+
+    """
 
     if results_dir is None:
         results_dir = Path(ops['data_dir']) / 'kilosort4'
@@ -534,9 +1152,29 @@ def save_ops(ops, results_dir=None):
     ops['settings']['filename'] = str(ops['settings']['filename'])
     ops['settings']['data_dir'] = str(ops['settings']['data_dir'])
 
+    ops_dir = results_dir / 'ops'
+    ops_dir.mkdir(exist_ok=True)
+    # Remove the header first, so that an interrupted save is never mistaken
+    # for a complete one, then any arrays from a previous save.
+    (ops_dir / 'ops.json').unlink(missing_ok=True)
+    for f in ops_dir.glob('*.npy'):
+        f.unlink()
+    # Tensors are saved as numpy arrays and flagged in the header, otherwise
+    # loading ops on a different system may not work (if saved from GPU, but
+    # loaded on a system with only CPU).
+    header = {'version': 1, 'ops': _encode_ops_value(ops, ops_dir, '')}
+    with open(ops_dir / 'ops.json', 'w') as f:
+        json.dump(header, f, indent=1)
+
+    if legacy:
+        _save_legacy_ops(ops, results_dir)
+
+
+def _save_legacy_ops(ops, results_dir):
     # Convert pytorch tensors to numpy arrays before saving, otherwise loading
     # ops on a different system may not work (if saved from GPU, but loaded
     # on a system with only CPU).
+    ops = ops.copy()
     ops['is_tensor'] = []
     for k, v in ops.items():
         if isinstance(v, torch.Tensor):
@@ -548,22 +1186,122 @@ def save_ops(ops, results_dir=None):
     np.save(results_dir / 'ops.npy', np.array(ops))
 
 
-def load_ops(ops_path, device=None):
-    """Load a saved `ops` dictionary and convert some arrays to tensors."""
+def _encode_ops_value(v, ops_dir, name):
+    """Convert `v` to something JSON-serializable, saving arrays to `ops_dir`."""
+    if isinstance(v, torch.Tensor) or \
+            (isinstance(v, np.ndarray) and v.dtype != object):
+        is_tensor = isinstance(v, torch.Tensor)
+        x = v.cpu().numpy() if is_tensor else v
+        filename = f'{name}.npy'
+        np.save(ops_dir / filename, x)
+        return {'__array__': filename, 'tensor': is_tensor}
+    elif isinstance(v, dict) and all([isinstance(k, str) for k in v]):
+        prefix = f'{name}.' if name else ''
+        d = {k: _encode_ops_value(x, ops_dir, f'{prefix}{k}')
+             for k, x in v.items()}
+        return {'__dict__': d}
+    elif isinstance(v, (list, tuple)):
+        items = [_encode_ops_value(x, ops_dir, f'{name}.{i}')
+                 for i, x in enumerate(v)]
+        return {'__tuple__': items} if isinstance(v, tuple) else items
+    elif isinstance(v, np.generic) and v.dtype != object:
+        return v.item()
+    elif v is None or isinstance(v, (bool, int, float, str)):
+        return v
+    elif isinstance(v, Path):
+        return str(v)
+    else:
+        # Anything else, like a numpy dtype, is pickled.
+        return {'__pickle__': base64.b64encode(pickle.dumps(v)).decode()}
+
+
+def _decode_ops_value(v, ops_dir, device):
+    """Inverse of `_encode_ops_value`."""
+    if isinstance(v, list):
+        return [_decode_ops_value(x, ops_dir, device) for x in v]
+    elif isinstance(v, dict):
+        if '__dict__' in v:
+            return {k: _decode_ops_value(x, ops_dir, device)
+                    for k, x in v['__dict__'].items()}
+        elif '__tuple__' in v:
+            return tuple([_decode_ops_value(x, ops_dir, device)
+                          for x in v['__tuple__']])
+        elif '__array__' in v:
+            # Read into memory rather than memory-mapping, since mapped files
+            # can't be replaced by a later `save_ops` on Windows.
+            x = np.load(ops_dir / v['__array__'])
+            if v['tensor']:
+                x = torch.from_numpy(x).to(device)
+            return x
+        elif '__pickle__' in v:
+            return pickle.loads(base64.b64decode(v['__pickle__']))
+    return v
+
+
+def _find_ops_dir(ops_path):
+    """Get the structured ops directory for `ops_path`, or None if legacy."""
+    ops_path = Path(ops_path)
+    if ops_path.name == 'ops.json':
+        candidates = [ops_path.parent]
+    elif ops_path.suffix == '.npy':
+        candidates = [ops_path.parent / 'ops']
+    else:
+        candidates = [ops_path, ops_path / 'ops']
+    for d in candidates:
+        if (d / 'ops.json').is_file():
+            return d
+    return None
+
+
+def load_ops(ops_path, device=None, keys=None):
+    """Load a saved `ops` dictionary and convert some arrays to tensors.
+
+    Parameters
+    ----------
+    ops_path : str or pathlib.Path
+        Path to the results directory, the `ops` directory saved by `save_ops`,
+        or `ops.npy`. If `ops.npy` is given but structured ops were saved in
+        the same directory, the structured format is loaded instead.
+    device : torch.device; optional.
+        Device for loaded tensors. Defaults to the first GPU if one is
+        available, otherwise CPU.
+    keys : list of str; optional.
+        Only load these top-level keys. For structured ops, arrays for other
+        keys are never read from disk.
+
+    """
     if device is None:
         if torch.cuda.is_available():
             device = torch.device('cuda')
         else:
             device = torch.device('cpu')
 
+    ops_dir = _find_ops_dir(ops_path)
+    if ops_dir is not None:
+        with open(ops_dir / 'ops.json') as f:
+            header = json.load(f)
+        items = header['ops']['__dict__']
+        if keys is not None:
+            items = {k: v for k, v in items.items() if k in keys}
+        return {k: _decode_ops_value(v, ops_dir, device)
+                for k, v in items.items()}
+
+    ops_path = Path(ops_path)
+    if ops_path.is_dir():
+        ops_path = ops_path / 'ops.npy'
     ops = np.load(ops_path, allow_pickle=True).item()
+    if keys is not None:
+        is_tensor = ops['is_tensor']
+        ops = {k: v for k, v in ops.items() if k in keys}
+        ops['is_tensor'] = is_tensor
     for k, v in ops.items():
         if k in ops['is_tensor']:
             ops[k] = torch.from_numpy(v).to(device)
     # TODO: Why do we have one copy of this saved as numpy, one as tensor,
     #       at different levels?
-    ops['preprocessing'] = {k: torch.from_numpy(v).to(device)
-                            for k,v in ops['preprocessing'].items()}
+    if 'preprocessing' in ops:
+        ops['preprocessing'] = {k: torch.from_numpy(v).to(device)
+                                for k,v in ops['preprocessing'].items()}
 
     return ops
 
@@ -577,7 +1315,7 @@ def bfile_from_ops(ops=None, ops_path=None, filename=None, device=None):
 
     if ops is None:
         if ops_path is not None:
-            ops = load_ops(ops_path, device=device)
+            ops = load_ops(ops_path, device=device, keys=_BFILE_OPS_KEYS)
         else:
             raise ValueError('Must specify either `ops` or `ops_path`.')
     
@@ -592,7 +1330,11 @@ def bfile_from_ops(ops=None, ops_path=None, filename=None, device=None):
         hp_filter=ops['fwav'], whiten_mat=ops['Wrot'], dshift=ops['dshift'],
         device=device, do_CAR=ops['do_CAR'], artifact_threshold=ops['artifact_threshold'],
         invert_sign=ops['invert_sign'], dtype=ops['data_dtype'], tmin=ops['tmin'],
-        tmax=ops['tmax'], shift=ops['shift'], scale=ops['scale']
+        tmax=ops['tmax'], shift=ops['shift'], scale=ops['scale'],
+        car_mode=ops.get('settings', {}).get('car_mode', 'median'),
+        channel_groups=ops['probe'].get('kcoords'),
+        sparse_ops=ops.get('settings', {}).get('sparse_preprocessing', False),
+        use_compile=ops.get('settings', {}).get('torch_compile', False)
         )
 
     return bfile
@@ -606,7 +1348,8 @@ class BinaryRWFile:
                  NT: int = 60000, nt: int = 61, nt0min: int = 20,
                  device: torch.device = None, write: bool = False,
                  dtype: str = None, tmin: float = 0.0, tmax: float = np.inf,
-                 shift=None, scale=None, file_object=None):
+                 shift=None, scale=None, file_object=None, prefetch: int = 0,
+                 sequential: bool = False, write_buffer: int = 0):
         """
         Creates/Opens a BinaryFile for reading and/or writing data that acts like numpy array
 
@@ -617,7 +1360,8 @@ class BinaryRWFile:
         Parameters
         ----------
         filename : Path-like or list of Path-likes.
-            The filename of the file(s) to read from or write to
+            The filename of the file(s) to read from or write to. Compressed
+            mtscomp (.cbin) files are opened with `MtscompRecording`.
         n_chan_bin : int
             number of channels
         file_object : array-like file object; optional.
@@ -625,6 +1369,22 @@ class BinaryRWFile:
             indexing (e.g. [:100,:], [5, 7:10], etc). For example, a numpy
             array or memmap.
             Note: `filename` is effectively ignored if `file_object` is not None.
+        prefetch : int; default=0.
+            Number of upcoming padded batches to read in background threads
+            while the current batch is being processed. See `BatchPrefetcher`.
+            If 0, batches are read synchronously.
+        sequential : bool; default=False.
+            If True, read batches with explicit reads and readahead hints
+            instead of memmap page faults, and drop pages behind the current
+            batch from the page cache. See `SequentialReader`. Only used for
+            read-only access to a single binary file on platforms that support
+            `posix_fadvise`.
+        write_buffer : int; default=0.
+            If greater than 0 and `write=True`, assignments are staged in
+            buffers of this many bytes and written with large contiguous writes
+            on a background thread, instead of writing and flushing a memmap
+            for every assignment. Staged data is written by `flush` or `close`.
+            See `BufferedWriter`.
 
         """
         # Extra casting statements to ensure that 64-bit values are used
@@ -649,7 +1409,10 @@ class BinaryRWFile:
         self.uint_set_warning = True
         self.writable = write
         self.mode = 'w+' if write else 'r'
+        self._memmap = None
 
+        if file_object is None and not write and not isinstance(filename, list):
+            file_object = open_compressed_recording(filename)
         if file_object is not None:
             dtype = file_object.dtype
         if dtype is None:
@@ -692,6 +1455,35 @@ class BinaryRWFile:
             self.n_batches -= 1
             self.imax -= batch_size
 
+        if isinstance(file_object, ChunkedRecording):
+            file_object.set_batch_size(self.NT + 2*self.nt)
+
+        self.prefetcher = None
+        if prefetch > 0:
+            self.prefetcher = BatchPrefetcher(self, n_prefetch=prefetch)
+
+        self.writer = None
+        if write and write_buffer > 0 and file_object is None:
+            f = filename[0] if isinstance(filename, list) else filename
+            self.writer = BufferedWriter(f, n_chan_bin, dtype,
+                                         self.total_samples,
+                                         buffer_size=write_buffer)
+            # File was already created by the writer, memmap shouldn't
+            # truncate it again.
+            self.mode = 'r+'
+
+        self.sequential_reader = None
+        if sequential:
+            if write or file_object is not None:
+                logger.info('Sequential reads are only used for read-only '
+                            'binary files, using memmap instead.')
+            elif not SequentialReader.is_supported():
+                logger.info('Sequential reads are not supported on this '
+                            'platform, using memmap instead.')
+            else:
+                f = filename[0] if isinstance(filename, list) else filename
+                self.sequential_reader = SequentialReader(f, n_chan_bin, dtype)
+
 
     @property
     def n_samples(self) -> int:
@@ -724,20 +1516,53 @@ class BinaryRWFile:
     
     @property
     def file(self):
-        """Get reference to in-memory file object or open a memmap to file."""
+        """Get reference to in-memory file object or memmap to file.
+        
+        The memmap is opened on first access and re-used afterward.
+
+        """
         if self.file_object is not None:
             file = self.file_object
         else:
-            f = self.filename
-            if isinstance(f, list):
-                f = f[0]
-            file = np.memmap(f, mode=self.mode, dtype=self.dtype,
-                             shape=(self.total_samples, self.n_chan_bin))
+            if self._memmap is None:
+                f = self.filename
+                if isinstance(f, list):
+                    f = f[0]
+                self._memmap = np.memmap(
+                    f, mode=self.mode, dtype=self.dtype,
+                    shape=(self.total_samples, self.n_chan_bin)
+                    )
+                # Only create or overwrite the file once, after that
+                # re-opening it should keep the existing data.
+                if self.mode == 'w+':
+                    self.mode = 'r+'
+            file = self._memmap
         return file
         
     def __enter__(self):
         return self
 
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Stop background reads, write staged data and close the memmap."""
+        if self.prefetcher is not None:
+            self.prefetcher.close()
+        if self.sequential_reader is not None:
+            self.sequential_reader.close()
+            self.sequential_reader = None
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        if self._memmap is not None:
+            if self.writable:
+                self._memmap.flush()
+            self._memmap = None
+        if isinstance(self.file_object, (BinaryFileGroup, ChunkedRecording,
+                                         RecordingExtractorAsArray)):
+            self.file_object.close()
+
     def __setitem__(self, *items):
         if not self.writable:
             raise ValueError('Binary file was loaded as read-only.')
@@ -759,13 +1584,30 @@ class BinaryRWFile:
         # Convert back from float to file dtype
         data = data.astype(self.dtype)
 
+        if self.writer is not None:
+            try:
+                self.writer[sample_indices] = data
+                return
+            except IndexError:
+                # Not a contiguous range of samples, write through memmap.
+                self.writer.flush()
+
         self.file[sample_indices] = data
         if self.file_object is None:
             self.file.flush()
 
+    def flush(self):
+        """Write any data staged by the buffered writer to the file."""
+        if self.writer is not None:
+            self.writer.flush()
+        elif self._memmap is not None and self.writable:
+            self._memmap.flush()
+
 
     def __getitem__(self, *items):
         idx, *crop = items
+        if self.writer is not None:
+            self.writer.flush()
         # Shift indices by minimum sample index.
         sample_indices = self._get_shifted_indices(idx)
         samples = self.file[sample_indices]
@@ -818,125 +1660,571 @@ class BinaryRWFile:
 
         return bstart, bend
 
-    def padded_batch_to_torch(self, ibatch, return_inds=False):
-        """ read batches from file """
+    def read_padded_batch(self, ibatch, load=False):
+        """Read raw samples for one padded batch, without any conversion.
+
+        Parameters
+        ----------
+        ibatch : int
+            Index of batch to read.
+        load : bool; default=False.
+            If True, force the samples to be read into memory instead of
+            returning a view of a memmap.
+
+        Returns
+        -------
+        data : np.ndarray
+            Samples with shape (n_samples, n_chan_bin), in the file's dtype.
+        bstart, bend : int
+            Sample indices of the first and last (exclusive) samples read.
 
+        """
         bstart, bend = self.get_batch_edges(ibatch)
-        data = self.file[bstart : bend]
-        data = data.T
+        if self.writer is not None:
+            self.writer.flush()
+        if self.sequential_reader is not None:
+            data = self.sequential_reader.read(bstart, bend)
+        else:
+            data = self.file[bstart : bend]
+        if load and isinstance(data, np.memmap):
+            data = np.array(data)
+        return data, bstart, bend
 
-        if self.dtype == 'uint16':
-            # Shift data to +/- 2**15
-            data = data.astype('float32')
-            data = data - 2**15
+    def padded_batch_to_torch(self, ibatch, return_inds=False, chan_map=None,
+                              buffers=None):
+        """ read batches from file
 
-        # Typically only need to be used with float32 data
-        if self.scale is not None:
-            data = data * self.scale
-        if self.shift is not None:
-            data = data + self.shift
+        Parameters
+        ----------
+        ibatch : int
+            Index of batch to read.
+        return_inds : bool; default=False.
+            If True, also return sample indices of the start and end of the
+            batch (including padding).
+        chan_map : np.ndarray; optional.
+            If specified, only these rows of the binary file are decoded, in
+            the given order.
+        buffers : BatchBufferPool; optional.
+            If specified, the batch is decoded into a re-used buffer from
+            the pool instead of a newly allocated tensor. The returned tensor
+            will be overwritten by later calls, so it should not be kept.
+
+        """
+
+        if self.prefetcher is not None:
+            data, bstart, bend = self.prefetcher.get(ibatch)
+        else:
+            data, bstart, bend = self.read_padded_batch(ibatch)
+
+        nsamp = data.shape[0]
+        n_chans = self.n_chan_bin if chan_map is None else len(chan_map)
+        shape = (n_chans, self.NT + 2*self.nt)
+        if buffers is not None:
+            X_host, X = buffers.get(shape)
+        else:
+            X_host = np.empty(shape, dtype='float32')
+            X = None
+
+        i0 = self.nt if ibatch == 0 else 0
+        i1 = i0 + nsamp
+        stage = None
+        if buffers is not None and chan_map is not None:
+            stage = buffers.get_stage(len(chan_map), data.dtype)
+        decode_samples(
+            data, X_host[:, i0:i1], chan_map=chan_map,
+            uint16=(self.dtype == 'uint16'), scale=self.scale, shift=self.shift,
+            stage=stage
+            )
 
-        nsamp = data.shape[-1]
-        X = torch.zeros((self.n_chan_bin, self.NT + 2*self.nt), device=self.device)
+        # fix the data at the edges for the first and last batch
+        if ibatch == 0:
+            X_host[:, :i0] = X_host[:, i0:i0+1]
+            X_host[:, i1:] = 0
+            bstart = self.imin - self.nt
+        elif ibatch == self.n_batches-1:
+            X_host[:, i1:] = X_host[:, i1-1:i1]
+            bend += self.nt
 
         with warnings.catch_warnings():
             # Don't need this, we know about the warning and it doesn't cause
             # any problems. Doing this the "correct" way is much slower.
             warnings.filterwarnings("ignore", message=_torch_warning)
-
-            # fix the data at the edges for the first and last batch
-            if ibatch == 0:
-                X[:, self.nt : self.nt+nsamp] = torch.from_numpy(data).to(self.device).float()
-                X[:, :self.nt] = X[:, self.nt : self.nt+1]
-                bstart = self.imin - self.nt
-            elif ibatch == self.n_batches-1:
-                X[:, :nsamp] = torch.from_numpy(data).to(self.device).float()
-                X[:, nsamp:] = X[:, nsamp-1:nsamp]
-                bend += self.nt
-            else:
-                X[:] = torch.from_numpy(data).to(self.device).float()
+            if X is None:
+                X = torch.from_numpy(X_host).to(self.device)
+            elif X.device != torch.device('cpu'):
+                X.copy_(torch.from_numpy(X_host))
 
         inds = [bstart, bend]
         if return_inds:
             return X, inds
         else:
             return X
-        
 
-def get_total_samples(filename, n_channels, dtype=np.int16):
-    """Count samples in binary file given dtype and number of channels."""
-    if isinstance(filename, list):
-        filename = filename[0]
-    bytes_per_value = np.dtype(dtype).itemsize
-    bytes_per_sample = np.int64(bytes_per_value * n_channels)
-    total_bytes = os.path.getsize(filename)
-    samples = np.float64(total_bytes / bytes_per_sample)
 
-    if samples%1 != 0:
-        raise ValueError(
-            "Bytes in binary file did not divide evenly, "
-            "incorrect n_chan_bin ('number of channels' in GUI)."
-        )
-    else:
-        return np.int64(samples)
+class BatchBufferPool:
+    def __init__(self, device=None, n_buffers=1, block_size=4096):
+        """Re-usable float32 buffers for decoding padded batches.
 
+        Buffers are allocated on first use and re-used as long as the requested
+        shape stays the same, which it does for every batch from a single
+        BinaryRWFile. For GPU devices, each buffer is a pinned host array
+        paired with a device tensor of the same shape.
 
-class BinaryFileGroup:
-    def __init__(self, file_objects=None, filenames=None,
-                 n_channels=None, dtype=None):
-        # NOTE: Assumes list order of files or objects matches temporal order
-        #       for concatenation.
-        self._file_objects = None
-        self._filenames = None
-        self.n_files = 0
+        Parameters
+        ----------
+        device : torch.device; optional.
+            Device for the returned tensors. Defaults to CPU.
+        n_buffers : int; default=1.
+            Number of buffers to rotate through. A tensor returned by `get`
+            stays valid until `get` has been called `n_buffers` more times.
+        block_size : int; default=4096.
+            Number of time samples in the staging array used by
+            `decode_samples` to gather channels.
 
-        if file_objects is not None:
-            self._file_objects = file_objects
-            self.dtype = file_objects[0].dtype
-            self.n_chans = file_objects[0].shape[1]
-            self.n_files = len(file_objects)
-            for f in file_objects[1:]:
-                assert f.dtype == self.dtype, 'All files must have the same dtype'
-                assert f.shape[1] == self.n_chans, \
-                    'All files must have the same number of channels'
-        elif filenames is not None:
-            # Must specify n_channels, dtype
-            if n_channels is None or dtype is None:
-                raise ValueError("BinaryFileGroup requires n_channels and dtype "
-                                 "when using filenames option.")
-            self._filenames = filenames
-            self.dtype = dtype
+        """
+        self.device = torch.device('cpu') if device is None else device
+        self.n_buffers = n_buffers
+        self.block_size = block_size
+        self.stage = None
+        self._shape = None
+        self._buffers = []
+        self._next = 0
+
+    def get(self, shape):
+        """Get `(host_array, tensor)` for the next buffer with `shape`."""
+        if shape != self._shape:
+            self._buffers = []
+            self._shape = shape
+            self._next = 0
+        if len(self._buffers) < self.n_buffers:
+            self._buffers.append(self._allocate(shape))
+            buffer = self._buffers[-1]
+        else:
+            buffer = self._buffers[self._next]
+        self._next = (self._next + 1) % self.n_buffers
+
+        return buffer
+
+    def get_stage(self, n_chans, dtype):
+        """Get staging array for gathering `n_chans` channels of raw data."""
+        if self.stage is None or self.stage.shape[1] != n_chans \
+                or self.stage.dtype != dtype:
+            self.stage = np.empty((self.block_size, n_chans), dtype=dtype)
+        return self.stage
+
+    def _allocate(self, shape):
+        if self.device.type == 'cuda':
+            host = torch.empty(shape, dtype=torch.float32, pin_memory=True)
+            tensor = torch.empty(shape, dtype=torch.float32, device=self.device)
+        else:
+            host = torch.empty(shape, dtype=torch.float32)
+            tensor = host
+        return host.numpy(), tensor
+
+
+def decode_samples(data, out, chan_map=None, uint16=False, scale=None,
+                   shift=None, stage=None, block_size=4096):
+    """Convert raw samples to float32 channels x time, writing to `out`.
+
+    Selecting channels, casting to float32, the uint16 offset, `scale` and
+    `shift` are all applied one block of time samples at a time, so that
+    data is only read from and written to memory once and no temporary
+    copies of the full batch are created.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Raw samples with shape (n_samples, n_chan_bin), as stored in the file.
+    out : np.ndarray
+        float32 array with shape (n_chans, n_samples) to write decoded data to.
+        Typically a view into a pre-allocated batch buffer.
+    chan_map : np.ndarray; optional.
+        Rows of the binary file to keep, in order. Default is all channels.
+    uint16 : bool; default=False.
+        If True, subtract 2**15 to center data at 0.
+    scale, shift : float; optional.
+        If given, data is transformed as `data*scale + shift`.
+    stage : np.ndarray; optional.
+        Array used to gather channels for a block of samples. Allocated as
+        needed if not provided or if the shape or dtype does not match.
+    block_size : int; default=4096.
+        Number of time samples decoded per block.
+
+    """
+    data = np.asarray(data)
+    nsamp = data.shape[0]
+    if stage is not None:
+        block_size = stage.shape[0]
+
+    for t0 in range(0, nsamp, block_size):
+        t1 = min(t0 + block_size, nsamp)
+        block = data[t0:t1]
+        if chan_map is not None:
+            n = t1 - t0
+            if stage is None or stage.dtype != data.dtype \
+                    or stage.shape[1] != len(chan_map):
+                stage = np.empty((block_size, len(chan_map)), dtype=data.dtype)
+            np.take(block, chan_map, axis=1, out=stage[:n])
+            block = stage[:n]
+
+        o = out[:, t0:t1]
+        np.copyto(o, block.T, casting='unsafe')
+        if uint16:
+            # Shift data to +/- 2**15
+            o -= 2**15
+        # Typically only need to be used with float32 data
+        if scale is not None:
+            o *= scale
+        if shift is not None:
+            o += shift
+
+
+class BatchPrefetcher:
+    def __init__(self, bfile, n_prefetch=4, n_workers=None):
+        """Read padded batches for a BinaryRWFile ahead of time in background threads.
+
+        Batch loops request batches in a regular order (every batch, or every
+        `nskip` batches). After each request, reads for the next `n_prefetch`
+        batches at the same stride are submitted to a thread pool, so that
+        disk I/O overlaps with processing of the current batch. If a batch is
+        requested that was not anticipated, pending reads are discarded and the
+        batch is read synchronously.
+
+        Only the raw read is done in the background. Conversion to a tensor,
+        including edge padding for the first and last batch, is still handled
+        by `BinaryRWFile.padded_batch_to_torch`.
+
+        Parameters
+        ----------
+        bfile : BinaryRWFile
+            File to read batches from.
+        n_prefetch : int; default=4.
+            Maximum number of batches to read ahead. This bounds the extra memory
+            used to `n_prefetch` raw batches.
+        n_workers : int; optional.
+            Number of threads used for reading. Defaults to `min(n_prefetch, 4)`.
+
+        Attributes
+        ----------
+        queue_depth : int
+            Number of batches that have finished reading but not been requested.
+        stall_time : float
+            Total time in seconds spent waiting for a background read to finish.
+        n_hits : int
+            Number of requested batches that had already been submitted.
+        n_misses : int
+            Number of requested batches that had to be read synchronously.
+
+        """
+        self.bfile = bfile
+        self.n_prefetch = n_prefetch
+        if n_workers is None:
+            n_workers = min(n_prefetch, 4)
+        self.n_workers = n_workers
+        self._executor = None
+        self._pending = OrderedDict()
+        self._last_batch = None
+        self._stride = 1
+
+        self.stall_time = 0.0
+        self.n_hits = 0
+        self.n_misses = 0
+        self._depth_sum = 0
+
+    @property
+    def queue_depth(self):
+        return sum([f.done() for f in self._pending.values()])
+
+    def get(self, ibatch):
+        """Get `(data, bstart, bend)` for batch `ibatch`, see `read_padded_batch`."""
+        future = self._pending.pop(ibatch, None)
+        if future is None:
+            self.n_misses += 1
+            result = self.bfile.read_padded_batch(ibatch)
+        else:
+            self.n_hits += 1
+            self._depth_sum += self.queue_depth + future.done()
+            tic = time.perf_counter()
+            result = future.result()
+            self.stall_time += time.perf_counter() - tic
+
+        if self._last_batch is not None and ibatch != self._last_batch:
+            self._stride = ibatch - self._last_batch
+        self._last_batch = ibatch
+        self._schedule(ibatch)
+
+        return result
+
+    def _schedule(self, ibatch):
+        expected = [ibatch + k*self._stride for k in range(1, self.n_prefetch+1)]
+        expected = [j for j in expected if 0 <= j < self.bfile.n_batches]
+        # Discard reads that are no longer going to be used.
+        for j in list(self._pending.keys()):
+            if j not in expected:
+                self._pending.pop(j).cancel()
+
+        if len(expected) > 0 and self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.n_workers)
+        for j in expected:
+            if j not in self._pending:
+                self._pending[j] = self._executor.submit(
+                    self.bfile.read_padded_batch, j, load=True
+                    )
+
+    def stats(self):
+        """Summarize prefetching performance as a dictionary."""
+        n_requests = self.n_hits + self.n_misses
+        return {
+            'n_requests': n_requests,
+            'n_hits': self.n_hits,
+            'n_misses': self.n_misses,
+            'stall_time': self.stall_time,
+            'mean_queue_depth': self._depth_sum / max(self.n_hits, 1),
+        }
+
+    def reset(self):
+        """Cancel pending reads and reset counters."""
+        for f in self._pending.values():
+            f.cancel()
+        self._pending.clear()
+        self._last_batch = None
+        self._stride = 1
+        self.stall_time = 0.0
+        self.n_hits = 0
+        self.n_misses = 0
+        self._depth_sum = 0
+
+    def close(self):
+        """Cancel pending reads and shut down the thread pool."""
+        for f in self._pending.values():
+            f.cancel()
+        self._pending.clear()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+
+class SequentialReader:
+    def __init__(self, filename, n_chan_bin, dtype, n_ahead=2,
+                 drop_behind=True):
+        """Read sample ranges from a binary file with explicit reads and hints.
+
+        Instead of relying on memmap page faults, samples are read into new
+        arrays with `os.preadv` (or `os.pread`). After each read, the kernel
+        is asked to start reading the next `n_ahead` ranges at the same stride
+        (`POSIX_FADV_WILLNEED`), and pages before the start of the current
+        range are dropped from the page cache (`POSIX_FADV_DONTNEED`) so that
+        a pass over a large file doesn't evict other processes' data.
+
+        Only available on platforms with `os.pread` and `os.posix_fadvise`,
+        see `SequentialReader.is_supported`.
+
+        Parameters
+        ----------
+        filename : str or pathlib.Path
+            Binary file with shape (n_samples, n_chan_bin).
+        n_chan_bin : int
+            Number of channels in the file.
+        dtype : str or np.dtype
+            Data type of samples in the file.
+        n_ahead : int; default=2.
+            Number of upcoming ranges to request readahead for.
+        drop_behind : bool; default=True.
+            If True, drop pages behind the most recently read range.
+
+        """
+        self.filename = filename
+        self.n_chan_bin = n_chan_bin
+        self.dtype = np.dtype(dtype)
+        self.n_ahead = n_ahead
+        self.drop_behind = drop_behind
+        self.sample_bytes = self.dtype.itemsize * n_chan_bin
+        self._fd = os.open(filename, os.O_RDONLY)
+        self._lock = threading.Lock()
+        self._last_start = None
+        self._dropped = 0
+        os.posix_fadvise(self._fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+    @staticmethod
+    def is_supported():
+        return hasattr(os, 'pread') and hasattr(os, 'posix_fadvise')
+
+    def read(self, start, stop):
+        """Read samples `start` to `stop` (exclusive) into a new array."""
+        data = np.empty((stop - start, self.n_chan_bin), dtype=self.dtype)
+        buffer = memoryview(data).cast('B')
+        offset = start * self.sample_bytes
+        n_read = 0
+        while n_read < buffer.nbytes:
+            if hasattr(os, 'preadv'):
+                n = os.preadv(self._fd, [buffer[n_read:]], offset + n_read)
+            else:
+                b = os.pread(self._fd, buffer.nbytes - n_read, offset + n_read)
+                n = len(b)
+                buffer[n_read : n_read+n] = b
+            if n == 0:
+                raise EOFError(
+                    f'Tried to read past the end of {self.filename}.'
+                    )
+            n_read += n
+
+        self._advise(start, stop)
+        return data
+
+    def _advise(self, start, stop):
+        with self._lock:
+            if self._last_start is not None and start > self._last_start:
+                stride = start - self._last_start
+            else:
+                stride = stop - start
+            self._last_start = start
+
+            length = (stop - start) * self.sample_bytes
+            for k in range(1, self.n_ahead+1):
+                ahead = (start + k*stride) * self.sample_bytes
+                os.posix_fadvise(self._fd, ahead, length,
+                                 os.POSIX_FADV_WILLNEED)
+
+            behind = start * self.sample_bytes
+            if self.drop_behind and behind > self._dropped:
+                os.posix_fadvise(self._fd, self._dropped,
+                                 behind - self._dropped,
+                                 os.POSIX_FADV_DONTNEED)
+                self._dropped = behind
+            elif behind < self._dropped:
+                # Started a new pass over the file.
+                self._dropped = behind
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+def get_total_samples(filename, n_channels, dtype=np.int16):
+    """Count samples in binary file given dtype and number of channels."""
+    if isinstance(filename, list):
+        filename = filename[0]
+    bytes_per_value = np.dtype(dtype).itemsize
+    bytes_per_sample = np.int64(bytes_per_value * n_channels)
+    total_bytes = os.path.getsize(filename)
+    samples = np.float64(total_bytes / bytes_per_sample)
+
+    if samples%1 != 0:
+        raise ValueError(
+            "Bytes in binary file did not divide evenly, "
+            "incorrect n_chan_bin ('number of channels' in GUI)."
+        )
+    else:
+        return np.int64(samples)
+
+
+class MemmapPool:
+    def __init__(self, max_open=64):
+        """Cache of open memmaps with least-recently-used eviction.
+
+        Parameters
+        ----------
+        max_open : int; default=64.
+            Maximum number of memmaps to keep open at once. Each open memmap
+            holds a file descriptor.
+
+        """
+        self.max_open = max_open
+        self._handles = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._handles)
+
+    def get(self, filename, dtype, shape, mode='r'):
+        """Get an open memmap for `filename`, opening it if needed."""
+        key = (str(filename), mode, np.dtype(dtype).str, tuple(shape))
+        with self._lock:
+            if key in self._handles:
+                self._handles.move_to_end(key)
+                return self._handles[key]
+
+            memmap = np.memmap(filename, mode=mode, dtype=dtype, shape=shape)
+            self._handles[key] = memmap
+            while len(self._handles) > self.max_open:
+                # Arrays that still reference an evicted memmap stay valid,
+                # the pool just stops holding on to it.
+                _, old = self._handles.popitem(last=False)
+                if old.mode != 'r':
+                    old.flush()
+            return memmap
+
+    def clear(self):
+        """Drop references to all open memmaps."""
+        with self._lock:
+            for m in self._handles.values():
+                if m.mode != 'r':
+                    m.flush()
+            self._handles.clear()
+
+
+class BinaryFileGroup:
+    def __init__(self, file_objects=None, filenames=None,
+                 n_channels=None, dtype=None, max_open_files=64):
+        # NOTE: Assumes list order of files or objects matches temporal order
+        #       for concatenation.
+        self._file_objects = None
+        self._filenames = None
+        self._pool = MemmapPool(max_open=max_open_files)
+        self.n_files = 0
+
+        if file_objects is not None:
+            self._file_objects = file_objects
+            self.dtype = file_objects[0].dtype
+            self.n_chans = file_objects[0].shape[1]
+            self.n_files = len(file_objects)
+            for f in file_objects[1:]:
+                assert f.dtype == self.dtype, 'All files must have the same dtype'
+                assert f.shape[1] == self.n_chans, \
+                    'All files must have the same number of channels'
+        elif filenames is not None:
+            # Must specify n_channels, dtype
+            if n_channels is None or dtype is None:
+                raise ValueError("BinaryFileGroup requires n_channels and dtype "
+                                 "when using filenames option.")
+            self._filenames = filenames
+            self.dtype = dtype
             self.n_chans = n_channels
             self.n_files = len(filenames)
         else:
             raise ValueError("Must specify either file_objects or filenames")
 
+        # Sizes are only looked up once, files are not expected to change
+        # while they're being sorted.
+        self._file_sizes = []
+        for j in range(self.n_files):
+            if self._file_objects is not None:
+                size = self._file_objects[j].shape[0]
+            else:
+                size = get_total_samples(self._filenames[j], self.n_chans,
+                                         self.dtype)
+            self._file_sizes.append(size)
+
         # Track indices that represent boundary between files. Each entry
         # is the starting index of the subsequent file.
-        i = 0
-        self.split_indices = []
-        for j in range(self.n_files):
-            i += self.get_file_size(j)
-            self.split_indices.append(i)
+        self.split_indices = np.cumsum(self._file_sizes).tolist()
 
     def get_file(self, i):
         if self._file_objects is not None:
             file = self._file_objects[i]
         else:
-            name = self._filenames[i]
-            n_samples = get_total_samples(name, self.n_chans, self.dtype)
-            file = np.memmap(name, mode='r', dtype=self.dtype,
-                                shape=(n_samples, self.n_chans))
+            file = self._pool.get(self._filenames[i], self.dtype,
+                                  (self._file_sizes[i], self.n_chans))
 
         return file
     
     def get_file_size(self, i):
-        if self._file_objects is not None:
-            size = self._file_objects[i].shape[0]
-        else:
-            size = get_total_samples(self._filenames[i], self.n_chans, self.dtype)
+        return self._file_sizes[i]
 
-        return size
+    def close(self):
+        """Close any memmaps opened by the group."""
+        self._pool.clear()
 
     def __getitem__(self, *items):
         # Index into appropriate individual object based on index.
@@ -960,25 +2248,26 @@ class BinaryFileGroup:
         if j < 0: j = self.shape[0] + j
         time_idx = slice(i, j)
 
+        # Only visit files that overlap the requested range, starting with
+        # the first file that ends after the start index.
+        first = bisect.bisect_right(self.split_indices, time_idx.start)
         data = []
-        shift = 0
-        for idx, k in enumerate(self.split_indices):
+        for idx in range(first, self.n_files):
+            k = self.split_indices[idx]
+            shift = k - self._file_sizes[idx]
             f = self.get_file(idx)
-            n_samples = f.shape[0]
-            if time_idx.start < k:
-                # At least part of the data is in this file
-                ii = max(int(time_idx.start - shift), 0)
-                jj = max(int(time_idx.stop - shift), 0)
-                t = slice(ii, jj)
-                data.append(f[t, channel_idx])
-                if time_idx.stop <= k:
-                    # This is the end of the data to be retrieved
-                    break
-            shift += n_samples
+            ii = max(int(time_idx.start - shift), 0)
+            jj = max(int(time_idx.stop - shift), 0)
+            data.append(f[ii:jj, channel_idx])
+            if time_idx.stop <= k:
+                # This is the end of the data to be retrieved
+                break
 
         if len(data) == 0:
             d = None
         elif len(data) == 1:
+            # Range is contained in a single file, return the view directly
+            # instead of copying.
             d = data[0]
         else:
             d = np.concatenate(data, axis=0)
@@ -1005,57 +2294,155 @@ class BinaryFiltered(BinaryRWFile):
                  device: torch.device = None, do_CAR: bool = True,
                  artifact_threshold: float = np.inf, invert_sign: bool = False,
                  dtype=None, tmin: float = 0.0, tmax: float = np.inf,
-                 shift=None, scale=None, file_object=None):
+                 shift=None, scale=None, file_object=None, prefetch: int = 0,
+                 cache=None, sequential: bool = False,
+                 filter_mode: str = 'fft', car_mode: str = 'median',
+                 channel_groups: np.ndarray = None, sparse_ops: bool = False,
+                 use_compile: bool = False):
 
         super().__init__(filename, n_chan_bin, fs, NT, nt, nt0min, device,
                          dtype=dtype, tmin=tmin, tmax=tmax, shift=shift,
-                         scale=scale, file_object=file_object) 
+                         scale=scale, file_object=file_object,
+                         prefetch=prefetch, sequential=sequential)
+        self.cache = cache
         self.chan_map = chan_map
         self.whiten_mat = whiten_mat
         self.hp_filter = hp_filter
         self.dshift = dshift
+        # Optional `DriftMatrixCache`, otherwise drift matrices are computed
+        # for each batch.
+        self.drift_matrices = None
+        # If True, whitening and drift matrices are applied as
+        # `SparseOperator`s, skipping entries that are zero.
+        self.sparse_ops = sparse_ops
+        self._whiten_op = None
         self.do_CAR = do_CAR
+        # Reference subtracted when do_CAR is True. `channel_groups` is the
+        # shank index of each channel after applying `chan_map`.
+        self.car_mode = car_mode
+        self.channel_groups = channel_groups
+        self.reference = CommonReference(car_mode, channel_groups)
         self.invert_sign=invert_sign
         self.artifact_threshold = artifact_threshold
+        # Elementwise preprocessing steps, fused with `torch.compile` if
+        # `use_compile` is True.
+        self.use_compile = use_compile
+        self._center_channels = compiled(center_channels, use_compile)
+        self._exceeds_threshold = compiled(exceeds_threshold, use_compile)
+        # 'fft' filters each batch over its full length (with wrap-around),
+        # 'overlap_save' filters in fast-length blocks with zero-padded edges,
+        # which is faster for arbitrary window sizes like GUI views.
+        if filter_mode not in ['fft', 'overlap_save']:
+            raise ValueError(
+                f"filter_mode must be 'fft' or 'overlap_save', got {filter_mode}."
+                )
+        self.filter_mode = filter_mode
+        self._filter_engine = None
+        # Raw batches are only used as input to `filter`, which always
+        # returns a new tensor, so one buffer can be re-used for every batch.
+        # Each thread gets its own pool, so batches can be loaded in parallel.
+        self._local = threading.local()
+
+    @property
+    def buffers(self):
+        if not hasattr(self._local, 'buffers'):
+            self._local.buffers = BatchBufferPool(device=self.device)
+        return self._local.buffers
+
+    @property
+    def filter_engine(self):
+        # Rebuilt if `hp_filter` is replaced, so that cached spectra always
+        # match the current filter.
+        if self.hp_filter is None:
+            return None
+        if (self._filter_engine is None
+                or self._filter_engine.hp_filter is not self.hp_filter):
+            self._filter_engine = FFTFilter(self.hp_filter)
+        return self._filter_engine
+
+    def close(self):
+        super().close()
+        if self.cache is not None:
+            self.cache.close()
 
     def filter(self, X, ops=None, ibatch=None, skip_preproc=False):
         # pick only the channels specified in the chanMap
         if self.chan_map is not None:
             X = X[self.chan_map]
+        return self._filter_channels(X, ops, ibatch, skip_preproc=skip_preproc)
 
-        if self.invert_sign:
-            X = X * -1
-
-        X = X - X.mean(1).unsqueeze(1)
+    def _filter_channels(self, X, ops=None, ibatch=None, skip_preproc=False,
+                         skip_whitening=False):
+        """Same as `filter`, but assumes `chan_map` was already applied."""
+        X = self._center_channels(X, self.invert_sign)
         if self.do_CAR:
-            # remove the mean of each channel, and the median across channels
-            X = X - torch.median(X, 0)[0]
+            # remove the mean of each channel, and the median (or mean) across
+            # channels, optionally for each shank separately
+            X = self.reference(X)
     
         if skip_preproc:
             return X
 
         # high-pass filtering in the Fourier domain (much faster than filtfilt etc)
         if self.hp_filter is not None:
-            fwav = fft_highpass(self.hp_filter, NT=X.shape[1])
-            X = torch.real(ifft(fft(X) * torch.conj(fwav)))
-            X = fftshift(X, dim = -1)
+            if self.filter_mode == 'overlap_save':
+                X = self.filter_engine.overlap_save(X)
+            else:
+                X = self.filter_engine.filter(X)
 
         if self.artifact_threshold < np.inf:
-            if torch.any(torch.abs(X) >= self.artifact_threshold):
+            if self._exceeds_threshold(X, self.artifact_threshold):
                 # Assume the batch contains a recording artifact.
                 # Skip subsequent preprocessing, zero-out the batch.
                 return torch.zeros_like(X)
 
+        if skip_whitening:
+            return X
+
         # whitening, with optional drift correction
         if self.whiten_mat is not None:
             if self.dshift is not None and ops is not None and ibatch is not None:
-                M = get_drift_matrix(ops, self.dshift[ibatch], device=self.device)
-                #logger.info(M.dtype, X.dtype, self.whiten_mat.dtype)
-                X = (M @ self.whiten_mat) @ X
+                X = self.drift_matrix(ops, ibatch, whiten=True) @ X
             else:
-                X = self.whiten_mat @ X
+                X = self.whiten_op @ X
         return X
 
+    @property
+    def whiten_op(self):
+        """`whiten_mat`, as a `SparseOperator` if `sparse_ops` is True."""
+        if not self.sparse_ops or self.whiten_mat is None:
+            return self.whiten_mat
+        if self._whiten_op is None or self._whiten_op[0] is not self.whiten_mat:
+            self._whiten_op = (self.whiten_mat, self.as_operator(self.whiten_mat))
+        return self._whiten_op[1]
+
+    def as_operator(self, M):
+        """Convert `M` to a `SparseOperator` if `sparse_ops` is True."""
+        if not self.sparse_ops or isinstance(M, SparseOperator):
+            return M
+        return SparseOperator(M, self.channel_groups, tol=SPARSE_OPS_TOL)
+
+    def drift_matrix(self, ops, ibatch, whiten=True):
+        """Drift-correction matrix for `ibatch`, optionally times `whiten_mat`.
+
+        Only matrices from `drift_matrices` are returned as `SparseOperator`s,
+        since those are converted once and re-used. Matrices computed for a
+        single batch are returned dense, because detecting their sparsity
+        costs more than the dense matmul it would save.
+
+        """
+        cache = self.drift_matrices
+        if cache is not None:
+            if cache.whiten_mat is None:
+                M = cache.get(ibatch)
+                return M @ self.whiten_mat if whiten else M
+            elif whiten:
+                return cache.get(ibatch)
+        M = get_drift_matrix(ops, self.dshift[ibatch], device=self.device)
+        if whiten:
+            M = M @ self.whiten_mat
+        return M
+
     def __getitem__(self, *items):
         samples = super().__getitem__(*items)
         with warnings.catch_warnings():
@@ -1067,17 +2454,732 @@ class BinaryFiltered(BinaryRWFile):
         
     def padded_batch_to_torch(self, ibatch, ops=None, return_inds=False,
                               skip_preproc=False):
+        use_cache = (self.cache is not None and self.whiten_mat is not None
+                     and not skip_preproc)
+        if use_cache and ibatch in self.cache:
+            X = self.cache.read(ibatch, device=self.device)
+            bstart, bend = self.get_batch_edges(ibatch)
+            if ibatch == 0:
+                bstart = self.imin - self.nt
+            elif ibatch == self.n_batches-1:
+                bend += self.nt
+            inds = [bstart, bend]
+        else:
+            # Channels in chan_map are selected while decoding raw data.
+            X, inds = super().padded_batch_to_torch(
+                ibatch, return_inds=True, chan_map=self.chan_map,
+                buffers=self.buffers
+                )
+            X = self._filter_channels(X, ops, ibatch, skip_preproc=skip_preproc,
+                                      skip_whitening=use_cache)
+            if use_cache:
+                X = self.whiten_op @ X
+                self.cache.write(ibatch, X)
+
+        if use_cache:
+            # Cached data is whitened, but not drift-corrected.
+            if self.dshift is not None and ops is not None:
+                X = self.drift_matrix(ops, ibatch, whiten=False) @ X
+
         if return_inds:
-            X, inds = super().padded_batch_to_torch(ibatch, return_inds=return_inds)
-            return self.filter(X, ops, ibatch, skip_preproc=skip_preproc), inds
+            return X, inds
+        else:
+            return X
+
+
+# Relative magnitude below which entries of whitening and drift matrices are
+# treated as zero by `SparseOperator`. Smaller than float32 precision, so
+# results match dense matrix products up to rounding.
+SPARSE_OPS_TOL = 1e-7
+
+
+class DriftMatrixCache:
+    def __init__(self, ops, dshift, whiten_mat=None, device=None,
+                 max_memory=2**30, quantize=0, max_block_memory=2**28,
+                 sparse=False, channel_groups=None):
+        """Memory-budgeted cache of drift-correction matrices for each batch.
+
+        Matrices are computed with `get_drift_matrices`, many batches at a
+        time, and multiplied by `whiten_mat` if it's given so that drift
+        correction and whitening are applied with a single matmul. Batches
+        with identical (or, if `quantize > 0`, nearly identical) drift share
+        one matrix. Matrices that don't fit in `max_memory` are computed
+        when requested and evicted in least-recently-used order.
+
+        Parameters
+        ----------
+        ops : dict
+            Dictionary with the drift-correction variables set by
+            `kilosort.datashift.run`.
+        dshift : np.ndarray
+            Drift for each batch and block, with shape (n_batches, nblocks).
+        whiten_mat : torch.Tensor; optional.
+            Whitening matrix. If given, cached matrices are
+            `get_drift_matrix(...) @ whiten_mat`.
+        device : torch.device; optional.
+            Device for cached matrices. Defaults to `whiten_mat.device`, or
+            CPU if `whiten_mat` is not given.
+        max_memory : int; default=2**30.
+            Maximum size of cached matrices, in bytes.
+        quantize : float; default=0.
+            If greater than 0, drifts are rounded to a multiple of this number
+            (in microns) before computing matrices, so that more batches can
+            share one. 0 uses the exact drift for each batch.
+        max_block_memory : int; default=2**28.
+            Approximate limit on temporary memory used while computing a
+            block of matrices, in bytes.
+        sparse : bool; default=False.
+            If True, matrices are stored as `SparseOperator`s, using
+            `channel_groups` to detect per-shank blocks. The memory budget
+            still assumes dense matrices.
+        channel_groups : np.ndarray; optional.
+            Shank index for each channel, like `probe['kcoords']`.
+
+        """
+        if device is None:
+            device = whiten_mat.device if whiten_mat is not None \
+                     else torch.device('cpu')
+        if isinstance(dshift, torch.Tensor):
+            dshift = dshift.cpu().numpy()
+        dshift = np.asarray(dshift)
+        if dshift.ndim == 1:
+            dshift = dshift[:, np.newaxis]
+        if quantize > 0:
+            dshift = np.round(dshift / quantize) * quantize
+        self.ops = ops
+        self.whiten_mat = whiten_mat
+        self.device = device
+        self.quantize = quantize
+        self.sparse = sparse
+        self.channel_groups = channel_groups
+        # Index of the unique drift used by each batch.
+        self.shifts, self.batch_keys = np.unique(
+            dshift, axis=0, return_inverse=True
+            )
+        self.batch_keys = self.batch_keys.reshape(-1)
+
+        n_chans = len(ops['probe']['yc'])
+        matrix_bytes = n_chans * n_chans * 4
+        self.max_matrices = max(1, int(max_memory // matrix_bytes))
+        # Kernel distances are computed for (block, n_chans, n_chans, 2).
+        self.block_size = max(1, int(max_block_memory // (matrix_bytes * 3)))
+        self._matrices = OrderedDict()
+        self._lock = threading.Lock()
+        self.n_hits = 0
+        self.n_misses = 0
+
+    def __len__(self):
+        return len(self._matrices)
+
+    def _compute(self, keys):
+        M = get_drift_matrices(self.ops, self.shifts[keys], device=self.device)
+        if self.whiten_mat is not None:
+            M = M @ self.whiten_mat.to(self.device)
+        return M
+
+    def precompute(self):
+        """Compute matrices for as many batches as fit in the memory budget.
+
+        Drifts shared by the most batches are computed first.
+
+        """
+        counts = np.bincount(self.batch_keys, minlength=len(self.shifts))
+        keys = np.argsort(-counts, kind='stable')[:self.max_matrices]
+        keys = np.array([k for k in keys if k not in self._matrices])
+        for i in range(0, len(keys), self.block_size):
+            block = keys[i : i+self.block_size]
+            M = self._compute(block)
+            with self._lock:
+                for k, m in zip(block, M):
+                    self._insert(int(k), m)
+
+    def get(self, ibatch):
+        """Get the matrix for batch `ibatch`, computing it if needed."""
+        k = int(self.batch_keys[ibatch])
+        with self._lock:
+            if k in self._matrices:
+                self._matrices.move_to_end(k)
+                self.n_hits += 1
+                return self._matrices[k]
+            self.n_misses += 1
+        m = self._compute([k])[0]
+        with self._lock:
+            return self._insert(k, m)
+
+    def _insert(self, key, m):
+        if self.sparse:
+            m = SparseOperator(m, self.channel_groups, tol=SPARSE_OPS_TOL)
+        self._matrices[key] = m
+        self._matrices.move_to_end(key)
+        while len(self._matrices) > self.max_matrices:
+            self._matrices.popitem(last=False)
+        return m
+
+    def stats(self):
+        """Summarize cache performance as a dictionary."""
+        n_requests = self.n_hits + self.n_misses
+        return {
+            'n_batches': len(self.batch_keys), 'n_unique': len(self.shifts),
+            'n_cached': len(self._matrices), 'n_hits': self.n_hits,
+            'n_misses': self.n_misses,
+            'hit_rate': self.n_hits / n_requests if n_requests > 0 else 0.0
+            }
+
+    def clear(self):
+        """Remove all cached matrices."""
+        with self._lock:
+            self._matrices.clear()
+
+
+class PreprocessedCache:
+    def __init__(self, cache_dir, key, n_batches, n_chans, n_samples,
+                 dtype='float16'):
+        """Scratch file storing filtered and whitened batches.
+
+        Each batch is stored the first time it is loaded by `BinaryFiltered`,
+        so that later passes over the data only need to load the batch from
+        this file and apply drift correction, instead of repeating filtering,
+        common average referencing and whitening.
+
+        Parameters
+        ----------
+        cache_dir : str or pathlib.Path
+            Directory where the cache files are stored.
+        key : str
+            Hash of all settings that affect preprocessed data, as returned by
+            `PreprocessedCache.get_key`. Cache files with a different key
+            in `cache_dir` are deleted, and are never re-used.
+        n_batches : int
+            Number of batches in the recording.
+        n_chans : int
+            Number of channels in each batch, after applying the channel map.
+        n_samples : int
+            Number of samples in each batch, including padding.
+        dtype : str; default='float16'.
+            Either 'float16' or 'int16'. For 'int16', each channel of each
+            batch is scaled to use the full range of int16.
+
+        """
+        if dtype not in ['float16', 'int16']:
+            raise ValueError(
+                f"Preprocessed cache dtype must be 'float16' or 'int16', "
+                f"got {dtype}."
+                )
+
+        self.cache_dir = Path(cache_dir)
+        self.key = key
+        self.dtype = np.dtype(dtype)
+        self.filename = self.cache_dir / f'preprocessed_cache_{key}.npy'
+        self.scale_filename = self.cache_dir / f'preprocessed_cache_{key}_scale.npy'
+        shape = (n_batches, n_chans, n_samples)
+
+        for f in self.cache_dir.glob('preprocessed_cache_*.npy'):
+            if f not in [self.filename, self.scale_filename]:
+                logger.info(f'Removing outdated preprocessed cache: {f}')
+                f.unlink()
+
+        self.data = None
+        if self.filename.exists() and self.scale_filename.exists():
+            data = np.lib.format.open_memmap(self.filename, mode='r+')
+            scale = np.load(self.scale_filename)
+            if data.shape == shape and data.dtype == self.dtype:
+                self.data = data
+                self.scale = scale
+                logger.info(f'Re-using {len(self)} batches of preprocessed '
+                            f'data cached in {self.filename}')
+            else:
+                del data
+        if self.data is None:
+            self.data = np.lib.format.open_memmap(
+                self.filename, mode='w+', dtype=self.dtype, shape=shape
+                )
+            # NaN scale indicates that a batch hasn't been written yet.
+            self.scale = np.full((n_batches, n_chans), np.nan, dtype='float32')
+
+    @staticmethod
+    def get_key(bfile, dtype):
+        """Hash the data source and preprocessing settings used by `bfile`."""
+        h = hashlib.sha256()
+        filenames = bfile.filename
+        if not isinstance(filenames, list):
+            filenames = [filenames]
+        for f in filenames:
+            h.update(str(f).encode())
+            if os.path.isfile(f):
+                stat = os.stat(f)
+                h.update(f'{stat.st_size}_{stat.st_mtime_ns}'.encode())
+
+        settings = [
+            bfile.n_chan_bin, str(bfile.dtype), bfile.n_samples, bfile.NT,
+            bfile.nt, bfile.imin, bfile.imax, bfile.do_CAR, bfile.invert_sign,
+            bfile.artifact_threshold, bfile.shift, bfile.scale, str(dtype),
+            bfile.car_mode, bfile.filter_mode
+            ]
+        h.update(repr(settings).encode())
+        for x in [bfile.chan_map, bfile.hp_filter, bfile.whiten_mat,
+                  bfile.channel_groups]:
+            if x is None:
+                h.update(b'None')
+            else:
+                if isinstance(x, torch.Tensor):
+                    x = x.cpu().numpy()
+                x = np.ascontiguousarray(x)
+                h.update(str(x.dtype).encode() + str(x.shape).encode())
+                h.update(x.tobytes())
+
+        return h.hexdigest()[:16]
+
+    @classmethod
+    def from_bfile(cls, bfile, cache_dir, dtype='float16'):
+        """Create a cache with the shape and settings used by `bfile`."""
+        key = cls.get_key(bfile, dtype)
+        n_chans = bfile.n_chan_bin if bfile.chan_map is None \
+            else len(bfile.chan_map)
+        return cls(cache_dir, key, bfile.n_batches, n_chans,
+                   bfile.NT + 2*bfile.nt, dtype=dtype)
+
+    def __contains__(self, ibatch):
+        return not np.isnan(self.scale[ibatch, 0])
+
+    def __len__(self):
+        return int((~np.isnan(self.scale[:, 0])).sum())
+
+    def write(self, ibatch, X):
+        """Store preprocessed batch `X`, with shape (n_chans, n_samples)."""
+        X = X.cpu().numpy()
+        if self.dtype == np.int16:
+            scale = np.abs(X).max(axis=1) / np.iinfo(np.int16).max
+            scale[scale == 0] = 1
+            self.data[ibatch] = np.round(X / scale[:, np.newaxis])
+        else:
+            scale = np.ones(X.shape[0], dtype='float32')
+            f16 = np.finfo(np.float16).max
+            self.data[ibatch] = np.clip(X, -f16, f16)
+        self.scale[ibatch] = scale
+
+    def read(self, ibatch, device=None):
+        """Load batch `ibatch` as a float32 tensor."""
+        X = torch.from_numpy(np.array(self.data[ibatch])).to(device).float()
+        if self.dtype == np.int16:
+            scale = torch.from_numpy(self.scale[ibatch]).to(device)
+            X *= scale.unsqueeze(1)
+        return X
+
+    def close(self):
+        """Flush cached data to disk and save which batches were written."""
+        if self.data is not None:
+            self.data.flush()
+            np.save(self.scale_filename, self.scale)
+
+    def delete(self):
+        """Close the cache and remove its files."""
+        self.data = None
+        for f in [self.filename, self.scale_filename]:
+            if f.exists():
+                f.unlink()
+
+
+class TracePyramid:
+    def __init__(self, directory, name, key, n_samples, n_chans,
+                 factors=(256, 1024, 4096, 16384)):
+        """Min, max and RMS of traces at several decimation levels.
+
+        For a decimation factor `f`, every block of `f` samples is reduced to
+        the minimum, maximum and root-mean-square value on each channel. Each
+        level is stored as a float16 .npy file with shape
+        (ceil(n_samples / f), n_chans, 3), so that a zoomed-out view of the
+        recording can be drawn from a few thousand rows instead of reading
+        and filtering the full time range.
+
+        Parameters
+        ----------
+        directory : str or pathlib.Path
+            Directory where the pyramid files are stored, typically next to
+            the recording. See `TracePyramid.default_directory`.
+        name : str
+            Name of the view the pyramid is built for, like 'raw' or
+            'whitened'. Files for the same view with a different key are
+            deleted.
+        key : str
+            Hash of the data source and preprocessing settings, as returned by
+            `PreprocessedCache.get_key`.
+        n_samples : int
+            Number of samples in the recording.
+        n_chans : int
+            Number of channels, after applying the channel map.
+        factors : tuple of int; default=(256, 1024, 4096, 16384).
+            Decimation factor of each level. Each factor must be a multiple of
+            the previous one.
+
+        """
+        factors = sorted(factors)
+        for f1, f2 in zip(factors[:-1], factors[1:]):
+            if f2 % f1 != 0:
+                raise ValueError(
+                    f'Pyramid factors must be multiples of each other, got '
+                    f'{f1} and {f2}.'
+                    )
+
+        self.directory = Path(directory)
+        self.name = name
+        self.key = key
+        self.n_samples = n_samples
+        self.n_chans = n_chans
+        self.factors = factors
+        self.filenames = {
+            f: self.directory / f'{name}_{key}_{f}.npy' for f in factors
+            }
+        self.meta_file = self.directory / f'{name}_{key}.json'
+        self.levels = {}
+
+        if self.directory.is_dir():
+            for f in self.directory.glob(f'{name}_*'):
+                if not f.name.startswith(f'{name}_{key}'):
+                    logger.info(f'Removing outdated trace pyramid: {f}')
+                    f.unlink()
+
+        if self.meta_file.exists():
+            with open(self.meta_file, 'r') as f:
+                meta = json.load(f)
+            if meta.get('factors') == factors \
+                    and all([p.exists() for p in self.filenames.values()]):
+                self.levels = {
+                    f: np.load(p, mmap_mode='r')
+                    for f, p in self.filenames.items()
+                    }
+
+    @staticmethod
+    def default_directory(filename):
+        """Sidecar directory for pyramids of the recording in `filename`."""
+        if isinstance(filename, list):
+            filename = filename[0]
+        return Path(f'{filename}.ks4pyramid')
+
+    @classmethod
+    def from_bfile(cls, bfile, name, directory=None, **kwargs):
+        """Create a pyramid with the shape and settings used by `bfile`."""
+        if directory is None:
+            directory = cls.default_directory(bfile.filename)
+        key = PreprocessedCache.get_key(bfile, 'pyramid')
+        n_chans = bfile.n_chan_bin if bfile.chan_map is None \
+            else len(bfile.chan_map)
+        n_samples = min(bfile.n_samples, bfile.n_batches * bfile.NT)
+        return cls(directory, name, key, n_samples, n_chans, **kwargs)
+
+    @property
+    def complete(self):
+        return len(self.levels) == len(self.factors)
+
+    def build(self, bfile, progress=None, stop_event=None):
+        """Compute all levels from the batches of `bfile`.
+
+        Parameters
+        ----------
+        bfile : BinaryFiltered
+            File that the pyramid was created for, see `from_bfile`.
+        progress : callable; optional.
+            Called as `progress(n_done, n_batches)` after each batch.
+        stop_event : threading.Event; optional.
+            If set, building stops after the current batch.
+
+        Returns
+        -------
+        bool
+            True if all levels were built, False if building was stopped.
+
+        """
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.levels = {}
+        f0 = self.factors[0]
+        NT, nt = bfile.NT, bfile.nt
+        finest = np.lib.format.open_memmap(
+            self.filenames[f0], mode='w+', dtype='float16',
+            shape=(int(np.ceil(self.n_samples / f0)), self.n_chans, 3)
+            )
+
+        leftover = None
+        ibin = 0
+        for ibatch in range(bfile.n_batches):
+            if stop_event is not None and stop_event.is_set():
+                return False
+            X = bfile.padded_batch_to_torch(ibatch)
+            n_valid = min(NT, self.n_samples - ibatch*NT)
+            X = X[:, nt : nt + n_valid]
+            if leftover is not None:
+                X = torch.cat([leftover, X], dim=1)
+            # Carry samples over to the next batch so that blocks don't
+            # depend on the batch size, except at the end of the recording.
+            n_full = X.shape[1]
+            if ibatch < bfile.n_batches - 1:
+                n_full = (n_full // f0) * f0
+            stats = self._block_stats(X[:, :n_full], f0)
+            leftover = X[:, n_full:]
+            finest[ibin : ibin + stats.shape[0]] = stats
+            ibin += stats.shape[0]
+            if progress is not None:
+                progress(ibatch + 1, bfile.n_batches)
+        finest.flush()
+        del finest
+
+        for f1, f2 in zip(self.factors[:-1], self.factors[1:]):
+            if stop_event is not None and stop_event.is_set():
+                return False
+            self._downsample(f1, f2)
+
+        with open(self.meta_file, 'w') as f:
+            json.dump({'factors': self.factors, 'n_samples': self.n_samples,
+                       'n_chans': self.n_chans}, f)
+        self.levels = {
+            f: np.load(p, mmap_mode='r') for f, p in self.filenames.items()
+            }
+
+        return True
+
+    @staticmethod
+    def _block_stats(X, factor):
+        # Pad the last block with its final sample, which doesn't change
+        # min or max and has little effect on RMS.
+        n_chans, n_samples = X.shape
+        n_blocks = int(np.ceil(n_samples / factor))
+        n_pad = n_blocks*factor - n_samples
+        if n_pad > 0:
+            X = torch.cat([X, X[:, -1:].expand(n_chans, n_pad)], dim=1)
+        X = X.reshape(n_chans, n_blocks, factor)
+        stats = torch.stack(
+            [X.amin(dim=2), X.amax(dim=2), (X**2).mean(dim=2).sqrt()], dim=2
+            )
+        f16 = np.finfo(np.float16).max
+        stats = stats.clamp(-f16, f16).permute(1, 0, 2)
+        return stats.cpu().numpy().astype('float16')
+
+    def _downsample(self, f1, f2, block_size=2**12):
+        r = f2 // f1
+        fine = np.load(self.filenames[f1], mmap_mode='r')
+        n_blocks = int(np.ceil(fine.shape[0] / r))
+        coarse = np.lib.format.open_memmap(
+            self.filenames[f2], mode='w+', dtype='float16',
+            shape=(n_blocks, self.n_chans, 3)
+            )
+        for i in range(0, n_blocks, block_size):
+            x = np.asarray(fine[i*r : (i + block_size)*r], dtype='float32')
+            n = int(np.ceil(x.shape[0] / r))
+            if n*r > x.shape[0]:
+                pad = np.repeat(x[-1:], n*r - x.shape[0], axis=0)
+                x = np.concatenate([x, pad], axis=0)
+            x = x.reshape(n, r, self.n_chans, 3)
+            coarse[i : i+n, :, 0] = x[..., 0].min(axis=1)
+            coarse[i : i+n, :, 1] = x[..., 1].max(axis=1)
+            coarse[i : i+n, :, 2] = np.sqrt((x[..., 2]**2).mean(axis=1))
+        coarse.flush()
+
+    def level_for(self, n_samples, n_pixels):
+        """Coarsest factor with at least `n_pixels` blocks in `n_samples`.
+
+        Returns None if no level is fine enough, or if the pyramid hasn't been
+        built, in which case the traces should be read directly.
+
+        """
+        if not self.complete:
+            return None
+        factors = [f for f in self.factors if n_samples / f >= n_pixels]
+        return max(factors) if len(factors) > 0 else None
+
+    def read(self, factor, start, stop, channels=None):
+        """Get stats for samples `start` to `stop` from level `factor`.
+
+        Returns
+        -------
+        np.ndarray
+            Array with shape (n_blocks, n_channels, 3) containing min, max
+            and RMS, as float32.
+
+        """
+        level = self.levels[factor]
+        i0 = start // factor
+        i1 = int(np.ceil(stop / factor))
+        if channels is None:
+            data = level[i0:i1]
         else:
-            X = super().padded_batch_to_torch(ibatch)
-            return self.filter(X, ops, ibatch, skip_preproc=skip_preproc)
+            data = level[i0:i1, channels]
+        return np.asarray(data, dtype='float32')
+
+    def delete(self):
+        """Remove all files for this pyramid."""
+        self.levels = {}
+        for f in list(self.filenames.values()) + [self.meta_file]:
+            if f.exists():
+                f.unlink()
+
+
+class ChunkedArray:
+    def __init__(self, row_shape, dtype, chunk_size=2**16, max_memory=np.inf,
+                 filename=None):
+        """Append-only array stored in fixed-size chunks, with spill to disk.
+
+        Rows are appended in batches of any length. Full chunks are kept in
+        memory until they use more than `max_memory` bytes, after which the
+        oldest chunks are written to `filename`. Unlike doubling the size of
+        a pre-allocated array, appending never copies existing rows.
+
+        Parameters
+        ----------
+        row_shape : tuple of int
+            Shape of each row, e.g. `(nearest_chans, n_pcs)` for PC features.
+        dtype : str or np.dtype
+            Data type of stored rows.
+        chunk_size : int; default=2**16.
+            Number of rows per chunk.
+        max_memory : float; default=np.inf.
+            Maximum number of bytes of chunks to keep in memory.
+        filename : str or pathlib.Path; optional.
+            File that chunks are spilled to. If not specified, all chunks are
+            kept in memory regardless of `max_memory`.
+
+        """
+        self.row_shape = tuple(row_shape)
+        self.dtype = np.dtype(dtype)
+        self.chunk_size = chunk_size
+        self.max_memory = max_memory
+        self.filename = Path(filename) if filename is not None else None
+
+        self._chunks = []
+        self._current = None
+        self._n_current = 0
+        self._n_spilled = 0
+        self._file = None
+
+    @property
+    def chunk_bytes(self):
+        return self.chunk_size * int(np.prod(self.row_shape)) * self.dtype.itemsize
+
+    @property
+    def n_spilled(self):
+        """Number of rows that were written to disk."""
+        return self._n_spilled
+
+    def __len__(self):
+        return self._n_spilled + len(self._chunks)*self.chunk_size \
+            + self._n_current
+
+    def append(self, X):
+        """Append rows `X`, with shape `(n_rows, *row_shape)`."""
+        X = np.asarray(X)
+        i = 0
+        while i < X.shape[0]:
+            if self._current is None:
+                self._current = np.empty(
+                    (self.chunk_size, *self.row_shape), dtype=self.dtype
+                    )
+                self._n_current = 0
+            n = min(X.shape[0] - i, self.chunk_size - self._n_current)
+            self._current[self._n_current : self._n_current+n] = X[i : i+n]
+            self._n_current += n
+            i += n
+            if self._n_current == self.chunk_size:
+                self._chunks.append(self._current)
+                self._current = None
+                self._n_current = 0
+                self._spill()
+
+    def _spill(self):
+        if self.filename is None:
+            return
+        # Count the partially filled chunk, since it is already allocated.
+        while len(self._chunks) > 0 and \
+                (len(self._chunks) + 1) * self.chunk_bytes > self.max_memory:
+            self._write_chunk(self._chunks.pop(0))
+
+    def _write_chunk(self, chunk):
+        if self._file is None:
+            logger.info(f'Spike buffer exceeded memory limit, writing to '
+                        f'{self.filename}')
+            self._file = open(self.filename, 'wb')
+        chunk.tofile(self._file)
+        self._n_spilled += chunk.shape[0]
+
+    def to_array(self, order=None):
+        """Return all rows as a single array and reset the store.
+
+        Parameters
+        ----------
+        order : np.ndarray; optional.
+            If specified, rows are returned in this order, as in `X[order]`.
+
+        Returns
+        -------
+        X : np.ndarray or np.memmap
+            Array with shape `(n_rows, *row_shape)`. If any chunks were
+            spilled, this is a memmap of `filename` (or of a sorted copy, if
+            `order` was specified).
+
+        """
+        n = len(self)
+        chunks = self._chunks
+        if self._current is not None:
+            chunks.append(self._current[:self._n_current])
+        self._chunks, self._current, self._n_current = [], None, 0
+
+        if self._file is None:
+            X = np.empty((n, *self.row_shape), dtype=self.dtype)
+            i = 0
+            while len(chunks) > 0:
+                # Release each chunk after copying to limit peak memory.
+                c = chunks.pop(0)
+                X[i : i+c.shape[0]] = c
+                i += c.shape[0]
+            if order is not None:
+                X = X[order]
+            return X
+
+        while len(chunks) > 0:
+            self._write_chunk(chunks.pop(0))
+        self._file.close()
+        self._file = None
+        self._n_spilled = 0
+        shape = (n, *self.row_shape)
+        X = np.memmap(self.filename, dtype=self.dtype, mode='r+', shape=shape)
+
+        if order is not None:
+            sorted_file = self.filename.with_name(
+                self.filename.stem + '_sorted' + self.filename.suffix
+                )
+            Y = np.memmap(sorted_file, dtype=self.dtype, mode='w+', shape=shape)
+            for i in range(0, n, self.chunk_size):
+                Y[i : i+self.chunk_size] = X[order[i : i+self.chunk_size]]
+            Y.flush()
+            del X
+            self.filename.unlink()
+            X = Y
+
+        return X
 
 
-def save_preprocessing(filename, ops, bfile=None, bfile_path=None):
+def remove_spill_files(spill_dir, pattern='*_spill*.dat'):
+    """Delete files written by `ChunkedArray` in `spill_dir`, if possible.
+
+    Returns a list of the files that could not be removed.
+
+    """
+    remaining = []
+    for f in Path(spill_dir).glob(pattern):
+        try:
+            f.unlink()
+        except OSError:
+            # Windows does not allow deleting files that are still mapped.
+            logger.debug(f'Could not remove spill file {f}')
+            remaining.append(f)
+
+    return remaining
+
+
+def save_preprocessing(filename, ops, bfile=None, bfile_path=None,
+                       n_workers=None):
     """Save a preprocessed copy of data, including drift correction.
 
+    Batches are preprocessed by a pool of worker threads, while the main
+    thread blends the overlapping samples at the edges of neighboring batches
+    and writes one contiguous block of samples per batch, in order.
+
     Parameters
     ----------
     filename : str or Path-like.
@@ -1093,6 +3195,9 @@ def save_preprocessing(filename, ops, bfile=None, bfile_path=None):
         Path where raw binary data should be loaded from. If `bfile` is given,
         this parameter will not be used.
         One of `bfile` or `bfile_path` must be provided.
+    n_workers : int; optional.
+        Number of threads used to preprocess batches. Defaults to the number
+        of CPUs, up to 4.
 
     """
 
@@ -1112,73 +3217,325 @@ def save_preprocessing(filename, ops, bfile=None, bfile_path=None):
         bfile = BinaryFiltered(
             filename=bfile_path, n_chan_bin=n_chans, chan_map=chan_map, nt=nt,
             NT=NT, hp_filter=hp_filter, whiten_mat=whiten_mat, dshift=dshift,
-            dtype=dtype
+            dtype=dtype,
+            car_mode=ops.get('settings', {}).get('car_mode', 'median'),
+            channel_groups=ops.get('probe', {}).get('kcoords')
             )
+    if n_workers is None:
+        n_workers = min(os.cpu_count() or 1, 4)
+    if bfile.prefetcher is not None:
+        # Prefetcher expects batches to be requested from one thread.
+        n_workers = 1
 
     # Need weights to linearly smooth the overlapping portions of batches
     # after drift correction. I.e. first replaced sample is mostly weighted
     # for first batch, middle sample is 50/50, last sample is mostly weighted
     # for second batch.
-    n_chans_used = len(chan_map)
-    weights = np.linspace(1, 0, 2*nt+2)[1:-1]
-    W = np.vstack([weights, np.flip(weights)])
-    W = np.tile(W, n_chans_used).reshape(2, n_chans_used, 2*nt)
+    weights = torch.linspace(1, 0, 2*nt+2, device=bfile.device)[1:-1]
+    W = torch.stack([weights, torch.flip(weights, dims=[0])])
 
     # NOTE: dtype for new file is always int16, float32 data returned by preproc
     #       steps is scaled by 200 and then converted.
-    z = np.memmap(filename, dtype='int16', mode='w+', shape=(NT*n_batches, n_chans))
+    # Writes are combined into large contiguous writes on a background
+    # thread, see `BufferedWriter`.
+    z = BufferedWriter(filename, n_chans, 'int16', NT*n_batches)
+    block = np.zeros((NT, n_chans), dtype='int16')
 
     logger.info(' ')
     logger.info('='*40)
     logger.info(f'Saving drift-corrected copy of data to: {filename}...')
-    for i in range(n_batches):
-        if i % 100 == 0:
-            logger.info(f'Writing batch {i}/{n_batches}...')
-
-        if i == 0:
-            # Initialize with first batch
-            batch1 = bfile.padded_batch_to_torch(i, ops=ops)
-        else:
-            # Re-use batch2 from previous iteration
-            batch1 = batch2
-
-        if i == n_batches-1:
-            # Skip first 2*nt of real data, it was added in previous iter.
-            # Nothing to interpolate on last batch.
-            y = batch1[:, 2*nt:-nt].cpu().numpy().T
-            z[(i*NT)+nt:, chan_map] = (y*200).astype('int16')
-        else:
-            batch2 = bfile.padded_batch_to_torch(i+1, ops=ops)
-
-            # Get interpolated values to replace inter-batch padding, there are
-            # 2*nt samples overlapping at the batch edges.
-            x1 = batch1[:, (NT-1) + 1:].cpu().numpy()
-            x2 = batch2[:, :2*nt].cpu().numpy()
-            X = np.vstack([x1[np.newaxis,...], x2[np.newaxis,...]])
-            y2 = (X*W).sum(axis=0).T
-            
-            # Write raw data, leaving out padding and first nt values
-            y1 = batch1[:, nt*2:-nt].cpu().numpy().T
-            z[(i*NT)+(nt) : ((i+1)*NT), chan_map] = (y1*200).astype('int16')
+    executor = ThreadPoolExecutor(max_workers=max(n_workers, 1))
+    futures = OrderedDict()
+    tic = time.time()
+    try:
+        # Each block of NT samples contains the second half of the blended
+        # samples from the previous edge, the middle of its batch, and the
+        # first half of the blended samples for the next edge.
+        head = None
+        for i in range(n_batches):
+            # Keep a few batches ahead in flight, bounding memory use.
+            for j in range(i, min(i + 2*n_workers + 1, n_batches)):
+                if j not in futures:
+                    futures[j] = executor.submit(
+                        _preprocess_for_copy, bfile, ops, j, NT, nt
+                        )
+            first, body, tail = futures.pop(i).result()
             if i == 0:
-                # Also need to write first nt values of first batch
-                y0 = batch1[:, nt:2*nt].cpu().numpy().T
-                z[:nt, chan_map] = (y0*200).astype('int16')
-
-            # Write interpolated data afterward, to replace the last nt values of
-            # first batch and first nt values of the next batch in loop.
-            z[((i+1)*NT)-nt : ((i+1)*NT)+nt, chan_map] = (y2*200).astype('int16')
-
-        z.flush()
+                head = first[:, nt:]
+            if i == n_batches - 1:
+                # Nothing to blend after the last batch.
+                edge = tail[:, :nt]
+                next_head = None
+            else:
+                next_first, _, _ = futures[i+1].result()
+                seam = W[0] * tail + W[1] * next_first
+                edge, next_head = seam[:, :nt], seam[:, nt:]
+
+            block[:nt, chan_map] = _to_int16(head)
+            block[nt:NT-nt, chan_map] = body
+            block[NT-nt:, chan_map] = _to_int16(edge)
+            z[i*NT : (i+1)*NT] = block
+            head = next_head
+
+            if (i+1) % 100 == 0 or i == n_batches - 1:
+                rate = (i+1)*NT / (time.time() - tic)
+                logger.info(f'Wrote batch {i+1}/{n_batches}, '
+                            f'{rate:.0f} samples/s')
+    finally:
+        for f in futures.values():
+            f.cancel()
+        executor.shutdown(wait=True)
+        z.close()
 
     logger.info('='*40)
     logger.info('Copying finished.')
     logger.info(' ')
 
 
+def _to_int16(X):
+    """Scale preprocessed data by 200 and convert to int16, time x channels."""
+    return (X * 200).to(torch.int16).T.cpu().numpy()
+
+
+def _preprocess_for_copy(bfile, ops, ibatch, NT, nt):
+    """Preprocess a batch for `save_preprocessing`.
+
+    Returns the first 2*nt samples and the last 2*nt samples (including
+    padding), which overlap with neighboring batches, and the remaining
+    samples converted to int16 with shape (NT - 2*nt, n_channels).
+
+    """
+    X = bfile.padded_batch_to_torch(ibatch, ops=ops)
+    first = X[:, :2*nt].clone()
+    tail = X[:, NT:].clone()
+    body = _to_int16(X[:, 2*nt:NT])
+    return first, body, tail
+
+
+def _write_at(fd, data, offset, lock=None):
+    """Write all of `data` to file descriptor `fd`, starting at byte `offset`."""
+    data = memoryview(data)
+    if hasattr(os, 'pwrite'):
+        while len(data) > 0:
+            n = os.pwrite(fd, data, offset)
+            data = data[n:]
+            offset += n
+    else:
+        # No pwrite on Windows, so seek and write can't be interleaved with
+        # other threads.
+        with lock:
+            os.lseek(fd, offset, os.SEEK_SET)
+            while len(data) > 0:
+                n = os.write(fd, data)
+                data = data[n:]
+
+
+class BufferedWriter:
+    def __init__(self, filename, n_chans, dtype, n_samples, buffer_size=2**26,
+                 max_pending=2, sync_interval=None, overwrite=True):
+        """Combine assignments to a binary file into large contiguous writes.
+
+        Assigned samples are staged in a buffer covering a contiguous range of
+        samples. When an assignment falls outside of that range, the staged
+        samples are written with a single `pwrite` call on a background
+        thread, so that writing overlaps with computing the next samples.
+        Assignments must use a contiguous range of samples, but can use any
+        channel index. Channels that are not assigned keep their existing
+        values.
+
+        Staged samples are only guaranteed to be in the file after `flush` or
+        `close`, which is also called when used as a context manager.
+
+        Parameters
+        ----------
+        filename : str or pathlib.Path
+            Binary file with shape (n_samples, n_chans).
+        n_chans : int
+            Number of channels in the file.
+        dtype : str or np.dtype
+            Data type of samples in the file.
+        n_samples : int
+            Number of samples in the file.
+        buffer_size : int; default=2**26.
+            Number of bytes staged before they are written. Larger
+            assignments get a buffer of their own.
+        max_pending : int; default=2.
+            Maximum number of staged buffers waiting to be written. This
+            bounds memory use to about `(max_pending + 1) * buffer_size`.
+        sync_interval : int; optional.
+            If specified, call `os.fsync` after this many bytes are written.
+            Otherwise, the file is only synced by `close`.
+        overwrite : bool; default=True.
+            If True, create or truncate the file and fill it with zeros.
+            Otherwise, existing data is kept.
+
+        Examples
+        --------
+        >>> with BufferedWriter('temp.dat', 4, 'int16', 1000) as f:
+        ...     f[0:500, [0, 2]] = data1
+        ...     f[500:1000] = data2
+
+        """
+        self.filename = filename
+        self.n_chans = n_chans
+        self.dtype = np.dtype(dtype)
+        self.n_samples = n_samples
+        self.shape = (n_samples, n_chans)
+        self.sample_bytes = self.dtype.itemsize * n_chans
+        self.buffer_samples = max(int(buffer_size // self.sample_bytes), 1)
+        self.max_pending = max(max_pending, 1)
+        self.sync_interval = sync_interval
+
+        flags = os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0)
+        if overwrite:
+            flags |= os.O_TRUNC
+        self._fd = os.open(filename, flags)
+        if os.fstat(self._fd).st_size < n_samples * self.sample_bytes:
+            os.ftruncate(self._fd, n_samples * self.sample_bytes)
+        # Samples after this index are still zero, so staging them doesn't
+        # require reading the file first.
+        self._existing_end = 0 if overwrite else n_samples
+
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending = []
+        self._free = []
+        self._buffer = None
+        self._start = 0
+        self._lo = 0
+        self._hi = 0
+        self._bytes_since_sync = 0
+
+        self.n_writes = 0
+        self.bytes_written = 0
+        self.stall_time = 0.0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __setitem__(self, idx, data):
+        if self._fd is None:
+            raise ValueError('BufferedWriter was already closed.')
+        if not isinstance(idx, tuple): idx = tuple([idx])
+        rows = idx[0]
+        cols = idx[1] if len(idx) > 1 else slice(None)
+        if not isinstance(rows, slice) or rows.step not in [None, 1]:
+            raise IndexError(
+                'BufferedWriter only supports contiguous ranges of samples.'
+                )
+        i, j, _ = rows.indices(self.n_samples)
+        if j <= i:
+            return
+
+        if self._buffer is None or i < self._start \
+                or j > self._start + self._buffer.shape[0]:
+            self._submit()
+            self._stage(i, j)
+        self._buffer[i - self._start : j - self._start, cols] = data
+        self._lo = min(self._lo, i)
+        self._hi = max(self._hi, j)
+
+    def _stage(self, i, j):
+        n = min(max(self.buffer_samples, j - i), self.n_samples - i)
+        buffer = None
+        while len(self._free) > 0 and buffer is None:
+            b = self._free.pop()
+            if b.shape[0] >= n:
+                buffer = b
+        if buffer is None:
+            buffer = np.empty((n, self.n_chans), dtype=self.dtype)
+        n = buffer.shape[0]
+
+        # Fill the buffer with the current contents of the file, so that
+        # channels that aren't assigned are written back unchanged.
+        n_existing = min(max(self._existing_end - i, 0), n)
+        if n_existing > 0:
+            for future, _, lo, hi in self._pending:
+                if lo < i + n_existing and hi > i:
+                    future.result()
+            b = memoryview(buffer[:n_existing]).cast('B')
+            with open(self.filename, 'rb') as f:
+                f.seek(i * self.sample_bytes)
+                f.readinto(b)
+        buffer[n_existing:] = 0
+
+        self._buffer = buffer
+        self._start = i
+        self._lo = j
+        self._hi = i
+
+    def _submit(self):
+        if self._buffer is None:
+            return
+        if self._hi > self._lo:
+            data = self._buffer[self._lo - self._start : self._hi - self._start]
+            data = memoryview(data).cast('B')
+            future = self._executor.submit(
+                _write_at, self._fd, data, self._lo * self.sample_bytes,
+                self._lock
+                )
+            self._pending.append((future, self._buffer, self._lo, self._hi))
+            self._existing_end = max(self._existing_end, self._hi)
+            self.n_writes += 1
+            self.bytes_written += data.nbytes
+            self._bytes_since_sync += data.nbytes
+        else:
+            self._free.append(self._buffer)
+        self._buffer = None
+
+        self._wait(self.max_pending)
+        if self.sync_interval is not None \
+                and self._bytes_since_sync >= self.sync_interval:
+            self._wait(0)
+            os.fsync(self._fd)
+            self._bytes_since_sync = 0
+
+    def _wait(self, max_pending):
+        # Wait for the oldest writes until at most `max_pending` remain,
+        # and re-use their buffers.
+        while len(self._pending) > max_pending:
+            future, buffer, _, _ = self._pending.pop(0)
+            t0 = time.time()
+            future.result()
+            self.stall_time += time.time() - t0
+            self._free.append(buffer)
+
+    def flush(self):
+        """Write all staged samples and wait for writes to finish."""
+        if self._fd is None:
+            return
+        self._submit()
+        self._wait(0)
+
+    def stats(self):
+        """Summarize write performance as a dictionary."""
+        return {
+            'n_writes': self.n_writes,
+            'bytes_written': self.bytes_written,
+            'stall_time': self.stall_time,
+        }
+
+    def close(self):
+        """Flush staged samples, sync the file and close it."""
+        if self._fd is None:
+            return
+        try:
+            self.flush()
+            os.fsync(self._fd)
+        finally:
+            self._executor.shutdown(wait=True)
+            os.close(self._fd)
+            self._fd = None
+            self._free = []
+
+
 def spikeinterface_to_binary(recording, filepath, data_name='data.bin',
                              dtype=np.int16, chunksize=300000, export_probe=True,
-                             probe_name='probe.prb', max_workers=None):
+                             probe_name='probe.prb', max_workers=None,
+                             max_in_flight=None, fsync_bytes=2**30):
     """Save data from a SpikeInterface RecordingExtractor to a binary file.
 
     This function is provided to assist with converting data from other file
@@ -1209,8 +3566,15 @@ def spikeinterface_to_binary(recording, filepath, data_name='data.bin',
         Name for the new probe file.
     max_workers : int; optional.
         Maximum number of threads used to execute file i/o.
-        Default: min(32, (os.process_cpu_count() or 1) + 4)
+        Default: min(32, (os.cpu_count() or 1) + 4)
         (https://github.com/python/cpython/blob/main/Lib/concurrent/futures/thread.py)
+    max_in_flight : int; optional.
+        Maximum number of chunks that are being read or written at once, which
+        bounds memory use to about `max_in_flight` chunks.
+        Default: 2 * max_workers.
+    fsync_bytes : int; default=2**30.
+        Number of bytes written between calls to `os.fsync`, so that written
+        data doesn't accumulate in the page cache for the whole conversion.
         
     Notes
     -----
@@ -1242,45 +3606,85 @@ def spikeinterface_to_binary(recording, filepath, data_name='data.bin',
     dtype = recording.get_dtype()
     logger.info(f'dtype: {dtype}')
 
-    # Determine start/end indices for each segment
+    # Determine start/end indices for each chunk within its segment, and the
+    # sample offset of each chunk in the concatenated binary file.
     indices = []
+    segment_start = 0
     for k in range(s):
         n = recording.get_num_samples(segment_index=k)
-        i = 0 + k*chunksize
-        while i < n:
-            j = i + chunksize if (i + chunksize) < n else n
-            indices.append((i, j, k))
-            i += chunksize
-
-    # Copy each chunk of data to memmory mapped binary file,
-    # use multithreading to speed it up.
-    def copy_chunk(memmap, i, j, k):
+        for i in range(0, n, chunksize):
+            j = min(i + chunksize, n)
+            indices.append((i, j, k, segment_start + i))
+        segment_start += n
+
+    itemsize = np.dtype(dtype).itemsize
+    if max_workers is None:
+        max_workers = min(32, (os.cpu_count() or 1) + 4)
+    if max_in_flight is None:
+        max_in_flight = 2 * max_workers
+
+    fd = os.open(binary_filename,
+                 os.O_RDWR | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0))
+    # Pre-size the file so that chunks can be written in any order.
+    os.ftruncate(fd, N * c * itemsize)
+    write_lock = threading.Lock()
+
+    # Read one chunk and write it at its offset in the binary file.
+    def copy_chunk(i, j, k, offset):
         t = recording.get_traces(start_frame=i, end_frame=j, segment_index=k)
-        memmap[i:j,:] = t
-        memmap.flush()
-        del(t)
+        b = memoryview(np.ascontiguousarray(t, dtype=dtype)).cast('B')
+        _write_at(fd, b, offset * c * itemsize, write_lock)
+        return b.nbytes
 
-    y = np.memmap(binary_filename, dtype=dtype, mode='w+', shape=(N,c))
     total_chunks = len(indices)
     logger.info('='*40)
     logger.info(
         f'Converting {total_chunks} data chunks '
         f'with a chunksize of {chunksize} samples...'
         )
-    with ThreadPoolExecutor(max_workers=max_workers) as exe:
-        futures = [exe.submit(copy_chunk, y, i, j, k) for i, j, k in indices]
-        # TODO: every some-amount-of-time, check list of futures
-        #       for completion
-        while exe._work_queue.qsize() > 0:
-            time.sleep(10)
-            logger.info(
-                f'{total_chunks - exe._work_queue.qsize()} of {total_chunks}'
-                ' chunks converted...'
-                )
-    logger.info(f'Data conversion finished.')
+    tic = time.time()
+    last_log = tic
+    n_done = 0
+    bytes_done = 0
+    bytes_since_sync = 0
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as exe:
+            pending = set()
+            chunks = iter(indices)
+            while True:
+                # Keep at most `max_in_flight` chunks in memory at once.
+                for chunk in chunks:
+                    pending.add(exe.submit(copy_chunk, *chunk))
+                    if len(pending) >= max_in_flight:
+                        break
+                if len(pending) == 0:
+                    break
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for f in done:
+                    nbytes = f.result()
+                    n_done += 1
+                    bytes_done += nbytes
+                    bytes_since_sync += nbytes
+
+                if bytes_since_sync >= fsync_bytes:
+                    os.fsync(fd)
+                    bytes_since_sync = 0
+                if time.time() - last_log >= 10:
+                    last_log = time.time()
+                    rate = bytes_done / (last_log - tic) / 1e6
+                    logger.info(
+                        f'{n_done} of {total_chunks} chunks converted, '
+                        f'{bytes_done/1e9:.2f} GB at {rate:.1f} MB/s...'
+                        )
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+    elapsed = time.time() - tic
+    logger.info(f'Data conversion finished, {bytes_done/1e9:.2f} GB in '
+                f'{elapsed:.1f}s.')
     logger.info('='*40)
 
-    del(y)  # Close memmap after copying
 
     if export_probe:
         try:
@@ -1305,9 +3709,205 @@ def spikeinterface_to_binary(recording, filepath, data_name='data.bin',
     return binary_filename, N, c, s, fs, probe_filename
 
 
+class ChunkCache:
+    def __init__(self, read_chunk, n_chunks, max_chunks=8, n_readahead=1,
+                 n_workers=None):
+        """Thread-safe LRU cache of data chunks, with background read-ahead.
+
+        After each request for chunk `i`, reads for chunks `i+1` through
+        `i+n_readahead` are submitted to a thread pool if they are not already
+        cached. Concurrent requests for the same chunk share a single read,
+        and missing chunks requested together with `get_many` are read in
+        parallel.
+
+        Parameters
+        ----------
+        read_chunk : callable
+            `read_chunk(i)` returns the data for chunk `i`.
+        n_chunks : int
+            Total number of chunks.
+        max_chunks : int; default=8.
+            Maximum number of chunks kept in the cache. Up to `n_readahead`
+            additional chunks may be held by pending reads.
+        n_readahead : int; default=1.
+            Number of upcoming chunks to read in the background.
+        n_workers : int; optional.
+            Number of threads used for reading chunks. By default,
+            `n_readahead + 1` threads are used.
+
+        Attributes
+        ----------
+        n_hits : int
+            Number of requests for chunks that were already cached.
+        n_readahead_hits : int
+            Number of requests for chunks that were still being read in the
+            background. Finished background reads are moved into the cache,
+            so later requests for them count as `n_hits`.
+        n_misses : int
+            Number of requests that had to read the chunk synchronously.
+
+        """
+        self.read_chunk = read_chunk
+        self.n_chunks = n_chunks
+        self.max_chunks = max(1, max_chunks)
+        self.n_readahead = n_readahead
+        if n_workers is None:
+            n_workers = n_readahead + 1
+        self.n_workers = max(1, n_workers)
+        self._chunks = OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._executor = None
+
+        self.n_hits = 0
+        self.n_readahead_hits = 0
+        self.n_misses = 0
+
+    def get(self, ichunk):
+        """Get data for chunk `ichunk`, reading it if it is not cached."""
+        return self.get_many([ichunk])[0]
+
+    def get_many(self, ichunks):
+        """Get data for a list of chunks, reading missing chunks in parallel."""
+        requests = []
+        with self._lock:
+            for k in ichunks:
+                if k in self._chunks:
+                    self._chunks.move_to_end(k)
+                    self.n_hits += 1
+                    requests.append((k, self._chunks[k], None))
+                    continue
+                future = self._pending.get(k, None)
+                if future is None:
+                    self.n_misses += 1
+                    future = self._submit(k)
+                else:
+                    self.n_readahead_hits += 1
+                requests.append((k, None, future))
+            self._schedule(ichunks[-1])
+
+        chunks = []
+        for k, data, future in requests:
+            if future is not None:
+                try:
+                    data = future.result()
+                finally:
+                    with self._lock:
+                        self._pending.pop(k, None)
+                with self._lock:
+                    self._insert(k, data)
+            chunks.append(data)
+
+        return chunks
+
+    def _insert(self, ichunk, data):
+        self._chunks[ichunk] = data
+        self._chunks.move_to_end(ichunk)
+        while len(self._chunks) > self.max_chunks:
+            self._chunks.popitem(last=False)
+
+    def _submit(self, ichunk):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.n_workers)
+        future = self._executor.submit(self.read_chunk, ichunk)
+        self._pending[ichunk] = future
+        return future
+
+    def _schedule(self, ichunk):
+        # Move finished background reads into the cache, so that reads that
+        # are never requested don't hold memory outside of the budget.
+        for j, f in list(self._pending.items()):
+            if j != ichunk and f.done():
+                self._pending.pop(j)
+                if not f.cancelled() and f.exception() is None:
+                    self._insert(j, f.result())
+        for j in range(ichunk+1, min(ichunk+1+self.n_readahead, self.n_chunks)):
+            if j not in self._chunks and j not in self._pending:
+                self._submit(j)
+
+    def stats(self):
+        """Summarize cache performance as a dictionary."""
+        n_requests = self.n_hits + self.n_readahead_hits + self.n_misses
+        return {
+            'n_requests': n_requests,
+            'n_hits': self.n_hits,
+            'n_readahead_hits': self.n_readahead_hits,
+            'n_misses': self.n_misses,
+            'hit_rate': (n_requests - self.n_misses) / max(n_requests, 1),
+            'n_cached': len(self._chunks),
+        }
+
+    def clear(self):
+        """Drop all cached chunks."""
+        with self._lock:
+            self._chunks.clear()
+
+    def close(self):
+        """Cancel pending reads and shut down the thread pool.
+
+        Cached chunks are kept, and the thread pool is restarted if more
+        chunks are requested.
+
+        """
+        with self._lock:
+            for f in self._pending.values():
+                f.cancel()
+            self._pending.clear()
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+
+def _parse_array_index(items, shape):
+    """Convert `__getitem__` arguments to a sample range and channel indices.
+
+    Returns
+    -------
+    i, j : int
+        First and last (exclusive) sample, bounded by the number of samples.
+    channel_ids : list or np.ndarray
+        Channel indices starting from 0.
+
+    """
+    N, C = shape
+    idx, *crop = items
+    if not isinstance(idx, tuple): idx = tuple([idx])
+    sample_idx = idx[0]
+    channel_ids = None if len(idx) == 1 else idx[1]
+
+    # Convert integer index to slice and convert NoneTypes to boundaries of
+    # data, and convert negative indices to positive indices.
+    if not isinstance(sample_idx, slice):
+        sample_idx = slice(sample_idx, sample_idx+1)
+    i = sample_idx.start
+    j = sample_idx.stop
+
+    if i is None: i = 0
+    if i < 0: i = N + i
+    if j is None: j = N
+    if j < 0: j = N + j
+    j = min(j, N)
+
+    # Convert channel slice to list of indices starting from 0
+    if isinstance(channel_ids, slice):
+        c = channel_ids.start
+        d = channel_ids.stop
+        if c is None: c = 0
+        if d is None: d = C
+        channel_ids = list(range(c, d))
+    elif channel_ids is not None:
+        assert isinstance(channel_ids, int)
+        channel_ids = [channel_ids]
+    else:
+        channel_ids = np.arange(C)
+
+    return i, j, channel_ids
+
+
 class RecordingExtractorAsArray:
 
-    def __init__(self, recording_extractor):
+    def __init__(self, recording_extractor, chunk_size=60000,
+                 cache_memory=0, n_readahead=0):
         """An array-like wrapper for a RecordingExtractor.
 
         This class is provided to assist with loading data from other file 
@@ -1324,11 +3924,27 @@ class RecordingExtractorAsArray:
             A SpikeInterface recording extractor. When the wrapper object is
             indexed, `recording_extractor.get_traces()` will be invoked to
             retrieve data from disk.
+        chunk_size : int; default=60000.
+            Number of samples in each cached chunk. Setting this to the
+            `batch_size` used for sorting aligns chunks with batches, so that
+            the padding shared by neighboring batches is only read once.
+        cache_memory : int; default=0.
+            Maximum number of bytes used for cached chunks. By default, caching
+            is disabled and data is read directly from the recording for
+            every index.
+        n_readahead : int; default=0.
+            Number of chunks after the most recently requested one to read
+            in background threads, if caching is enabled. Only use this with
+            extractors that support concurrent calls to `get_traces`, which
+            many do not. With the default of 0, all reads happen one at a time.
 
         Attributes
         ----------
         shape
         dtype
+        cache : ChunkCache or None
+            Cache of recently read chunks. See `ChunkCache.stats` for hit/miss
+            statistics.
 
         Examples
         --------
@@ -1375,38 +3991,24 @@ class RecordingExtractorAsArray:
         logger.info(f'dtype: {self.dtype}')
         self.shape = (self.N, self.c)
         logger.info('='*40)
+
+        self.chunk_size = chunk_size
+        chunk_bytes = chunk_size * self.c * np.dtype(self.dtype).itemsize
+        max_chunks = int(cache_memory // chunk_bytes)
+        if max_chunks > 0:
+            n_chunks = int(np.ceil(self.N / chunk_size))
+            self.cache = ChunkCache(self._read_chunk, n_chunks, max_chunks,
+                                    n_readahead=n_readahead)
+        else:
+            self.cache = None
     
 
     def __getitem__(self, *items):
-        idx, *crop = items
-        if not isinstance(idx, tuple): idx = tuple([idx])
-        sample_idx = idx[0]
-        channel_ids = None if len(idx) == 1 else idx[1]
+        i, j, channel_ids = _parse_array_index(items, self.shape)
 
-        # Convert integer index to slice and convert NoneTypes to boundaries of
-        # data, and convert negative indices to positive indices.
-        if not isinstance(sample_idx, slice):
-            sample_idx = slice(sample_idx, sample_idx+1)
-        i = sample_idx.start
-        j = sample_idx.stop
+        if self.cache is not None:
+            return self._get_cached(i, j, channel_ids)
 
-        if i is None: i = 0
-        if i < 0: i = self.N + i
-        if j is None: j = self.N
-        if j < 0: j = self.N + j
-
-        # Convert channel slice to list of indices starting from 0
-        if isinstance(channel_ids, slice):
-            c = channel_ids.start
-            d = channel_ids.stop
-            if c is None: c = 0
-            if d is None: d = self.shape[1]
-            channel_ids = list(range(c, d))
-        elif channel_ids is not None:
-            assert isinstance(channel_ids, int)
-            channel_ids = [channel_ids]
-        else:
-            channel_ids = np.arange(self.shape[1])
         # Index into actual channel ids from recording, which do not have to 
         # be sequential or start from 0
         channel_ids = self.recording.channel_ids[channel_ids]
@@ -1416,5 +4018,274 @@ class RecordingExtractorAsArray:
         
         return samples
 
+    def _read_chunk(self, ichunk):
+        i = ichunk * self.chunk_size
+        j = min(i + self.chunk_size, self.N)
+        return self.recording.get_traces(start_frame=i, end_frame=j)
+
+    def _get_cached(self, i, j, channel_ids):
+        if j <= i:
+            return np.zeros((0, len(channel_ids)), dtype=self.dtype)
+        i0 = i // self.chunk_size
+        i1 = (j - 1) // self.chunk_size
+        chunks = self.cache.get_many(list(range(i0, i1+1)))
+        offset = i - i0*self.chunk_size
+        if len(chunks) == 1:
+            samples = chunks[0][offset : offset + (j-i)]
+        else:
+            samples = np.concatenate(chunks, axis=0)[offset : offset + (j-i)]
+        # Fancy indexing copies the data, so cached chunks can't be modified.
+        return samples[:, channel_ids]
+
+    def close(self):
+        """Stop background reads, if any are running."""
+        if self.cache is not None:
+            self.cache.close()
+
+
     def __setitem__(self):
         raise ValueError('RecordingExtractorAsBinary is read-only.')
+
+
+class ChunkedRecording:
+
+    def __init__(self, chunk_bounds, n_channels, dtype, cache_memory=2**30,
+                 n_readahead=2, n_workers=None):
+        """Base class for array-like recordings stored in compressed chunks.
+
+        Subclasses implement `_read_chunk(i)`, which returns the decompressed
+        data for chunk `i` with shape (n_samples, n_channels). Indexing reads
+        all chunks that overlap the requested samples, decompressing missing
+        chunks in parallel, and keeps recently used chunks in an LRU cache.
+        During sequential passes, upcoming chunks are decompressed in the
+        background. See `ChunkCache`.
+
+        Parameters
+        ----------
+        chunk_bounds : array-like of int
+            Sample index of the start of each chunk, followed by the total
+            number of samples.
+        n_channels : int
+            Number of channels in the recording.
+        dtype : str or np.dtype
+            Data type of decompressed samples.
+        cache_memory : int; default=2**30.
+            Maximum number of bytes used for cached chunks. The cache always
+            holds at least enough chunks for one batch, see `set_batch_size`.
+        n_readahead : int; default=2.
+            Number of chunks after the most recently requested one to
+            decompress in background threads.
+        n_workers : int; optional.
+            Number of threads used for decompression. By default, one thread
+            per CPU is used, up to 8.
+
+        Attributes
+        ----------
+        shape
+        dtype
+        cache : ChunkCache
+            Cache of decompressed chunks. See `ChunkCache.stats` for hit/miss
+            statistics.
+
+        """
+        self.chunk_bounds = np.asarray(chunk_bounds, dtype=np.int64)
+        self.n_chunks = self.chunk_bounds.size - 1
+        self.N = int(self.chunk_bounds[-1])
+        self.c = n_channels
+        self.dtype = np.dtype(dtype)
+        self.shape = (self.N, self.c)
+        self.cache_memory = cache_memory
+        self.n_readahead = n_readahead
+        if n_workers is None:
+            n_workers = min(os.cpu_count() or 1, 8)
+        self.n_workers = n_workers
+        self.cache = None
+        self._make_cache(min_chunks=1, n_readahead=n_readahead)
+
+    def _make_cache(self, min_chunks, n_readahead):
+        if self.cache is not None:
+            self.cache.close()
+        chunk_bytes = np.diff(self.chunk_bounds).max() * self.c \
+                      * self.dtype.itemsize
+        max_chunks = max(int(self.cache_memory // chunk_bytes), min_chunks)
+        self.cache = ChunkCache(
+            self._read_chunk, self.n_chunks, max_chunks,
+            n_readahead=n_readahead,
+            n_workers=max(self.n_workers, n_readahead + 1)
+            )
+
+    def set_batch_size(self, batch_size):
+        """Align cache size and read-ahead to batches of `batch_size` samples.
+
+        The cache is resized to hold every chunk spanned by two neighboring
+        batches, so that the padding shared by those batches is only
+        decompressed once, and read-ahead covers at least one full batch.
+
+        Parameters
+        ----------
+        batch_size : int
+            Number of samples read for each batch, including padding
+            (typically `NT + 2*nt`).
+
+        """
+        chunk_size = int(np.diff(self.chunk_bounds).min())
+        chunks_per_batch = int(np.ceil(batch_size / chunk_size)) + 1
+        n_readahead = max(self.n_readahead, chunks_per_batch)
+        self._make_cache(2*chunks_per_batch + n_readahead, n_readahead)
+
+    def _read_chunk(self, ichunk):
+        raise NotImplementedError
+
+    def __getitem__(self, *items):
+        i, j, channel_ids = _parse_array_index(items, self.shape)
+        if j <= i:
+            return np.zeros((0, len(channel_ids)), dtype=self.dtype)
+
+        i0 = np.searchsorted(self.chunk_bounds, i, side='right') - 1
+        i1 = np.searchsorted(self.chunk_bounds, j - 1, side='right') - 1
+        chunks = self.cache.get_many(list(range(i0, i1+1)))
+        offset = i - self.chunk_bounds[i0]
+        if len(chunks) == 1:
+            samples = chunks[0][offset : offset + (j-i)]
+        else:
+            samples = np.concatenate(chunks, axis=0)[offset : offset + (j-i)]
+        # Fancy indexing copies the data, so cached chunks can't be modified.
+        return samples[:, channel_ids]
+
+    def close(self):
+        """Stop background decompression, if any is running."""
+        self.cache.close()
+
+
+class MtscompRecording(ChunkedRecording):
+
+    def __init__(self, filename, ch_file=None, **kwargs):
+        """Array-like reader for recordings compressed with mtscomp (.cbin).
+
+        Chunks are located with the chunk index stored in the accompanying
+        .ch file, so that any range of samples can be read without
+        decompressing the rest of the recording. Only the 'zlib' algorithm
+        used by mtscomp is supported, and mtscomp itself is not required.
+
+        Parameters
+        ----------
+        filename : str or pathlib.Path
+            Path to the compressed .cbin file.
+        ch_file : str or pathlib.Path; optional.
+            Path to the .ch metadata file. By default, the .cbin path with a
+            .ch suffix is used.
+        kwargs : dict
+            Keyword arguments for `ChunkedRecording`.
+
+        """
+        self.filename = Path(filename)
+        if ch_file is None:
+            ch_file = self.filename.with_suffix('.ch')
+        with open(ch_file, 'r') as f:
+            meta = json.load(f)
+        if meta.get('algorithm', 'zlib') != 'zlib':
+            raise ValueError(
+                f"Unsupported mtscomp algorithm '{meta['algorithm']}', "
+                "only 'zlib' is supported."
+                )
+
+        self.fs = meta['sample_rate']
+        self.chunk_offsets = np.asarray(meta['chunk_offsets'], dtype=np.int64)
+        self.do_time_diff = meta.get('do_time_diff', True)
+        self.do_spatial_diff = meta.get('do_spatial_diff', False)
+        self.chunk_order = meta.get('chunk_order', 'F')
+        if self.chunk_order not in ['C', 'F']:
+            raise ValueError(
+                f"Unsupported mtscomp chunk_order '{self.chunk_order}', "
+                "expected 'C' or 'F'."
+                )
+        self._file = open(self.filename, 'rb')
+        self._file_lock = threading.Lock()
+        super().__init__(meta['chunk_bounds'], meta['n_channels'],
+                         meta['dtype'], **kwargs)
+
+        logger.info(f'Opened compressed recording {self.filename} with '
+                    f'{self.n_chunks} chunks, shape {self.shape}.')
+
+    def _read_compressed(self, ichunk):
+        start = self.chunk_offsets[ichunk]
+        n_bytes = self.chunk_offsets[ichunk+1] - start
+        if hasattr(os, 'pread'):
+            return os.pread(self._file.fileno(), n_bytes, start)
+        with self._file_lock:
+            self._file.seek(start)
+            return self._file.read(n_bytes)
+
+    def _read_chunk(self, ichunk):
+        # zlib releases the GIL, so chunks are decompressed in parallel.
+        buffer = zlib.decompress(self._read_compressed(ichunk))
+        chunk = np.frombuffer(buffer, dtype=self.dtype)
+        n_samples = self.chunk_bounds[ichunk+1] - self.chunk_bounds[ichunk]
+        chunk = chunk.reshape((n_samples, self.c), order=self.chunk_order)
+        if self.do_spatial_diff:
+            chunk = np.cumsum(chunk, axis=1, dtype=self.dtype)
+        if self.do_time_diff:
+            chunk = np.cumsum(chunk, axis=0, dtype=self.dtype)
+        return np.ascontiguousarray(chunk)
+
+    def close(self):
+        """Stop background decompression and close the compressed file."""
+        super().close()
+        if not self._file.closed:
+            self._file.close()
+
+
+class ChunkedArrayRecording(ChunkedRecording):
+
+    def __init__(self, array, **kwargs):
+        """Array-like reader for chunked HDF5 datasets or Zarr arrays.
+
+        Reads are aligned to the storage chunks of `array` along the sample
+        axis, so that each chunk is only decompressed once while it is cached.
+        Zarr decompresses chunks in parallel threads, while h5py serializes
+        reads internally but still benefits from caching and read-ahead.
+
+        Parameters
+        ----------
+        array : h5py.Dataset or zarr.Array
+            Chunked array with shape (n_samples, n_channels).
+        kwargs : dict
+            Keyword arguments for `ChunkedRecording`.
+
+        """
+        chunks = getattr(array, 'chunks', None)
+        if chunks is None:
+            raise ValueError('`array` is not chunked, pass it to BinaryRWFile '
+                             'as `file_object` instead.')
+        n_samples, n_channels = array.shape
+        chunk_bounds = np.append(np.arange(0, n_samples, chunks[0]), n_samples)
+        self.array = array
+        super().__init__(chunk_bounds, n_channels, array.dtype, **kwargs)
+
+    def _read_chunk(self, ichunk):
+        i, j = self.chunk_bounds[ichunk], self.chunk_bounds[ichunk+1]
+        return np.asarray(self.array[i:j])
+
+
+def open_compressed_recording(filename, **kwargs):
+    """Open a compressed recording, or return None if format isn't supported.
+
+    Currently supports mtscomp (.cbin) files. Chunked HDF5 datasets or Zarr
+    arrays can be wrapped with `ChunkedArrayRecording` and passed to
+    `BinaryRWFile` as `file_object`.
+
+    Parameters
+    ----------
+    filename : str or pathlib.Path
+        Path to the compressed recording.
+    kwargs : dict
+        Keyword arguments for the matching `ChunkedRecording` subclass.
+
+    Returns
+    -------
+    ChunkedRecording or None
+
+    """
+    if Path(filename).suffix == '.cbin':
+        return MtscompRecording(filename, **kwargs)
+    return None
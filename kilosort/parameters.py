@@ -140,6 +140,48 @@ EXTRA_PARAMETERS = {
             """
     },
 
+    'prefetch_batches': {
+        'gui_name': 'prefetch batches', 'type': int, 'min': 0, 'max': np.inf,
+        'exclude': [], 'default': 0, 'step': 'data',
+        'description':
+            """
+            Number of upcoming batches to read from disk in background threads
+            while the current batch is processed. This can speed up sorting
+            when reading data is slow, like for files on network storage, at
+            the cost of keeping this many extra batches in memory. A value of
+            0 disables prefetching.
+            """
+    },
+
+    'torch_compile': {
+        'gui_name': 'torch compile', 'type': bool, 'min': None, 'max': None,
+        'exclude': [], 'default': False, 'step': 'data',
+        'description':
+            """
+            If True, use `torch.compile` to fuse the elementwise steps of
+            preprocessing and the inner loops of spike detection and template
+            matching, which reduces memory allocations and can be faster,
+            especially on CPU. Compiled kernels are cached in the Kilosort
+            downloads directory, so compilation time is mostly paid on the
+            first run. If compilation fails, the usual (eager) code is used.
+            """
+    },
+
+    'sequential_io': {
+        'gui_name': 'sequential io', 'type': bool, 'min': None, 'max': None,
+        'exclude': [], 'default': False, 'step': 'data',
+        'description':
+            """
+            If True, read batches from the binary file with explicit reads
+            instead of memory-mapping, and tell the operating system which
+            batches will be read next and which can be dropped from the page
+            cache. This can speed up reading very large files and avoids filling
+            the page cache with data that won't be reused. Only supported for
+            single binary files on Linux and other platforms with
+            posix_fadvise; otherwise memory-mapping is used.
+            """
+    },
+
     ### PREPROCESSING
     'artifact_threshold': {
         'gui_name': 'artifact threshold', 'type': float, 'min': 0, 'max': np.inf,
@@ -211,6 +253,93 @@ EXTRA_PARAMETERS = {
             """
     },
 
+    'drift_matrix_memory': {
+        'gui_name': 'drift matrix memory', 'type': float, 'min': 0,
+        'max': np.inf, 'exclude': [], 'default': 0, 'step': 'preprocessing',
+        'description':
+            """
+            Memory (in GB) for caching the combined drift-correction and
+            whitening matrix of each batch. Matrices are computed once after
+            drift estimation, and re-used by every later pass over the data.
+            Batches that don't fit are computed when loaded, as before. Cached
+            matrices are stored on the same device used for sorting, so this
+            memory is in use (on the GPU, if there is one) until sorting
+            finishes. Default is 0, which disables the cache.
+            """
+    },
+
+    'drift_quantization': {
+        'gui_name': 'drift quantization', 'type': float, 'min': 0,
+        'max': np.inf, 'exclude': [], 'default': 0, 'step': 'preprocessing',
+        'description':
+            """
+            If greater than 0, estimated drift is rounded to a multiple of this
+            value (in microns) when building drift-correction matrices, so that
+            batches with nearly identical drift share one matrix. This reduces
+            the memory needed by the drift matrix cache, at the cost of small
+            errors in drift correction. Default is 0 (no rounding).
+            """
+    },
+
+    'drift_only_detection': {
+        'gui_name': 'drift-only detection', 'type': bool, 'min': None,
+        'max': None, 'exclude': [], 'default': False, 'step': 'preprocessing',
+        'description':
+            """
+            If True, the spike detection pass used to estimate drift skips PC
+            feature extraction and bins spikes by depth and amplitude as each
+            batch is detected, instead of storing all detected spikes. This
+            greatly reduces memory use for long recordings. The drift scatter
+            plot is not generated in this mode, since it needs the stored
+            spikes. Estimated drift is unchanged.
+            """
+    },
+
+    'sparse_preprocessing': {
+        'gui_name': 'sparse preprocessing', 'type': bool, 'min': None,
+        'max': None, 'exclude': [], 'default': False, 'step': 'preprocessing',
+        'description':
+            """
+            If True, whitening and drift-correction matrices are applied as
+            sparse or per-shank block matrices when most of their entries are
+            zero, instead of as dense matrices. This is faster for probes with
+            many channels or multiple shanks, and falls back to dense matrices
+            when they are not sparse enough to benefit. Drift-correction
+            matrices are only applied sparsely when they are cached, which
+            requires `drift_matrix_memory > 0`.
+            """
+    },
+
+    'car_mode': {
+        'gui_name': 'CAR mode', 'type': str, 'min': None, 'max': None,
+        'exclude': [], 'default': 'median', 'step': 'preprocessing',
+        'description':
+            """
+            Reference subtracted from each time sample when common average
+            referencing is enabled. 'median' (default) subtracts the median
+            across all channels, and 'mean' subtracts the mean, which is faster
+            but more sensitive to outliers. 'shank_median' and 'shank_mean'
+            compute a separate reference for each shank, using the probe's
+            'kcoords'.
+            """
+    },
+
+    'preprocessed_cache': {
+        'gui_name': 'preprocessed cache', 'type': str, 'min': None, 'max': None,
+        'exclude': [], 'default': None, 'step': 'preprocessing',
+        'description':
+            """
+            If 'float16' or 'int16', filtered and whitened batches are saved
+            to a scratch file in the results directory the first time they are
+            loaded, and re-used by later passes over the data (drift
+            estimation, spike detection and template matching) so that
+            filtering only happens once. Requires disk space of about
+            2 bytes per sample per channel, and introduces a small rounding
+            error. The cache is re-used between runs with identical data and
+            preprocessing settings. Default is None, which disables the cache.
+            """
+    },
+
 
     ### SPIKE DETECTION
     # NOTE: if left as None, will be set to `int(20 * settings['nt']/61)`
@@ -328,6 +457,23 @@ EXTRA_PARAMETERS = {
             """
     },
 
+    'score_dtype': {
+        'gui_name': 'score dtype', 'type': str, 'min': None, 'max': None,
+        'exclude': [], 'default': 'float32', 'step': 'spike detection',
+        'description':
+            """
+            Data type used to store the per-batch universal template scores
+            during spike detection, either 'float32' (default), 'bfloat16' or
+            'float16'. Scores are still computed and compared in float32, so
+            reduced precision only affects storage, which halves the memory
+            used by these arrays. Template matching with the final clusters
+            and preprocessed batches always use float32. This is experimental
+            and can slightly change which spikes are detected; use
+            `kilosort.bench.compare_precision` to check the effect on a
+            representative recording.
+            """
+    },
+
     'n_pcs': {
         'gui_name': 'n pcs', 'type': int, 'min': 1, 'max': np.inf,
         'exclude': [], 'default': 6, 'step': 'spike detection',
@@ -348,6 +494,22 @@ EXTRA_PARAMETERS = {
             """
     },
 
+    'spike_buffer_memory': {
+        'gui_name': 'spike buffer memory', 'type': float, 'min': 0, 'max': np.inf,
+        'exclude': [0], 'default': np.inf, 'step': 'spike detection',
+        'description':
+            """
+            Maximum memory in GB used to hold spike times and PC features
+            while detecting and extracting spikes. Once this is exceeded, older
+            spikes are written to scratch files in the results directory
+            ('st_spill.dat', 'tF_spill_sorted.dat', etc.), and the PC features
+            returned by `run_kilosort` are memory-mapped from those files.
+            Scratch files are deleted once results have been saved.
+            Set this for long recordings with many spikes if sorting runs out
+            of system memory. Default is no limit.
+            """
+    },
+
 
     ### CLUSTERING
     'acg_threshold': {
@@ -453,6 +615,21 @@ EXTRA_PARAMETERS = {
             after sorting is complete.
             """
     },
+
+    'results_format': {
+        'gui_name': 'results format', 'type': str, 'min': None, 'max': None,
+        'exclude': [], 'default': 'phy', 'step': 'postprocessing',
+        'description':
+            """
+            Format used to save sorting results. 'phy' saves a separate .npy
+            file for each variable, as expected by Phy. 'container' saves
+            spike and cluster variables in a single chunked file,
+            'sorting.ks4', which can be loaded lazily with
+            `load_sorting(..., lazy=True)`. Phy files can be generated from
+            the container later with `kilosort.io.container_to_phy`. 'both'
+            saves both formats.
+            """
+    },
 }
 
 # Add default values to descriptions
@@ -3,6 +3,7 @@ import matplotlib.pyplot as plt
 import numpy as np
 import torch
 
+from kilosort.io import load_result
 from kilosort.postprocessing import compute_spike_positions
 
 
@@ -143,7 +144,7 @@ def plot_spike_positions(clu, is_refractory, results_dir):
         colors[subset] = rgba
 
     # Get x, y positions, add to scatterplot
-    positions = np.load(results_dir / 'spike_positions.npy')
+    positions = load_result(results_dir, 'spike_positions')
     xs, ys = positions[:,0], positions[:,1]
     ax.scatter(ys, xs, s=3, c=colors)
     ax.set_xlabel('Depth (um)', fontsize=22)
@@ -54,10 +54,11 @@ def compute_spike_positions(st, tF, ops):
     return xs, ys
 
 
-def make_pc_features(ops, spike_templates, spike_clusters, tF):
+def make_pc_features(ops, spike_templates, spike_clusters, tF,
+                     kept_spikes=None, out=None, chunk_size=2**18):
     '''Get PC Features and corresponding indices for export to Phy.
 
-    NOTE: This function will update tF in-place!
+    NOTE: If `out` is not specified, this function will update tF in-place!
 
     Parameters
     ----------
@@ -74,29 +75,55 @@ def make_pc_features(ops, spike_templates, spike_clusters, tF):
     tF : torch.Tensor
         Tensor of pc features as returned by `template_matching.extract`,
         with shape `(n_spikes, nearest_chans, n_pcs)`.
+    kept_spikes : np.ndarray; optional.
+        Boolean mask with shape `(n_spikes,)`. If specified, features are only
+        computed for spikes where the mask is True, as if the other spikes had
+        been removed from all inputs. Only used if `out` is specified.
+    out : array-like; optional.
+        Array with shape `(n_kept_spikes, n_pcs, nearest_chans)`, like a
+        memmap opened with `np.lib.format.open_memmap`. If specified, features
+        are written to `out` a chunk of spikes at a time and tF is not
+        modified, so that the features never need to fit in memory twice.
+    chunk_size : int; default=2**18.
+        Number of spikes copied to `out` at a time.
 
     Returns
     -------
-    tF : torch.Tensor
+    tF : torch.Tensor or array-like
         As above, but with some data replaced so that features are associated 
         with the final clusters instead of templates. The second and third
         dimensions are also swapped to conform to the shape expected by Phy.
+        If `out` is specified, `out` is returned instead.
     feature_ind : np.ndarray
         Channel indices associated with the data present in tF for each cluster,
         with shape `(n_clusters, nearest_chans)`.
     
     '''
 
+    if out is None or kept_spikes is None:
+        kept_spikes = np.ones(spike_clusters.shape[0], dtype=bool)
+    if out is not None:
+        # Copy features for kept spikes, in the order expected by Phy.
+        kept_idx = np.nonzero(kept_spikes)[0]
+        for i in range(0, kept_idx.size, chunk_size):
+            idx = torch.from_numpy(kept_idx[i:i+chunk_size])
+            out[i:i+idx.numel()] = torch.permute(tF[idx], (0, 2, 1)).cpu().numpy()
+        # Maps indices of all spikes to indices of kept spikes.
+        kept_index = np.cumsum(kept_spikes) - 1
+    kept_mask = torch.from_numpy(kept_spikes)
+
     # xy: template centers, iC: channels associated with each template
     xy, iC = xy_templates(ops)
     n_templates = iC.shape[1]
-    n_clusters = np.unique(spike_clusters).size
+    clusters = np.unique(spike_clusters[kept_spikes])
+    n_clusters = clusters.size
     n_chans = ops['nearest_chans']
     feature_ind = np.zeros((n_clusters, n_chans), dtype=np.uint32)
 
-    for i in np.unique(spike_clusters):
+    for i in clusters:
         # Get templates associated with cluster (often just 1)
-        iunq = np.unique(spike_templates[spike_clusters==i]).astype(int)
+        in_cluster = np.logical_and(spike_clusters == i, kept_spikes)
+        iunq = np.unique(spike_templates[in_cluster]).astype(int)
         # Get boolean mask with size (n_templates,), True if they match cluster
         ix = torch.from_numpy(np.zeros(n_templates, bool))
         ix[iunq] = True
@@ -106,16 +133,25 @@ def make_pc_features(ops, spike_templates, spike_clusters, tF):
             ops, xy, iC, spike_templates, tF, None, None,
             dmin=ops['dmin'], dminx=ops['dminx'], ix=ix, merge_dim=False
             )
+        keep = kept_mask[igood]
+        Xd, igood = Xd[keep], igood[keep]
 
         # Take mean of features across spikes, find channels w/ largest norm
         spike_mean = Xd.mean(0)
         chan_norm = torch.linalg.norm(spike_mean, dim=1)
         sorted_chans, ind = torch.sort(chan_norm, descending=True)
-        # Assign features to overwrite tF in-place
-        tF[igood,:] = Xd[:, ind[:n_chans], :]
+        if out is None:
+            # Assign features to overwrite tF in-place
+            tF[igood,:] = Xd[:, ind[:n_chans], :]
+        else:
+            features = torch.permute(Xd[:, ind[:n_chans], :], (0, 2, 1))
+            out[kept_index[igood.numpy()]] = features.cpu().numpy()
         # Save channel inds for phy
         feature_ind[i,:] = ichan[ind[:n_chans]].cpu().numpy()
 
+    if out is not None:
+        return out, feature_ind
+
     # Swap last 2 dimensions to get ordering Phy expects
     tF = torch.permute(tF, (0, 2, 1))
 
@@ -1,4 +1,7 @@
+import functools
 import torch, os, scipy
+import scipy.fft
+import scipy.sparse
 import numpy as np
 from scipy.signal import butter, filtfilt
 from scipy.interpolate import interp1d
@@ -16,22 +19,66 @@ def whitening_from_covariance(CC):
     Wrot =(E / (D+eps)**.5) @ E.T
     return Wrot
 
-def whitening_local(CC, xc, yc, nrange=32, device=torch.device('cuda')):
-    """Compute whitening filter for each channel based on nearest channels."""
-    Nchan = CC.shape[0]
-    Wrot = torch.zeros((Nchan,Nchan), device = device)
+def get_neighbor_index(xc, yc, nrange=32):
+    """Indices of the `nrange` nearest channels to each channel.
+
+    Returns an array with shape (n_channels, min(nrange, n_channels)), sorted
+    by distance so that the first column is the channel itself. The result
+    only depends on probe geometry, so it is cached for repeated calls.
+
+    """
+    # Coordinates keep their dtype so that ties in distance are broken in the
+    # same order as sorting each channel's distances separately.
+    xc = np.ascontiguousarray(xc)
+    yc = np.ascontiguousarray(yc)
+    return _neighbor_index(
+        xc.tobytes(), yc.tobytes(), xc.dtype.str, yc.dtype.str, nrange
+        ).copy()
 
-    # for each channel, a local covariance matrix is extracted
-    # the whitening matrix is computed for that local neighborhood
-    for j in range(CC.shape[0]):
-        ds = (xc[j] - xc)**2 + (yc[j] - yc)**2
-        isort = np.argsort(ds)
-        ix = isort[:nrange]
+@functools.lru_cache(maxsize=8)
+def _neighbor_index(xc_bytes, yc_bytes, xc_dtype, yc_dtype, nrange,
+                    chunk_size=1024):
+    xc = np.frombuffer(xc_bytes, dtype=xc_dtype)
+    yc = np.frombuffer(yc_bytes, dtype=yc_dtype)
+    Nchan = xc.size
+    nrange = min(nrange, Nchan)
+    ix = np.zeros((Nchan, nrange), dtype=np.int64)
+    # Distances are computed for a chunk of channels at a time to limit memory
+    # use for probes with thousands of channels.
+    for j in range(0, Nchan, chunk_size):
+        ds = ((xc[j:j+chunk_size, np.newaxis] - xc)**2
+              + (yc[j:j+chunk_size, np.newaxis] - yc)**2)
+        ix[j:j+chunk_size] = np.argsort(ds, axis=1)[:, :nrange]
+    return ix
 
-        wrot = whitening_from_covariance(CC[np.ix_(ix, ix)])
+def whitening_local(CC, xc, yc, nrange=32, device=torch.device('cuda'),
+                    ix=None):
+    """Compute whitening filter for each channel based on nearest channels.
+
+    The local covariance blocks for all channels are whitened at once with a
+    batched eigendecomposition. `ix` can be used to pass a neighbor index
+    from `get_neighbor_index`, otherwise it's computed from `xc` and `yc`.
+
+    """
+    Nchan = CC.shape[0]
+    Wrot = torch.zeros((Nchan,Nchan), device = device)
+    if ix is None:
+        ix = get_neighbor_index(xc, yc, nrange=nrange)
+    ix = torch.as_tensor(ix, device=CC.device)
 
-        # the first row of wrot is a whitening vector for the center channel
-        Wrot[j, ix] = wrot[0]
+    # for each channel, a local covariance matrix is extracted, with shape
+    # (Nchan, nrange, nrange)
+    CCloc = CC[ix[:, :, None], ix[:, None, :]]
+    # CC is symmetric positive semi-definite, so this matches the SVD used
+    # in `whitening_from_covariance`.
+    D, E = torch.linalg.eigh(CCloc)
+    eps = 1e-6
+    D = D.clamp(min=0)
+    # the first row of each local whitening matrix is a whitening vector for
+    # the center channel: (E / (D+eps)**.5) @ E.T, row 0 only.
+    wrot = torch.einsum('nk,njk->nj', E[:, 0, :] / (D + eps)**.5, E)
+    rows = torch.arange(Nchan, device=CC.device)[:, None]
+    Wrot[rows.to(device), ix.to(device)] = wrot.to(device, Wrot.dtype)
     return Wrot
 
 def kernel2D_torch(x, y, sig = 1):
@@ -69,6 +116,45 @@ def get_drift_matrix(ops, dshift, device=torch.device('cuda')):
     return M
 
 
+def get_drift_matrices(ops, dshifts, device=torch.device('cuda')):
+    """Same as `get_drift_matrix`, for many drifts at once.
+
+    `dshifts` has shape (n, nblocks), and the returned tensor has shape
+    (n, n_channels, n_channels), with `M[i]` equal to
+    `get_drift_matrix(ops, dshifts[i])`.
+
+    """
+    if isinstance(dshifts, torch.Tensor):
+        dshifts = dshifts.cpu().numpy()
+    dshifts = np.asarray(dshifts)
+
+    # first, interpolate drifts to every channel
+    yblk = ops['yblk']
+    if ops['nblocks'] == 1:
+        shifts = dshifts[:, :1]
+    else:
+        finterp = interp1d(yblk, dshifts, axis=1, fill_value="extrapolate",
+                           kind = 'linear')
+        shifts = finterp(ops['probe']['yc'])
+
+    # compute coordinates of desired interpolation
+    xp = np.vstack((ops['probe']['xc'],ops['probe']['yc'])).T
+    yp = np.repeat(xp[np.newaxis], dshifts.shape[0], axis=0)
+    yp[:,:,1] -= shifts
+
+    xp = torch.from_numpy(xp).to(device)
+    yp = torch.from_numpy(yp).to(device)
+
+    # the kernel is radial symmetric based on distance
+    ds = ((yp.unsqueeze(2) - xp)**2).sum(-1)
+    Kyx = torch.exp(-ds / (2*ops['settings']['sig_interp']**2))
+
+    # multiply with precomputed inverse kernel matrix of original channels
+    M = Kyx @ ops['iKxx']
+
+    return M
+
+
 def get_fwav(NT = 30122, fs = 30000, device=torch.device('cuda')):
     """Precomputes a filter to use for high-pass filtering.
     
@@ -93,6 +179,180 @@ def get_fwav(NT = 30122, fs = 30000, device=torch.device('cuda')):
 
     return fwav
 
+def center_channels(X, invert_sign=False):
+    """Optionally invert `X`, then subtract the mean of each channel (row).
+
+    Kept separate from the rest of preprocessing so that these elementwise
+    steps can be fused into one kernel by `kilosort.utils.compiled`.
+
+    """
+    if invert_sign:
+        X = X * -1
+    return X - X.mean(1).unsqueeze(1)
+
+
+def exceeds_threshold(X, threshold):
+    """True if any absolute value in `X` is at least `threshold`."""
+    return torch.any(torch.abs(X) >= threshold)
+
+
+def channel_median(X, block_size=4096):
+    """Median across channels (dim 0) of `X`, same as `torch.median(X, 0)`.
+
+    For an even number of channels this is the lower of the two middle
+    values, like `torch.median`. On CPU, the median is selected with
+    `torch.kthvalue` on contiguous blocks of time samples, which avoids
+    strided access across channels.
+
+    """
+    if X.device.type != 'cpu':
+        return torch.median(X, 0)[0]
+    k = (X.shape[0] + 1) // 2
+    med = torch.empty(X.shape[1], dtype=X.dtype)
+    for t in range(0, X.shape[1], block_size):
+        Xb = X[:, t:t+block_size].T.contiguous()
+        med[t:t+block_size] = torch.kthvalue(Xb, k, dim=1)[0]
+    return med
+
+
+class CommonReference:
+    modes = ['median', 'mean', 'shank_median', 'shank_mean']
+
+    def __init__(self, mode='median', channel_groups=None):
+        """Common average referencing, globally or for groups of channels.
+
+        Parameters
+        ----------
+        mode : str; default='median'.
+            One of 'median', 'mean', 'shank_median' or 'shank_mean'. The
+            'shank_' modes compute a separate reference for each group in
+            `channel_groups`.
+        channel_groups : np.ndarray; optional.
+            Group (shank) index for each channel, like `probe['kcoords']`.
+            Ignored for global modes, required for 'shank_' modes.
+
+        """
+        if mode not in self.modes:
+            raise ValueError(f'CAR mode must be one of {self.modes}, got {mode}.')
+        self.mode = mode
+        self.groups = None
+        if mode.startswith('shank_'):
+            if channel_groups is None:
+                raise ValueError(f"CAR mode '{mode}' requires channel groups.")
+            channel_groups = np.asarray(channel_groups)
+            self.groups = [torch.from_numpy((channel_groups == g).nonzero()[0])
+                           for g in np.unique(channel_groups)]
+        self._reference = channel_median if mode.endswith('median') \
+                          else lambda X: X.mean(0)
+
+    def __call__(self, X):
+        """Subtract the reference from each channel of `X`."""
+        if self.groups is None:
+            return X - self._reference(X)
+        X = X.clone()
+        for idx in self.groups:
+            idx = idx.to(X.device)
+            X[idx] -= self._reference(X[idx])
+        return X
+
+class SparseOperator:
+    def __init__(self, W, channel_groups=None, tol=0, max_density=0.25):
+        """Channel-mixing matrix stored as shank blocks, CSR, or dense.
+
+        Whitening and drift-correction matrices only mix nearby channels, so
+        most of their entries are zero. If `channel_groups` is given and
+        every entry connecting different groups is zero, the matrix is
+        stored as one operator per group ('blocks'). Otherwise, it's stored
+        as a sparse CSR tensor ('sparse') if the fraction of nonzero entries
+        is at most `max_density`, or as a dense tensor ('dense') if that's
+        cheaper. Each block chooses between sparse and dense storage in the
+        same way.
+
+        Parameters
+        ----------
+        W : torch.Tensor
+            Matrix with shape (n_channels, n_channels).
+        channel_groups : np.ndarray; optional.
+            Group (shank) index for each channel, like `probe['kcoords']`.
+        tol : float; default=0.
+            Entries with magnitude at most `tol` times the largest magnitude
+            are treated as zero.
+        max_density : float; default=0.25.
+            Largest fraction of nonzero entries stored as a sparse matrix.
+
+        """
+        self.shape = tuple(W.shape)
+        self.dtype = W.dtype
+        self.channel_groups = channel_groups
+        self.max_density = max_density
+        self.device = W.device
+        W = torch.where(W.abs() > tol * W.abs().max(), W, torch.zeros_like(W))
+        self.nnz = int((W != 0).sum())
+        self.blocks = None
+        self.W = None
+
+        if channel_groups is not None:
+            channel_groups = np.asarray(channel_groups)
+            groups = np.unique(channel_groups)
+            if groups.size > 1:
+                mask = channel_groups[:, None] == channel_groups[None, :]
+                mask = torch.from_numpy(mask).to(W.device)
+                if not torch.any(W[~mask] != 0):
+                    self.mode = 'blocks'
+                    self.blocks = []
+                    for g in groups:
+                        idx = torch.from_numpy(
+                            (channel_groups == g).nonzero()[0]
+                            ).to(W.device)
+                        block = W[idx][:, idx]
+                        self.blocks.append(
+                            (idx, SparseOperator(block, max_density=max_density))
+                            )
+                    return
+
+        if self.nnz <= max_density * W.numel():
+            self.mode = 'sparse'
+            self.W = W.to_sparse_csr()
+        else:
+            self.mode = 'dense'
+            self.W = W
+
+    @property
+    def density(self):
+        """Fraction of nonzero entries."""
+        return self.nnz / (self.shape[0] * self.shape[1])
+
+    def __matmul__(self, X):
+        if self.mode == 'blocks':
+            Y = torch.empty((self.shape[0], *X.shape[1:]), dtype=X.dtype,
+                            device=X.device)
+            for idx, op in self.blocks:
+                Y[idx] = op @ X[idx]
+            return Y
+        return self.W @ X
+
+    def to(self, device):
+        """Copy of this operator on `device`."""
+        return SparseOperator(self.to_dense().to(device), self.channel_groups,
+                              max_density=self.max_density)
+
+    def to_dense(self):
+        """Dense tensor with shape (n_channels, n_channels)."""
+        if self.mode == 'blocks':
+            W = torch.zeros(self.shape, dtype=self.dtype, device=self.device)
+            for idx, op in self.blocks:
+                W[idx[:, None], idx[None, :]] = op.to_dense()
+            return W
+        elif self.mode == 'sparse':
+            return self.W.to_dense()
+        return self.W
+
+    def to_scipy(self):
+        """Export as a `scipy.sparse.csr_matrix`."""
+        W = self.to_dense().cpu().numpy()
+        return scipy.sparse.csr_matrix(W)
+
+
 def get_whitening_matrix(f, xc, yc, nskip=25, nrange=32):
     """Get the whitening matrix, use every nskip batches."""
     n_chan = len(f.chan_map)
@@ -135,20 +395,106 @@ def get_highpass_filter(fs=30000, cutoff=300, device=torch.device('cuda')):
     hp_filter = torch.from_numpy(hp_filter).to(device).float()
     return hp_filter
 
-def fft_highpass(hp_filter, NT=30122):
-    """Convert filter to fourier domain."""
+def _pad_highpass(hp_filter, NT=30122):
+    """Center `hp_filter` in a length `NT` window, padding or cropping it."""
     device = hp_filter.device
     ft = hp_filter.shape[0]
 
     # the filter is padded or cropped depending on the size of NT
     if ft < NT:
         pad = (NT - ft) // 2
-        fhp = fft(torch.cat((torch.zeros(pad, device=device), 
-                             hp_filter,
-                             torch.zeros(pad + (NT-pad*2-ft), device=device))))
+        return torch.cat((torch.zeros(pad, device=device), 
+                          hp_filter,
+                          torch.zeros(pad + (NT-pad*2-ft), device=device)))
     elif ft > NT:
         crop = (ft - NT) // 2 
-        fhp = fft(hp_filter[crop : crop + NT])
+        return hp_filter[crop : crop + NT]
     else:
-        fhp = fft(hp_filter)
-    return fhp
+        return hp_filter
+
+def fft_highpass(hp_filter, NT=30122):
+    """Convert filter to fourier domain."""
+    return fft(_pad_highpass(hp_filter, NT=NT))
+
+
+class FFTFilter:
+    def __init__(self, hp_filter, n_taps=None, tol=1e-6, block_size=2**14):
+        """High-pass filtering with cached real-FFT filter spectra.
+
+        `filter` gives the same result as multiplying by `fft_highpass` in the
+        Fourier domain (circular filtering over the full window), but uses
+        `rfft`/`irfft` and only computes the filter spectrum once for each
+        window length and device.
+
+        `overlap_save` applies the filter to windows of any length by
+        filtering blocks of a fast FFT length, using only the central
+        `n_taps` of the filter. Unlike `filter`, edges are zero-padded
+        instead of wrapping around.
+
+        Parameters
+        ----------
+        hp_filter : torch.Tensor
+            Symmetric filter impulse response, as returned by
+            `get_highpass_filter`.
+        n_taps : int; optional.
+            Number of filter taps used by `overlap_save`. By default, this
+            is the smallest centered window containing every tap with
+            magnitude above `tol` times the largest tap.
+        tol : float; default=1e-6.
+            Relative magnitude below which taps are dropped by `overlap_save`
+            if `n_taps` is not specified.
+        block_size : int; default=2**14.
+            Minimum FFT length for `overlap_save`. This is increased to at
+            least twice the number of taps, then to the next fast FFT length.
+
+        """
+        self.hp_filter = hp_filter
+        self.block_size = block_size
+        h = hp_filter.abs()
+        c = hp_filter.shape[0] // 2
+        if n_taps is None:
+            big = (h > tol * h.max()).nonzero().flatten()
+            r = int(max(c - big.min().item(), big.max().item() - c))
+        else:
+            r = n_taps // 2
+        r = min(r, c, hp_filter.shape[0] - c - 1)
+        self.taps = hp_filter[c-r : c+r+1]
+        self._spectra = {}
+
+    def spectrum(self, n, device, taps=False):
+        """Conjugate real-FFT of the (padded) filter with length `n`."""
+        key = (n, str(device), taps)
+        if key not in self._spectra:
+            if taps:
+                h = torch.zeros(n, device=device)
+                h[:self.taps.shape[0]] = self.taps.to(device)
+            else:
+                h = _pad_highpass(self.hp_filter, NT=n).to(device)
+            self._spectra[key] = torch.conj(torch.fft.rfft(h))
+        return self._spectra[key]
+
+    def filter(self, X):
+        """Filter the last dimension of `X`, same as using `fft_highpass`."""
+        n = X.shape[-1]
+        fwav = self.spectrum(n, X.device)
+        X = torch.fft.irfft(torch.fft.rfft(X) * fwav, n=n)
+        return fftshift(X, dim=-1)
+
+    def overlap_save(self, X):
+        """Filter the last dimension of `X` in blocks, for any window length."""
+        n = X.shape[-1]
+        K = self.taps.shape[0]
+        r = K // 2
+        N = scipy.fft.next_fast_len(max(self.block_size, 2*K), real=True)
+        S = N - K + 1
+        n_blocks = (n + S - 1) // S
+        # Zero-pad so that every output sample has `r` samples on each side,
+        # and the last block is full length.
+        Xp = torch.nn.functional.pad(X, (r, n_blocks*S + K - 1 - n - r))
+        blocks = Xp.unfold(-1, N, S)
+        Y = torch.fft.irfft(
+            torch.fft.rfft(blocks) * self.spectrum(N, X.device, taps=True), n=N
+            )
+        # Only the first S samples of each block are free of wrap-around.
+        Y = Y[..., :S].reshape(*X.shape[:-1], n_blocks*S)
+        return Y[..., :n]
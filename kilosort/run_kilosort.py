@@ -278,7 +278,7 @@ def _sort(filename, results_dir, probe, settings, data_dtype, device, do_CAR,
         ops, bfile, st0 = compute_drift_correction(
             ops, device, tic0=tic0, progress_bar=progress_bar,
             file_object=file_object, clear_cache=clear_cache,
-            verbose=verbose_log
+            verbose=verbose_log, cache_dir=results_dir
             )
 
         # Save preprocessing steps
@@ -286,20 +286,22 @@ def _sort(filename, results_dir, probe, settings, data_dtype, device, do_CAR,
             io.save_preprocessing(results_dir / 'temp_wh.dat', ops, bfile)
 
         logger.info('Generating drift plots ...')
-        # st0 will be None if nblocks = 0 (no drift correction)
-        if st0 is not None:
+        # dshift will be None if nblocks = 0 (no drift correction), st0 will
+        # also be None if spikes weren't stored (drift_only_detection)
+        if ops['dshift'] is not None:
             if gui_sorter is not None:
                 gui_sorter.dshift = ops['dshift']
                 gui_sorter.st0 = st0
                 gui_sorter.plotDataReady.emit('drift')
             else:
                 kplots.plot_drift_amount(ops, results_dir)
-                kplots.plot_drift_scatter(st0, results_dir)
+                if st0 is not None:
+                    kplots.plot_drift_scatter(st0, results_dir)
 
         # Sort spikes and save results
         st,tF, Wall0, clu0 = detect_spikes(
             ops, device, bfile, tic0=tic0, progress_bar=progress_bar,
-            clear_cache=clear_cache, verbose=verbose_log
+            clear_cache=clear_cache, verbose=verbose_log, spill_dir=results_dir
             )
 
         logger.info('Generating diagnostic plots ...')
@@ -321,6 +323,16 @@ def _sort(filename, results_dir, probe, settings, data_dtype, device, do_CAR,
                 save_extra_vars=save_extra_vars,
                 save_preprocessed_copy=save_preprocessed_copy
                 )
+        bfile.close()
+        # Scratch files are no longer needed once results are saved. Returned
+        # arrays that map them stay valid until released (except on Windows,
+        # where mapped files can't be removed).
+        remaining = io.remove_spill_files(results_dir)
+        if len(remaining) > 0:
+            logger.warning(
+                f'Could not remove scratch files {[f.name for f in remaining]}'
+                f' from {results_dir}, they can be deleted after sorting.'
+                )
 
         logger.info('Generating spike position plot ...')
         if gui_sorter is not None:
@@ -593,6 +605,12 @@ def compute_preprocessing(ops, device, tic0=np.nan, file_object=None):
         xc, yc, tmin, tmax, artifact, shift, scale = get_run_parameters(ops)
     nskip = ops['settings']['nskip']
     whitening_range = ops['settings']['whitening_range']
+    prefetch = ops['settings']['prefetch_batches']
+    sequential = ops['settings'].get('sequential_io', False)
+    car_mode = ops['settings'].get('car_mode', 'median')
+    kcoords = ops['probe']['kcoords']
+    sparse_ops = ops['settings'].get('sparse_preprocessing', False)
+    use_compile = ops['settings'].get('torch_compile', False)
     
     # Compute high pass filter
     cutoff = ops['settings']['highpass_cutoff']
@@ -602,7 +620,10 @@ def compute_preprocessing(ops, device, tic0=np.nan, file_object=None):
                               chan_map, hp_filter, device=device, do_CAR=do_CAR,
                               invert_sign=invert, dtype=dtype, tmin=tmin,
                               tmax=tmax, artifact_threshold=artifact,
-                              shift=shift, scale=scale, file_object=file_object)
+                              shift=shift, scale=scale, file_object=file_object,
+                              prefetch=prefetch, sequential=sequential,
+                              car_mode=car_mode, channel_groups=kcoords,
+                              sparse_ops=sparse_ops, use_compile=use_compile)
 
     logger.info(f'N samples: {bfile.n_samples}')
     logger.info(f'N seconds: {bfile.n_samples/fs}')
@@ -610,6 +631,9 @@ def compute_preprocessing(ops, device, tic0=np.nan, file_object=None):
 
     whiten_mat = preprocessing.get_whitening_matrix(bfile, xc, yc, nskip=nskip,
                                                     nrange=whitening_range)
+    if bfile.prefetcher is not None:
+        logger.debug(f'Prefetch stats: {bfile.prefetcher.stats()}')
+        bfile.prefetcher.reset()
 
 
     # Save results
@@ -627,6 +651,7 @@ def compute_preprocessing(ops, device, tic0=np.nan, file_object=None):
     # Check scale of data for log file
     b1 = bfile.padded_batch_to_torch(0).cpu().numpy()
     logger.debug(f"First batch min, max: {b1.min(), b1.max()}")
+    bfile.close()
 
     log_performance(logger, 'info', 'Resource usage after preprocessing')
 
@@ -634,7 +659,8 @@ def compute_preprocessing(ops, device, tic0=np.nan, file_object=None):
 
 
 def compute_drift_correction(ops, device, tic0=np.nan, progress_bar=None,
-                             file_object=None, clear_cache=False, verbose=False):
+                             file_object=None, clear_cache=False, verbose=False,
+                             cache_dir=None):
     """Compute drift correction parameters and save them to `ops`.
 
     Parameters
@@ -656,6 +682,9 @@ def compute_drift_correction(ops, device, tic0=np.nan, progress_bar=None,
         memory-intensive steps in the pipeline.
     verbose : bool; False.
         If true, include additional debug-level logging statements.
+    cache_dir : str or pathlib.Path; optional.
+        Directory for the preprocessed data cache, if enabled with
+        `settings['preprocessed_cache']`. Typically the results directory.
 
     Returns
     -------
@@ -665,7 +694,9 @@ def compute_drift_correction(ops, device, tic0=np.nan, progress_bar=None,
         Wrapped file object for handling data.
     st0 : np.ndarray.
         Intermediate spike times variable with 6 columns. This is only used
-        for generating the 'Drift Scatter' plot through the GUI.
+        for generating the 'Drift Scatter' plot through the GUI. None if
+        drift correction is skipped or `settings['drift_only_detection']`
+        is True.
     
     """
 
@@ -678,20 +709,39 @@ def compute_drift_correction(ops, device, tic0=np.nan, progress_bar=None,
         _, _, tmin, tmax, artifact, shift, scale = get_run_parameters(ops)
     hp_filter = ops['preprocessing']['hp_filter']
     whiten_mat = ops['preprocessing']['whiten_mat']
+    prefetch = ops['settings']['prefetch_batches']
+    sequential = ops['settings'].get('sequential_io', False)
+    car_mode = ops['settings'].get('car_mode', 'median')
+    kcoords = ops['probe']['kcoords']
+    sparse_ops = ops['settings'].get('sparse_preprocessing', False)
+    use_compile = ops['settings'].get('torch_compile', False)
+    cache_dtype = ops['settings']['preprocessed_cache']
+    if cache_dir is None:
+        cache_dtype = None
     bfile = io.BinaryFiltered(
         ops['filename'], n_chan_bin, fs, NT, nt, twav_min, chan_map, 
         hp_filter=hp_filter, whiten_mat=whiten_mat, device=device, do_CAR=do_CAR,
         invert_sign=invert, dtype=dtype, tmin=tmin, tmax=tmax,
         artifact_threshold=artifact, shift=shift, scale=scale,
-        file_object=file_object
+        file_object=file_object, prefetch=prefetch,
+        sequential=sequential, car_mode=car_mode, channel_groups=kcoords,
+        sparse_ops=sparse_ops, use_compile=use_compile
         )
+    if cache_dtype is not None:
+        bfile.cache = io.PreprocessedCache.from_bfile(
+            bfile, cache_dir, dtype=cache_dtype
+            )
 
     ops, st = datashift.run(ops, bfile, device=device, progress_bar=progress_bar,
                             clear_cache=clear_cache, verbose=verbose)
+    if bfile.prefetcher is not None:
+        logger.debug(f'Prefetch stats: {bfile.prefetcher.stats()}')
+    bfile.close()
     logger.info(f'drift computed in {time.time()-tic : .2f}s; ' + 
                 f'total {time.time()-tic0 : .2f}s')
-    if st is not None:
-        logger.debug(f'st shape: {st.shape}')
+    if ops['dshift'] is not None:
+        if st is not None:
+            logger.debug(f'st shape: {st.shape}')
         logger.debug(f'yblk shape: {ops["yblk"].shape}')
         logger.debug(f'dshift shape: {ops["dshift"].shape}')
         logger.debug(f'iKxx shape: {ops["iKxx"].shape}')
@@ -702,8 +752,33 @@ def compute_drift_correction(ops, device, tic0=np.nan, progress_bar=None,
         hp_filter=hp_filter, whiten_mat=whiten_mat, device=device,
         dshift=ops['dshift'], do_CAR=do_CAR, dtype=dtype, tmin=tmin, tmax=tmax,
         artifact_threshold=artifact, shift=shift, scale=scale,
-        file_object=file_object
+        file_object=file_object, prefetch=prefetch,
+        sequential=sequential, car_mode=car_mode, channel_groups=kcoords,
+        sparse_ops=sparse_ops, use_compile=use_compile
         )
+    if cache_dtype is not None:
+        # Drift correction is applied after loading cached batches, so the
+        # same cache can be used.
+        bfile.cache = io.PreprocessedCache.from_bfile(
+            bfile, cache_dir, dtype=cache_dtype
+            )
+
+    drift_memory = ops['settings'].get('drift_matrix_memory', 0)
+    if ops['dshift'] is not None and drift_memory > 0:
+        # Cached batches are already whitened, so only cache drift matrices
+        # in that case. Otherwise, cache drift and whitening combined.
+        bfile.drift_matrices = io.DriftMatrixCache(
+            ops, ops['dshift'], device=device,
+            whiten_mat=None if bfile.cache is not None else whiten_mat,
+            max_memory=drift_memory * 2**30,
+            quantize=ops['settings'].get('drift_quantization', 0),
+            sparse=sparse_ops, channel_groups=kcoords
+            )
+        bfile.drift_matrices.precompute()
+        logger.debug(f'Drift matrices: {bfile.drift_matrices.stats()}')
+    elif ops['dshift'] is not None and sparse_ops:
+        logger.info('sparse_preprocessing only applies to whitening, since '
+                    'drift matrices are not cached (drift_matrix_memory = 0).')
 
     log_performance(logger, 'info', 'Resource usage after drift correction')
     log_cuda_details(logger)
@@ -712,7 +787,7 @@ def compute_drift_correction(ops, device, tic0=np.nan, progress_bar=None,
 
 
 def detect_spikes(ops, device, bfile, tic0=np.nan, progress_bar=None,
-                  clear_cache=False, verbose=False):
+                  clear_cache=False, verbose=False, spill_dir=None):
     """Detect spikes via template deconvolution.
     
     Parameters
@@ -732,6 +807,10 @@ def detect_spikes(ops, device, bfile, tic0=np.nan, progress_bar=None,
         memory-intensive steps in the pipeline.
     verbose : bool; False.
         If true, include additional debug-level logging statements.
+    spill_dir : str or pathlib.Path; optional.
+        Directory for scratch files used to hold spikes and PC features that
+        exceed `settings['spike_buffer_memory']`. Typically the results
+        directory. If not specified, everything is kept in memory.
 
     Returns
     -------
@@ -756,7 +835,7 @@ def detect_spikes(ops, device, bfile, tic0=np.nan, progress_bar=None,
     logger.info('-'*40)
     st0, tF, ops = spikedetect.run(
         ops, bfile, device=device, progress_bar=progress_bar,
-        clear_cache=clear_cache, verbose=verbose
+        clear_cache=clear_cache, verbose=verbose, spill_dir=spill_dir
         )
     tF = torch.from_numpy(tF)
     logger.info(f'{len(st0)} spikes extracted in {time.time()-tic : .2f}s; ' + 
@@ -787,14 +866,21 @@ def detect_spikes(ops, device, bfile, tic0=np.nan, progress_bar=None,
     logger.info('Extracting spikes using cluster waveforms')
     logger.info('-'*40)
     st, tF, ops = template_matching.extract(
-        ops, bfile, Wall3, device=device, progress_bar=progress_bar
+        ops, bfile, Wall3, device=device, progress_bar=progress_bar,
+        spill_dir=spill_dir
         )
+    if bfile.prefetcher is not None:
+        logger.debug(f'Prefetch stats: {bfile.prefetcher.stats()}')
     logger.info(f'{len(st)} spikes extracted in {time.time()-tic : .2f}s; ' +
                 f'total {time.time()-tic0 : .2f}s')
     logger.debug(f'st shape: {st.shape}')
     logger.debug(f'tF shape: {tF.shape}')
     logger.debug(f'iCC shape: {ops["iCC"].shape}')
     logger.debug(f'iU shape: {ops["iU"].shape}')
+    if spill_dir is not None:
+        # Spikes from the first detection pass are no longer needed.
+        del st0
+        io.remove_spill_files(spill_dir, pattern='*0_spill.dat')
 
     log_performance(logger, 'info', 'Resource usage after spike detection')
     log_cuda_details(logger)
@@ -961,7 +1047,7 @@ def save_sorting(ops, results_dir, st, clu, tF, Wall, imin, tic0=np.nan,
     return ops, similar_templates, is_ref, est_contam_rate, kept_spikes
 
 
-def load_sorting(results_dir, device=None, load_extra_vars=False):
+def load_sorting(results_dir, device=None, load_extra_vars=False, lazy=False):
     '''Load saved sorting results into memory.
     
     Parameters
@@ -976,6 +1062,12 @@ def load_sorting(results_dir, device=None, load_extra_vars=False):
     load_extra_vars : default=False.
         If True, load tF, Wall, and full copies of st, clu, and spike amplitudes
         in addition to the other variables.
+    lazy : bool; default=False.
+        If True, arrays are returned as read-only memmaps (or, for compressed
+        columns in 'sorting.ks4', as `kilosort.io.LazyColumn`) instead of
+        being read into memory. If results were saved with
+        `settings['results_format']` set to 'container' or 'both', `is_ref`
+        and `est_contam_rate` are also loaded instead of being recomputed.
 
     Returns
     -------
@@ -1033,29 +1125,41 @@ def load_sorting(results_dir, device=None, load_extra_vars=False):
 
     results_dir = Path(results_dir)
     ops = io.load_ops(results_dir / 'ops.npy', device=device)
-    similar_templates = np.load(results_dir / 'similar_templates.npy')
-
-    clu = np.load(results_dir / 'spike_clusters.npy')
-    st = np.load(results_dir / 'spike_times.npy')
-    kept_spikes = np.load(results_dir / 'kept_spikes.npy')
-    acg_threshold = ops['settings']['acg_threshold']
-    ccg_threshold = ops['settings']['ccg_threshold']
-    is_ref, est_contam_rate = CCG.refract(clu, st / ops['fs'],
-                                          acg_threshold=acg_threshold,
-                                          ccg_threshold=ccg_threshold)
+    load = lambda name: io.load_result(results_dir, name, lazy=lazy)
+    similar_templates = load('similar_templates')
+
+    clu = load('spike_clusters')
+    st = load('spike_times')
+    kept_spikes = load('kept_spikes')
+    container = io.result_source(results_dir, 'spike_clusters')
+    if lazy and container.name == io.SortingContainer.FILENAME:
+        # Saved labels only match clusters that were also read from the
+        # container, not a curated spike_clusters.npy.
+        sorting = io.SortingContainer(container)
+        is_ref = sorting.load('is_ref')
+        est_contam_rate = sorting.load('est_contam_rate')
+    else:
+        acg_threshold = ops['settings']['acg_threshold']
+        ccg_threshold = ops['settings']['ccg_threshold']
+        is_ref, est_contam_rate = CCG.refract(
+            np.asarray(clu), np.asarray(st) / ops['fs'],
+            acg_threshold=acg_threshold, ccg_threshold=ccg_threshold
+            )
 
     results = [ops, st, clu, similar_templates, is_ref,
                est_contam_rate, kept_spikes]
 
     if load_extra_vars:
         # NOTE: tF and Wall always go on CPU, not CUDA
-        tF = np.load(results_dir / 'tF.npy')
-        tF = torch.from_numpy(tF)
-        Wall = np.load(results_dir / 'Wall.npy')
-        Wall = torch.from_numpy(Wall)
-        full_st = np.load(results_dir / 'full_st.npy')
-        full_clu = np.load(results_dir / 'full_clu.npy')
-        full_amp = np.load(results_dir / 'full_amp.npy')
+        with warnings.catch_warnings():
+            # Memmapped arrays are read-only, which is fine since they are
+            # not modified here.
+            warnings.filterwarnings('ignore', message=io._torch_warning)
+            tF = torch.from_numpy(np.asarray(load('tF')))
+            Wall = torch.from_numpy(np.asarray(load('Wall')))
+        full_st = load('full_st')
+        full_clu = load('full_clu')
+        full_amp = load('full_amp')
         results.extend([tF, Wall, full_st, full_clu, full_amp])
 
     return results
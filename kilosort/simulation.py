@@ -454,7 +454,7 @@ def waveforms_from_recording(filename_bg, NT, n_chan_bin, nt, twav_min, chan_map
     # load kilosort4 output
     data_folder = os.path.split(filename_bg)[0]
     ks4_folder = os.path.join(data_folder, 'kilosort4/')   
-    ops = np.load(os.path.join(ks4_folder, 'ops.npy'), allow_pickle=True).item()
+    ops = io.load_ops(ks4_folder, device=torch.device('cpu'), keys=['Nbatches'])
     st = np.load(os.path.join(ks4_folder, 'spike_times.npy'))
     cl = np.load(os.path.join(ks4_folder, 'spike_clusters.npy'))
     templates = np.load(os.path.join(ks4_folder, 'templates.npy'))
@@ -1,4 +1,5 @@
 import os
+from pathlib import Path
 import gc
 import logging
 import warnings
@@ -11,7 +12,25 @@ from sklearn.cluster import KMeans
 from sklearn.decomposition import TruncatedSVD
 from tqdm import tqdm
 
-from kilosort.utils import template_path, log_performance
+from kilosort.io import ChunkedArray
+from kilosort.utils import template_path, log_performance, compiled
+
+
+SCORE_DTYPES = {
+    'float32': torch.float32, 'bfloat16': torch.bfloat16,
+    'float16': torch.float16
+    }
+
+
+def score_dtype(ops):
+    """Storage dtype for per-batch score maps, from `settings['score_dtype']`."""
+    name = ops['settings'].get('score_dtype', 'float32')
+    if name not in SCORE_DTYPES:
+        raise ValueError(
+            f'score_dtype must be one of {list(SCORE_DTYPES.keys())}, '
+            f'got {name}.'
+            )
+    return SCORE_DTYPES[name]
 
 
 def my_max2d(X, dt):
@@ -127,6 +146,54 @@ def template_centers(ops):
     return ops
 
 
+def _match_block(weigh, Bt, ti, tj, iC2, Nfilt):
+    # Best template and amplitude for one block of time points.
+    A = torch.einsum('ijk, jklm-> iklm', weigh, Bt)
+    A = A.transpose(1,2)
+    A = A.reshape(-1, Nfilt, A.shape[-1])
+
+    #Aa, imax = torch.max(A, 0) 
+    Aa, imax = torch.max(A.abs(), 0)
+    imax = (1+imax) * A[imax, ti.unsqueeze(-1), tj[:A.shape[-1]]].sign()
+    Amax = torch.max(Aa[iC2], 0)[0]
+
+    return Aa, imax, Amax
+
+
+def _drop_rounding_ties(xy, As, iC2, nt0, block_size=1024):
+    # With reduced-precision scores, nearby templates can round to the same
+    # score so that one spike is detected more than once. Keep only the first
+    # detection (by time, then template) of each group of tied neighbors.
+    # Neighboring detections are found by binary search over sorted
+    # (template, time) keys, so no dense (Nfilt, NT) lookup is needed.
+    Nfilt, NT = As.shape
+    n = xy.shape[0]
+    amp = As[xy[:,0], xy[:,1]]
+    keys, order = torch.sort(xy[:,0] * NT + xy[:,1])
+    sf, st, samp = xy[order,0], xy[order,1], amp[order]
+
+    keep = torch.ones(n, dtype=torch.bool, device=As.device)
+    for i in range(0, n, block_size):
+        f, t, a = xy[i:i+block_size, 0], xy[i:i+block_size, 1], amp[i:i+block_size]
+        ff = iC2[:, f].T * NT
+        lo = torch.searchsorted(keys, ff + (t - nt0).clamp(min=0).unsqueeze(-1))
+        hi = torch.searchsorted(
+            keys, ff + (t + nt0).clamp(max=NT-1).unsqueeze(-1), right=True
+            )
+        tied = torch.zeros(f.shape[0], dtype=torch.bool, device=As.device)
+        for k in range(int((hi - lo).max())):
+            j = (lo + k).clamp(max=n-1)
+            earlier = torch.logical_or(
+                st[j] < t.unsqueeze(-1),
+                torch.logical_and(st[j] == t.unsqueeze(-1), sf[j] < f.unsqueeze(-1))
+                )
+            match = (lo + k < hi) & earlier & (samp[j] == a.unsqueeze(-1))
+            tied |= match.any(-1)
+        keep[i:i+block_size] = ~tied
+
+    return xy[keep]
+
+
 def template_match(X, ops, iC, iC2, weigh, device=torch.device('cuda')):
     nt = ops['nt']
     nt0 = ops['settings']['nt0min']
@@ -138,32 +205,43 @@ def template_match(X, ops, iC, iC2, weigh, device=torch.device('cuda')):
 
     W = ops['wTEMP'].unsqueeze(1)
     B = conv1d(X.unsqueeze(1), W, padding=nt//2)
-    As    = torch.zeros((Nfilt, NT), device=device)
-    Amaxs = torch.zeros((Nfilt, NT), device=device)
-    imaxs = torch.zeros((Nfilt, NT), dtype = torch.int64, device=device)
+    # Scores are computed in float32, but may be stored with less precision.
+    dtype = score_dtype(ops)
+    itype = torch.int64 if dtype == torch.float32 else torch.int32
+    As    = torch.zeros((Nfilt, NT), dtype=dtype, device=device)
+    Amaxs = torch.zeros((Nfilt, NT), dtype=dtype, device=device)
+    imaxs = torch.zeros((Nfilt, NT), dtype=itype, device=device)
     ti = torch.arange(Nfilt, device = device)
     tj = torch.arange(nb, device = device)
 
+    match_block = compiled(
+        _match_block, ops['settings'].get('torch_compile', False)
+        )
     for t in range(niter):
-        A = torch.einsum('ijk, jklm-> iklm', weigh, B[iC,:, nb*t:nb*(t+1)])        
-        A = A.transpose(1,2)
-        A = A.reshape(-1, Nfilt, A.shape[-1])
-        
-        #Aa, imax = torch.max(A, 0) 
-        Aa, imax = torch.max(A.abs(), 0)
-        imax = (1+imax) * A[imax, ti.unsqueeze(-1), tj[:A.shape[-1]]].sign()
-
+        Aa, imax, Amax = match_block(
+            weigh, B[iC,:, nb*t:nb*(t+1)], ti, tj, iC2, Nfilt
+            )
         As[:, nb*t:nb*(t+1)] = Aa
         imaxs[:, nb*t:nb*(t+1)] = imax
-        Amax = torch.max(Aa[iC2], 0)[0]
         Amaxs[:, nb*t:nb*(t+1)] = Amax
 
     Amaxs[:,:nt] = 0
     Amaxs[:,-nt:] = 0
-    Amaxs  = max_pool1d(Amaxs.unsqueeze(0), (2*nt0+1), stride = 1, padding = nt0).squeeze(0)
+    if dtype == torch.float32:
+        Amaxs  = max_pool1d(Amaxs.unsqueeze(0), (2*nt0+1), stride = 1, padding = nt0).squeeze(0)
+    else:
+        # Pool in float32 a block of rows at a time, so that there's never a
+        # full-size float32 copy of the scores.
+        for i in range(0, Nfilt, 256):
+            Amaxs[i:i+256] = max_pool1d(
+                Amaxs[i:i+256].float().unsqueeze(0), (2*nt0+1), stride = 1,
+                padding = nt0
+                ).squeeze(0)
     xy = torch.logical_and(Amaxs==As, As > ops['Th_universal']).nonzero()
-    imax = imaxs[xy[:,0], xy[:,1]]
-    amp = As[xy[:,0], xy[:,1]]
+    if dtype != torch.float32:
+        xy = _drop_rounding_ties(xy, As, iC2, nt0)
+    imax = imaxs[xy[:,0], xy[:,1]].long()
+    amp = As[xy[:,0], xy[:,1]].float()
 
     ssign = imax.sign()
     imax = imax.abs()-1
@@ -193,8 +271,39 @@ def yweighted(yc, iC, adist, xy, device=torch.device('cuda')):
     yct = (cF0 * yy[:,xy[:,0]]).sum(0)
     return yct
 
+
+def spike_buffers(ops, st_shape, tF_shape, spill_dir=None, suffix=''):
+    """Create `ChunkedArray` stores for spike times and PC features.
+
+    The memory budget in `ops['settings']['spike_buffer_memory']` is split
+    between the two stores in proportion to their row sizes. Spilled rows are
+    written to `st{suffix}_spill.dat` and `tF{suffix}_spill.dat` in
+    `spill_dir`, or kept in memory if `spill_dir` is None.
+
+    """
+    max_memory = ops['settings'].get('spike_buffer_memory', np.inf) * 1e9
+    st_bytes = np.prod(st_shape) * 8
+    tF_bytes = np.prod(tF_shape) * 4
+    st_memory = max_memory * st_bytes / (st_bytes + tF_bytes)
+    tF_memory = max_memory * tF_bytes / (st_bytes + tF_bytes)
+
+    st_file, tF_file = None, None
+    if spill_dir is not None:
+        st_file = Path(spill_dir) / f'st{suffix}_spill.dat'
+        tF_file = Path(spill_dir) / f'tF{suffix}_spill.dat'
+    st = ChunkedArray(st_shape, 'float64', max_memory=st_memory,
+                      filename=st_file)
+    tF = ChunkedArray(tF_shape, 'float32', max_memory=tF_memory,
+                      filename=tF_file)
+
+    return st, tF
+
+
 def run(ops, bfile, device=torch.device('cuda'), progress_bar=None,
-        clear_cache=False, verbose=False):        
+        clear_cache=False, verbose=False, spill_dir=None, batch_callback=None):
+    # If `batch_callback` is given, it's called as `batch_callback(ibatch, stt)`
+    # with the 6-column spike table of each batch instead of storing spikes,
+    # and PC features aren't computed. `st` and `tF` are returned as None.
     sig = ops['settings']['min_template_size']
     nsizes = ops['settings']['template_sizes']
     nb = ops['Nbatches']
@@ -239,10 +348,11 @@ def run(ops, bfile, device=torch.device('cuda'), progress_bar=None,
     weigh = torch.permute(weigh, (2, 0, 1)).contiguous()
     weigh = weigh / (weigh**2).sum(1).unsqueeze(1)**.5
 
-    st = np.zeros((10**6, 6), 'float64')
-    tF = np.zeros((10**6, nC , ops['settings']['n_pcs']), 'float32')
+    if batch_callback is None:
+        st, tF = spike_buffers(
+            ops, (6,), (nC, ops['settings']['n_pcs']), spill_dir, suffix='0'
+            )
 
-    k = 0
     nt = ops['nt']
     tarange = torch.arange(-(nt//2),nt//2+1, device = device)
     logger.info('Detecting spikes...')
@@ -260,22 +370,23 @@ def run(ops, bfile, device=torch.device('cuda'), progress_bar=None,
             yct = yweighted(yc, iC, adist, xy, device=device)
             nsp = len(xy)
 
-            if k+nsp>st.shape[0]:
-                st = np.concatenate((st, np.zeros_like(st)), 0)
-                tF = np.concatenate((tF, np.zeros_like(tF)), 0)
+            if batch_callback is None:
+                xsub = X[iC[:,xy[:,:1]], xy[:,1:2] + tarange]
+                xfeat = xsub @ ops['wPCA'].T
+                tF.append(xfeat.transpose(0,1).cpu().numpy())
+
+            stt = np.zeros((nsp, 6), 'float64')
+            stt[:,0] = ((xy[:,1].cpu().numpy()-nt)/ops['fs'] + ibatch * (ops['batch_size']/ops['fs']))
+            stt[:,1] = yct.cpu().numpy()
+            stt[:,2] = amp.cpu().numpy()
+            stt[:,3] = imax.cpu().numpy()
+            stt[:,4] = ibatch
+            stt[:,5] = xy[:,0].cpu().numpy()
+            if batch_callback is None:
+                st.append(stt)
+            else:
+                batch_callback(ibatch, stt)
 
-            xsub = X[iC[:,xy[:,:1]], xy[:,1:2] + tarange]
-            xfeat = xsub @ ops['wPCA'].T
-            tF[k:k+nsp] = xfeat.transpose(0,1).cpu().numpy()
-
-            st[k:k+nsp,0] = ((xy[:,1].cpu().numpy()-nt)/ops['fs'] + ibatch * (ops['batch_size']/ops['fs']))
-            st[k:k+nsp,1] = yct.cpu().numpy()
-            st[k:k+nsp,2] = amp.cpu().numpy()
-            st[k:k+nsp,3] = imax.cpu().numpy()
-            st[k:k+nsp,4] = ibatch
-            st[k:k+nsp,5] = xy[:,0].cpu().numpy()
-
-            k = k + nsp
             if clear_cache:
                 gc.collect()
                 torch.cuda.empty_cache()
@@ -295,8 +406,11 @@ def run(ops, bfile, device=torch.device('cuda'), progress_bar=None,
             
     log_performance(logger, 'debug', f'Batch {ibatch} of {nb-1} ({100*(ibatch/nb):.1f}%)')
 
-    st = st[:k]
-    tF = tF[:k]
+    if batch_callback is None:
+        st = st.to_array()
+        tF = tF.to_array()
+    else:
+        st, tF = None, None
     ops['iC'] = iC
     ops['iC2'] = iC2
     ops['weigh'] = weigh
@@ -6,7 +6,8 @@ from torch.nn.functional import conv1d, max_pool2d, max_pool1d
 from tqdm import tqdm
 
 from kilosort import CCG
-from kilosort.utils import log_performance
+from kilosort.spikedetect import spike_buffers
+from kilosort.utils import log_performance, compiled
 
 logger = logging.getLogger(__name__)
 
@@ -53,7 +54,8 @@ def prepare_extract(xc, yc, U, nC, position_limit, device=torch.device('cuda')):
     return iCC, iCC_mask, iU, Ucc
 
 
-def extract(ops, bfile, U, device=torch.device('cuda'), progress_bar=None):
+def extract(ops, bfile, U, device=torch.device('cuda'), progress_bar=None,
+            spill_dir=None):
     nC = ops['settings']['nearest_chans']
     position_limit = ops['settings']['position_limit']
     iCC, iCC_mask, iU, Ucc = prepare_extract(
@@ -66,9 +68,9 @@ def extract(ops, bfile, U, device=torch.device('cuda'), progress_bar=None):
     
     tiwave = torch.arange(-(nt//2), nt//2+1, device=device) 
     ctc = prepare_matching(ops, U)
-    st = np.zeros((10**6, 3), 'float64')
-    tF  = torch.zeros((10**6, nC , ops['settings']['n_pcs']))
-    k = 0
+    st, tF = spike_buffers(
+        ops, (3,), (nC, ops['settings']['n_pcs']), spill_dir
+        )
     prog = tqdm(
         np.arange(bfile.n_batches, dtype=np.int64),
         miniters=200 if progress_bar else None, 
@@ -95,18 +97,14 @@ def extract(ops, bfile, U, device=torch.device('cuda'), progress_bar=None):
                 th_amps = th_amps[~neg_spikes,:]
 
             nsp = len(stt) 
-            if k+nsp>st.shape[0]:                     
-                st = np.concatenate((st, np.zeros_like(st)), 0)
-                tF  = torch.cat((tF,  torch.zeros_like(tF)), 0)
-
             stt = stt.double()
-            st[k:k+nsp,0] = ((stt[:,0]-nt) + ibatch * (ops['batch_size'])).cpu().numpy() - nt//2 + ops['nt0min']
-            st[k:k+nsp,1] = stt[:,1].cpu().numpy()
-            st[k:k+nsp,2] = th_amps.cpu().numpy().squeeze()
-            
-            tF[k:k+nsp]  = xfeat.transpose(0,1).cpu()
+            st_batch = np.zeros((nsp, 3), 'float64')
+            st_batch[:,0] = ((stt[:,0]-nt) + ibatch * (ops['batch_size'])).cpu().numpy() - nt//2 + ops['nt0min']
+            st_batch[:,1] = stt[:,1].cpu().numpy()
+            st_batch[:,2] = th_amps.cpu().numpy().reshape(-1)
+            st.append(st_batch)
 
-            k+= nsp
+            tF.append(xfeat.transpose(0,1).cpu().numpy())
             
             if progress_bar is not None:
                 progress_bar.emit(int((ibatch+1) / bfile.n_batches * 100))
@@ -118,9 +116,10 @@ def extract(ops, bfile, U, device=torch.device('cuda'), progress_bar=None):
 
     log_performance(logger, 'debug', f'Batch {ibatch}')
 
-    isort = np.argsort(st[:k,0])
+    st = st.to_array()
+    isort = np.argsort(st[:,0])
     st = st[isort]
-    tF = tF[isort]
+    tF = torch.from_numpy(tF.to_array(order=isort))
 
     return st, tF, ops
 
@@ -166,6 +165,25 @@ def prepare_matching(ops, U):
     return ctc
 
 
+def _peel_scores(B, nm, nt, Th):
+    # Cf is shape (n_units, n_times)
+    Cf = torch.relu(B)**2 /nm.unsqueeze(-1)
+    #a = 1 + lam
+    #b = torch.relu(B) + lam * mu.unsqueeze(-1)
+    #Cf = b**2 / a - lam * mu.unsqueeze(-1)**2
+
+    Cf[:, :nt] = 0
+    Cf[:, -nt:] = 0
+
+    Cfmax, imax = torch.max(Cf, 0)
+    Cmax  = max_pool1d(Cfmax.unsqueeze(0).unsqueeze(0), (2*nt+1), stride=1, padding=(nt))
+
+    cnd1 = Cmax[0,0] > Th**2
+    cnd2 = torch.abs(Cmax[0,0] - Cfmax) < 1e-9
+
+    return imax, Cmax, cnd1 * cnd2
+
+
 def run_matching(ops, X, U, ctc, device=torch.device('cuda')):
     Th = ops['Th_learned']
     nt = ops['nt']
@@ -189,26 +207,16 @@ def run_matching(ops, X, U, ctc, device=torch.device('cuda')):
 
     Xres = X.clone()
     lam = 20
+    # Scores for each peel are computed in one fused kernel if enabled, which
+    # avoids allocating Cf (n_units, n_times) separately from B.
+    peel_scores = compiled(
+        _peel_scores, ops['settings'].get('torch_compile', False)
+        )
 
     for t in range(max_peels):
         # Cf = 2 * B - nm.unsqueeze(-1) 
-        # Cf is shape (n_units, n_times)
-        Cf = torch.relu(B)**2 /nm.unsqueeze(-1)
-        #a = 1 + lam
-        #b = torch.relu(B) + lam * mu.unsqueeze(-1)
-        #Cf = b**2 / a - lam * mu.unsqueeze(-1)**2
-
-        Cf[:, :nt] = 0
-        Cf[:, -nt:] = 0
-
-        Cfmax, imax = torch.max(Cf, 0)
-        Cmax  = max_pool1d(Cfmax.unsqueeze(0).unsqueeze(0), (2*nt+1), stride=1, padding=(nt))
-
-        #print(Cfmax.shape)
-        #import pdb; pdb.set_trace()
-        cnd1 = Cmax[0,0] > Th**2
-        cnd2 = torch.abs(Cmax[0,0] - Cfmax) < 1e-9
-        xs = torch.nonzero(cnd1 * cnd2)
+        imax, Cmax, cnd = peel_scores(B, nm, nt, Th)
+        xs = torch.nonzero(cnd)
 
         
         if len(xs)==0:
@@ -122,6 +122,65 @@ def download_url_to_file(url, dst, progress=True):
             os.remove(f.name)
 
 
+# Compiled versions of functions, shared by all callers so that compilation
+# happens at most once per process. None marks functions that failed to
+# compile, which always run eagerly afterwards.
+_COMPILED = {}
+COMPILE_CACHE_DIR = DOWNLOADS_DIR.joinpath('torch_compile')
+
+
+def _enable_compile_cache():
+    # Persist compiled kernels between runs, so that warm-up only happens the
+    # first time a kernel is compiled for this version of torch.
+    os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', os.fspath(COMPILE_CACHE_DIR))
+    os.environ.setdefault('TORCHINDUCTOR_FX_GRAPH_CACHE', '1')
+
+
+def compiled(func, enabled=True):
+    """Wrap `func` with `torch.compile`, falling back to eager execution.
+
+    Parameters
+    ----------
+    func : callable
+        Function containing only tensor operations, so that it can be traced
+        and fused by `torch.compile`.
+    enabled : bool; default=True.
+        If False, or if `torch.compile` is not available, `func` is returned
+        unchanged.
+
+    Returns
+    -------
+    wrapper : callable
+        Calls the compiled version of `func`. If compilation or the compiled
+        call raises an exception, a warning is logged and `func` is called
+        instead, for this and every later call.
+
+    """
+    if not enabled or not hasattr(torch, 'compile'):
+        return func
+    if func not in _COMPILED:
+        _enable_compile_cache()
+        try:
+            _COMPILED[func] = torch.compile(func, dynamic=True)
+        except Exception as e:
+            logger.warning(f'Could not compile {func.__name__}, using eager '
+                           f'mode instead: {e}')
+            _COMPILED[func] = None
+
+    def wrapper(*args, **kwargs):
+        cfunc = _COMPILED.get(func, None)
+        if cfunc is not None:
+            try:
+                return cfunc(*args, **kwargs)
+            except Exception as e:
+                logger.warning(f'Compiled {func.__name__} failed, using eager '
+                               f'mode instead: {e}')
+                _COMPILED[func] = None
+        return func(*args, **kwargs)
+
+    return wrapper
+
+
 def log_performance(log=None, level=None, header=None):
     """Log usage information for cpu, memory, gpu, and gpu memory.
 
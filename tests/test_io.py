@@ -1,11 +1,21 @@
+import os
 import pytest
 import tempfile
+import shutil
+import json
+import zlib
 from pathlib import Path
 
 import numpy as np
 import torch
 
 from kilosort import io
+from kilosort.run_kilosort import load_sorting
+from kilosort.preprocessing import get_highpass_filter, get_drift_matrix
+from kilosort.postprocessing import make_pc_features
+from kilosort.data_tools import (
+    get_cluster_spikes, get_best_channels, SpikeTrains
+    )
 
 
 def test_probe_io():
@@ -271,3 +281,877 @@ def test_file_group(torch_device, data_directory, bfile):
         b1 = bfile.padded_batch_to_torch(i, skip_preproc=True)
         b2 = bfile3.padded_batch_to_torch(j)
         assert torch.allclose(b1, b2)
+
+
+def test_prefetch(torch_device, tmp_path):
+    N, C = (5000, 10)
+    NT = 300
+    nt = 61
+    data = np.repeat(np.arange(N)[...,np.newaxis], repeats=C, axis=1)
+    path = tmp_path / 'temp_memmap.dat'
+    a = np.memmap(path, mode='w+', shape=(N,C), dtype=np.int16)
+    a[:] = data[:]
+    a.flush()
+    del(a)
+
+    bfile = io.BinaryRWFile(path, n_chan_bin=C, device=torch_device,
+                            NT=NT, nt=nt)
+    bfile2 = io.BinaryRWFile(path, n_chan_bin=C, device=torch_device,
+                             NT=NT, nt=nt, prefetch=3)
+
+    with bfile2:
+        # Sequential, strided and out-of-order access should all match
+        # synchronous reads, including padding for first and last batch.
+        order = list(range(bfile.n_batches)) \
+                + list(range(0, bfile.n_batches, 4)) + [5, 2, 9, 0]
+        for i in order:
+            X1, inds1 = bfile.padded_batch_to_torch(i, return_inds=True)
+            X2, inds2 = bfile2.padded_batch_to_torch(i, return_inds=True)
+            assert torch.allclose(X1, X2)
+            assert inds1 == inds2
+
+        stats = bfile2.prefetcher.stats()
+        assert stats['n_requests'] == len(order)
+        assert stats['n_hits'] > stats['n_misses']
+        assert stats['stall_time'] >= 0
+    assert len(bfile2.prefetcher._pending) == 0
+
+
+@pytest.mark.skipif(not io.SequentialReader.is_supported(),
+                    reason='posix_fadvise not available')
+@pytest.mark.parametrize('prefetch', [0, 2])
+def test_sequential_io(torch_device, tmp_path, prefetch):
+    N, C = (5000, 10)
+    NT = 300
+    nt = 61
+    data = np.repeat(np.arange(N)[...,np.newaxis], repeats=C, axis=1)
+    path = tmp_path / 'temp_memmap.dat'
+    a = np.memmap(path, mode='w+', shape=(N,C), dtype=np.int16)
+    a[:] = data[:]
+    a.flush()
+    del(a)
+
+    bfile = io.BinaryRWFile(path, n_chan_bin=C, device=torch_device,
+                            NT=NT, nt=nt)
+    bfile2 = io.BinaryRWFile(path, n_chan_bin=C, device=torch_device,
+                             NT=NT, nt=nt, prefetch=prefetch, sequential=True)
+    assert bfile2.sequential_reader is not None
+
+    with bfile2:
+        order = list(range(bfile.n_batches)) \
+                + list(range(0, bfile.n_batches, 4)) + [5, 2, 9, 0]
+        for i in order:
+            X1, inds1 = bfile.padded_batch_to_torch(i, return_inds=True)
+            X2, inds2 = bfile2.padded_batch_to_torch(i, return_inds=True)
+            assert torch.allclose(X1, X2)
+            assert inds1 == inds2
+    assert bfile2.sequential_reader is None
+
+    # Writable files always use memmap.
+    bfile3 = io.BinaryRWFile(path, n_chan_bin=C, device=torch_device,
+                             NT=NT, nt=nt, write=True, sequential=True)
+    assert bfile3.sequential_reader is None
+    bfile3.close()
+
+
+def test_file_group_handles(tmp_path):
+    C = 4
+    sizes = [100, 37, 250, 13, 80]
+    files = []
+    full = []
+    start = 0
+    for i, n in enumerate(sizes):
+        d = np.repeat(np.arange(start, start+n)[...,np.newaxis], C, axis=1)
+        d = d.astype(np.int16)
+        path = tmp_path / f'temp_{i}.bin'
+        d.tofile(path)
+        files.append(path)
+        full.append(d)
+        start += n
+    full = np.concatenate(full, axis=0)
+
+    bfg = io.BinaryFileGroup(filenames=files, n_channels=C, dtype='int16',
+                             max_open_files=2)
+    assert bfg.shape == full.shape
+    for i, j in [(0, 10), (95, 105), (99, 400), (137, 387), (0, None),
+                 (470, -2), (-30, None)]:
+        assert np.all(bfg[i:j] == full[i:j])
+        assert np.all(bfg[i:j, 1:3] == full[i:j, 1:3])
+        assert len(bfg._pool) <= 2
+
+    # Slice inside one file should be a view of the memmap, not a copy.
+    x = bfg[140:200]
+    assert np.shares_memory(x, bfg.get_file(2))
+    bfg.close()
+    assert len(bfg._pool) == 0
+
+    # Single file memmap should only be opened once.
+    bfile = io.BinaryRWFile(files[0], n_chan_bin=C, NT=50, nt=5)
+    assert bfile.file is bfile.file
+
+
+def _legacy_padded_batch(bfile, ibatch, chan_map):
+    # Decoding as done before batch buffers were added, for comparison.
+    data, bstart, bend = bfile.read_padded_batch(ibatch)
+    data = data.T.astype('float32') - 2**15
+    data = data * bfile.scale + bfile.shift
+    nsamp = data.shape[-1]
+    X = np.zeros((bfile.n_chan_bin, bfile.NT + 2*bfile.nt), dtype='float32')
+    if ibatch == 0:
+        X[:, bfile.nt:bfile.nt+nsamp] = data
+        X[:, :bfile.nt] = X[:, bfile.nt:bfile.nt+1]
+    elif ibatch == bfile.n_batches-1:
+        X[:, :nsamp] = data
+        X[:, nsamp:] = X[:, nsamp-1:nsamp]
+    else:
+        X[:] = data
+    return X[chan_map]
+
+
+def test_batch_buffers(torch_device, tmp_path):
+    T, C, NT, nt = 5000, 10, 300, 61
+    data = np.random.randint(0, 2**16, size=(T, C), dtype=np.uint16)
+    path = tmp_path / 'temp.bin'
+    data.tofile(path)
+    chan_map = np.array([3, 0, 9, 4, 5, 1])
+
+    bfile = io.BinaryRWFile(path, n_chan_bin=C, dtype='uint16', NT=NT, nt=nt,
+                            device=torch_device, scale=0.5, shift=3.0)
+    buffers = io.BatchBufferPool(device=torch_device, block_size=128)
+    tensors = []
+    for i in range(bfile.n_batches):
+        X = bfile.padded_batch_to_torch(i, chan_map=chan_map, buffers=buffers)
+        X_legacy = _legacy_padded_batch(bfile, i, chan_map)
+        assert X.dtype == torch.float32
+        assert np.allclose(X.cpu().numpy(), X_legacy)
+        tensors.append(X)
+
+    # Same underlying memory should be re-used for every batch.
+    assert all(t.data_ptr() == tensors[0].data_ptr() for t in tensors)
+
+    # Without buffers, each batch gets its own tensor.
+    X1 = bfile.padded_batch_to_torch(1)
+    X2 = bfile.padded_batch_to_torch(2)
+    assert X1.data_ptr() != X2.data_ptr()
+    assert np.allclose(X1.cpu().numpy()[chan_map], _legacy_padded_batch(bfile, 1, chan_map))
+
+
+@pytest.mark.parametrize('nblocks', [1, 3])
+def test_drift_matrix_cache(torch_device, nblocks):
+    n_chans, n_batches = 16, 20
+    xc = np.tile([0., 32.], n_chans // 2)
+    yc = np.repeat(np.arange(n_chans // 2) * 20., 2)
+    ops = {
+        'probe': {'xc': xc, 'yc': yc}, 'nblocks': nblocks,
+        'yblk': np.linspace(0, yc.max(), nblocks),
+        'settings': {'sig_interp': 20},
+        'iKxx': torch.eye(n_chans, dtype=torch.float64, device=torch_device),
+        }
+    dshift = np.random.randint(-4, 5, (n_batches, nblocks)) * 2.5
+    whiten_mat = torch.rand((n_chans, n_chans), dtype=torch.float64,
+                            device=torch_device)
+
+    cache = io.DriftMatrixCache(ops, dshift, whiten_mat=whiten_mat)
+    cache.precompute()
+    assert len(cache) == len(np.unique(dshift, axis=0))
+    for i in range(n_batches):
+        M = get_drift_matrix(ops, dshift[i], device=torch_device) @ whiten_mat
+        assert torch.allclose(cache.get(i), M)
+    assert cache.stats()['n_misses'] == 0
+
+    # Memory budget for 2 matrices, and drift rounded to multiples of 5.
+    cache = io.DriftMatrixCache(ops, dshift, device=torch_device,
+                                max_memory=2 * n_chans**2 * 4, quantize=5)
+    cache.precompute()
+    assert len(cache) == 2
+    for i in range(n_batches):
+        M = get_drift_matrix(ops, np.round(dshift[i] / 5) * 5,
+                             device=torch_device)
+        assert torch.allclose(cache.get(i), M)
+    assert len(cache) == 2
+
+
+@pytest.mark.parametrize('cache_dtype', ['float16', 'int16'])
+def test_preprocessed_cache(torch_device, tmp_path, cache_dtype):
+    T, C, NT, nt = 5000, 8, 1000, 61
+    data = (np.random.randn(T, C) * 100).astype(np.int16)
+    path = tmp_path / 'temp.bin'
+    data.tofile(path)
+    chan_map = np.array([0, 2, 3, 4, 5, 6, 7])
+    hp_filter = get_highpass_filter(fs=30000, device=torch_device)
+    whiten_mat = torch.eye(len(chan_map), device=torch_device) * 0.1 \
+        + 0.01*torch.rand(len(chan_map), len(chan_map), device=torch_device)
+
+    def make_bfile(**kwargs):
+        return io.BinaryFiltered(path, C, NT=NT, nt=nt, chan_map=chan_map,
+                                 hp_filter=hp_filter, whiten_mat=whiten_mat,
+                                 device=torch_device, **kwargs)
+
+    bfile = make_bfile()
+    expected = [bfile.padded_batch_to_torch(i, return_inds=True)
+                for i in range(bfile.n_batches)]
+
+    cached = make_bfile()
+    cached.cache = io.PreprocessedCache.from_bfile(cached, tmp_path, cache_dtype)
+    assert len(cached.cache) == 0
+    for _ in range(2):
+        for i in range(cached.n_batches):
+            X, inds = cached.padded_batch_to_torch(i, return_inds=True)
+            X0, inds0 = expected[i]
+            assert inds == inds0
+            assert torch.allclose(X, X0, atol=1e-2, rtol=1e-2)
+        assert len(cached.cache) == cached.n_batches
+    cached.close()
+
+    # Cache should be re-used by a new file with the same settings...
+    cached = make_bfile()
+    cache = io.PreprocessedCache.from_bfile(cached, tmp_path, cache_dtype)
+    assert len(cache) == cached.n_batches
+    del cache
+    # ... but not if settings change, and the old cache should be removed.
+    cached = make_bfile(do_CAR=False)
+    cache = io.PreprocessedCache.from_bfile(cached, tmp_path, cache_dtype)
+    assert len(cache) == 0
+    assert len(list(tmp_path.glob('preprocessed_cache_*.npy'))) == 1
+    key = io.PreprocessedCache.get_key(cached, cache_dtype)
+    del cache
+    # Filter modes differ at the edges of the recording.
+    cached = make_bfile(do_CAR=False, filter_mode='overlap_save')
+    assert io.PreprocessedCache.get_key(cached, cache_dtype) != key
+
+
+@pytest.mark.parametrize('overwrite', [True, False])
+def test_buffered_writer(tmp_path, overwrite):
+    N, C = (5000, 6)
+    rng = np.random.default_rng(0)
+    path = tmp_path / 'temp_write.dat'
+    expected = rng.integers(-100, 100, size=(N, C)).astype(np.int16)
+    expected.tofile(path)
+    if overwrite:
+        expected[:] = 0
+
+    # Small buffers so that writes go through several staged buffers,
+    # including ones that re-read previously written samples.
+    writes = [
+        (slice(0, 300), [0, 2, 3]), (slice(300, 1000), slice(None)),
+        (slice(950, 1200), [1, 5]), (slice(100, 200), 4),
+        (slice(1200, 4000), slice(None)), (slice(4500, None), [0, 1]),
+    ]
+    with io.BufferedWriter(path, C, 'int16', N, buffer_size=400*C*2,
+                           max_pending=1, overwrite=overwrite) as f:
+        for rows, cols in writes:
+            n = len(range(*rows.indices(N)))
+            n_cols = 1 if isinstance(cols, int) else len(range(C)[cols])
+            data = rng.integers(-1000, 1000, size=(n, n_cols)).astype(np.int16)
+            if isinstance(cols, int):
+                data = data[:, 0]
+            f[rows, cols] = data
+            expected[rows, cols] = data
+        with pytest.raises(IndexError):
+            f[[1, 2, 3]] = 0
+        assert f.stats()['n_writes'] > 1
+
+    result = np.fromfile(path, dtype=np.int16).reshape(N, C)
+    assert np.array_equal(result, expected)
+
+
+def test_binary_write_buffer(torch_device, tmp_path):
+    N, C = (5000, 4)
+    path = tmp_path / 'temp_write.dat'
+    np.zeros((N, C), dtype=np.int16).tofile(path)
+    data = np.arange(N*C).reshape(N, C).astype(np.int16)
+
+    with io.BinaryRWFile(path, n_chan_bin=C, device=torch_device, NT=1000,
+                         write=True, write_buffer=2**12) as bfile:
+        assert bfile.writer is not None
+        for i in range(0, N, 1000):
+            bfile[i:i+1000] = data[i:i+1000]
+        # Staged writes are flushed before reading.
+        assert np.array_equal(bfile[:], data)
+        bfile[10:20, [1, 2]] = np.zeros((10, 2))
+        data[10:20, [1, 2]] = 0
+    assert np.array_equal(np.fromfile(path, dtype=np.int16).reshape(N, C), data)
+
+
+@pytest.mark.parametrize('n_workers', [1, 3])
+def test_save_preprocessing(torch_device, tmp_path, n_workers):
+    T, C, NT, nt = 5000, 8, 1000, 61
+    data = (np.random.randn(T, C) * 100).astype(np.int16)
+    path = tmp_path / 'temp.bin'
+    data.tofile(path)
+    chan_map = np.array([0, 2, 3, 4, 5, 6, 7])
+    hp_filter = get_highpass_filter(fs=30000, device=torch_device)
+    whiten_mat = torch.eye(len(chan_map), device=torch_device) * 0.1
+    bfile = io.BinaryFiltered(path, C, NT=NT, nt=nt, chan_map=chan_map,
+                              hp_filter=hp_filter, whiten_mat=whiten_mat,
+                              device=torch_device)
+    n_batches = bfile.n_batches
+    ops = {
+        'Nbatches': n_batches, 'nt': nt, 'batch_size': NT, 'dshift': None,
+        'chanMap': chan_map, 'data_dtype': 'int16', 'n_chan_bin': C,
+        'preprocessing': {'whiten_mat': whiten_mat, 'hp_filter': hp_filter}
+    }
+
+    # Reference: write each batch, then replace the overlapping samples at
+    # each batch edge with a linear cross-fade.
+    batches = [bfile.padded_batch_to_torch(i).cpu().numpy()
+               for i in range(n_batches)]
+    expected = np.zeros((NT*n_batches, C), dtype='float64')
+    weights = np.linspace(1, 0, 2*nt+2)[1:-1]
+    for i, X in enumerate(batches):
+        expected[i*NT : (i+1)*NT, chan_map] = X[:, nt:NT+nt].T
+        if i > 0:
+            seam = weights*batches[i-1][:, NT:] + weights[::-1]*X[:, :2*nt]
+            expected[i*NT-nt : i*NT+nt, chan_map] = seam.T
+    expected = (expected*200).astype('int16')
+
+    out_path = tmp_path / 'temp_wh.dat'
+    io.save_preprocessing(out_path, ops, bfile, n_workers=n_workers)
+    result = np.fromfile(out_path, dtype='int16').reshape(-1, C)
+    assert result.shape == expected.shape
+    # float32 vs float64 can round differently before truncating.
+    assert np.abs(result.astype(int) - expected).max() <= 1
+    assert np.all(result[:, 1] == 0)
+
+
+def test_stream_pc_features(tmp_path):
+    rng = np.random.default_rng(0)
+    n_spikes, n_chan, n_near, n_pcs = 2000, 8, 4, 3
+    iCC = np.stack([np.clip(np.arange(n_chan) + k - 1, 0, n_chan - 1)
+                    for k in range(n_near)])
+    ops = {
+        'iU': torch.arange(n_chan), 'iCC': torch.from_numpy(iCC),
+        'xc': np.zeros(n_chan, dtype='float32'),
+        'yc': np.arange(n_chan, dtype='float32') * 20,
+        'nearest_chans': n_near, 'dmin': 20, 'dminx': 32
+    }
+    tF = torch.from_numpy(
+        rng.standard_normal((n_spikes, n_near, n_pcs)).astype('float32')
+        )
+    spike_templates = rng.integers(0, n_chan, n_spikes).astype('int32')
+    clu = (spike_templates // 2).astype('int32')
+    kept = rng.random(n_spikes) > 0.2
+    kept[:n_chan] = True
+    spike_templates[:n_chan] = np.arange(n_chan)
+    clu[:n_chan] = np.arange(n_chan) // 2
+
+    expected, expected_ind = make_pc_features(
+        ops, spike_templates[kept], clu[kept], tF[torch.from_numpy(kept)].clone()
+        )
+    tF_copy = tF.clone()
+    out = np.lib.format.open_memmap(
+        tmp_path / 'pc_features.npy', mode='w+', dtype='float32',
+        shape=(int(kept.sum()), n_pcs, n_near)
+        )
+    pc_features, pc_feature_ind = make_pc_features(
+        ops, spike_templates, clu, tF, kept_spikes=kept, out=out, chunk_size=300
+        )
+
+    assert torch.equal(tF, tF_copy)
+    assert np.array_equal(pc_feature_ind, expected_ind)
+    assert np.allclose(pc_features, expected.numpy())
+
+
+def test_trace_pyramid(torch_device, tmp_path):
+    T, C, NT, nt = 5000, 8, 1000, 61
+    data = (np.random.randn(T, C) * 100).astype(np.int16)
+    path = tmp_path / 'temp.bin'
+    data.tofile(path)
+    chan_map = np.array([0, 2, 3, 4, 5, 6, 7])
+    bfile = io.BinaryFiltered(path, C, NT=NT, nt=nt, chan_map=chan_map,
+                              do_CAR=False, device=torch_device)
+
+    # 1000 isn't a multiple of 64, so blocks span batch edges.
+    factors = (16, 64, 256)
+    pyramid = io.TracePyramid.from_bfile(bfile, 'raw', factors=factors)
+    assert pyramid.directory == Path(f'{path}.ks4pyramid')
+    assert not pyramid.complete
+    assert pyramid.level_for(T, 10) is None
+    assert pyramid.build(bfile)
+    assert pyramid.complete
+
+    # Traces as seen by `bfile`, after per-batch mean subtraction.
+    x = np.concatenate([
+        bfile.padded_batch_to_torch(i)[:, nt:nt+NT].cpu().numpy().T
+        for i in range(bfile.n_batches)
+        ])
+    assert x.shape == (T, len(chan_map))
+    for f in factors:
+        n = int(np.ceil(T / f))
+        padded = np.concatenate([x, np.repeat(x[-1:], n*f - T, axis=0)])
+        padded = padded.reshape(n, f, len(chan_map))
+        expected = np.stack([padded.min(axis=1), padded.max(axis=1),
+                             np.sqrt((padded**2).mean(axis=1))], axis=2)
+        stats = pyramid.read(f, 0, T)
+        assert stats.shape == (n, len(chan_map), 3)
+        assert np.allclose(stats[..., :2], expected[..., :2], rtol=1e-3, atol=0.5)
+        if f == factors[0]:
+            assert np.allclose(stats[..., 2], expected[..., 2], rtol=1e-2)
+        else:
+            # Coarse RMS is computed from finer blocks, including padding.
+            assert np.allclose(stats[:-1, :, 2], expected[:-1, :, 2], rtol=1e-2)
+
+    assert np.array_equal(pyramid.read(64, 640, 1280, channels=[1, 3]),
+                          pyramid.read(64, 0, T)[10:20, [1, 3]])
+    assert pyramid.level_for(T, 19) == 256
+    assert pyramid.level_for(T, 20) == 64
+    assert pyramid.level_for(T, 1000) is None
+
+    # Re-opening with the same settings re-uses the pyramid, while different
+    # settings replace it.
+    assert io.TracePyramid.from_bfile(bfile, 'raw', factors=factors).complete
+    bfile2 = io.BinaryFiltered(path, C, NT=NT, nt=nt, chan_map=chan_map,
+                               do_CAR=True, device=torch_device)
+    pyramid2 = io.TracePyramid.from_bfile(bfile2, 'raw', factors=factors)
+    assert not pyramid2.complete
+    assert not pyramid.filenames[16].exists()
+
+    with pytest.raises(ValueError):
+        io.TracePyramid(tmp_path, 'raw', 'key', T, C, factors=(16, 24))
+
+
+@pytest.mark.parametrize('max_memory', [np.inf, 0])
+def test_chunked_array(tmp_path, max_memory):
+    rows = [np.random.rand(n, 3, 2).astype('float32')
+            for n in [0, 5, 40, 1, 17, 100]]
+    expected = np.concatenate(rows)
+    order = np.argsort(expected[:, 0, 0])
+
+    for o in [None, order]:
+        filename = tmp_path / 'tF_spill.dat'
+        store = io.ChunkedArray((3, 2), 'float32', chunk_size=16,
+                                max_memory=max_memory, filename=filename)
+        for r in rows:
+            store.append(r)
+        assert len(store) == expected.shape[0]
+        if max_memory == 0:
+            assert store.n_spilled > 0
+        else:
+            assert store.n_spilled == 0
+
+        X = store.to_array(order=o)
+        assert np.array_equal(X, expected if o is None else expected[o])
+        assert isinstance(X, np.memmap) == (max_memory == 0)
+        del X
+
+    io.remove_spill_files(tmp_path)
+    assert len(list(tmp_path.glob('*_spill*.dat'))) == 0
+
+
+def test_sorting_container(tmp_path):
+    n = 1000
+    columns = {
+        'spike_times': np.sort(np.random.randint(0, 10**7, n)).astype('int64'),
+        'spike_clusters': np.random.randint(0, 20, n).astype('int32'),
+        'kept_spikes': np.random.rand(n) > 0.1,
+        'pc_features': np.random.rand(n, 6, 10).astype('float32'),
+        'templates': np.random.rand(20, 61, 8).astype('float32'),
+        'is_ref': np.random.rand(20) > 0.5,
+        'est_contam_rate': np.random.rand(20),
+        'template_amplitudes': np.random.rand(20).astype('float32'),
+        }
+    path = tmp_path / io.SortingContainer.FILENAME
+    io.SortingContainer.write(path, columns, chunk_size=128)
+    sorting = io.SortingContainer(path)
+    assert set(sorting.keys()) == set(columns.keys())
+    assert sorting.columns['spike_times']['codec'] == 'delta'
+    assert sorting.columns['pc_features']['codec'] == 'raw'
+
+    for name, x in columns.items():
+        assert np.array_equal(sorting.load(name), x)
+        lazy = sorting.load(name, lazy=True)
+        assert lazy.shape == x.shape
+        assert np.array_equal(lazy[5], x[5])
+        assert np.array_equal(lazy[-3:], x[-3:])
+        assert np.array_equal(lazy[100:600:7], x[100:600:7])
+        assert np.array_equal(np.asarray(lazy), x)
+    times = sorting['spike_times']
+    assert isinstance(times, io.LazyColumn)
+    mask = columns['kept_spikes']
+    assert np.array_equal(times[mask], columns['spike_times'][mask])
+    assert isinstance(sorting['pc_features'], np.memmap)
+
+    # Phy files generated from the container match the original arrays.
+    io.container_to_phy(tmp_path)
+    assert np.array_equal(np.load(tmp_path / 'spike_times.npy'),
+                          columns['spike_times'])
+    assert (tmp_path / 'cluster_KSLabel.tsv').is_file()
+    assert not (tmp_path / 'is_ref.npy').exists()
+    assert np.array_equal(io.load_result(tmp_path, 'pc_features', lazy=True),
+                          columns['pc_features'])
+
+    # A .npy file written after the container (by Phy, after curation) is
+    # used instead of the container column, an older one is ignored.
+    curated = np.zeros(n, dtype='int32')
+    np.save(tmp_path / 'spike_clusters.npy', curated)
+    assert np.array_equal(io.load_result(tmp_path, 'spike_clusters'), curated)
+    t = path.stat().st_mtime_ns - 10**9
+    os.utime(tmp_path / 'spike_clusters.npy', ns=(t, t))
+    assert np.array_equal(io.load_result(tmp_path, 'spike_clusters'),
+                          columns['spike_clusters'])
+
+    # data_tools readers work with container-only results.
+    container_dir = tmp_path / 'container_only'
+    container_dir.mkdir()
+    shutil.copy(path, container_dir / io.SortingContainer.FILENAME)
+    spikes, _ = get_cluster_spikes(3, container_dir)
+    expected = columns['spike_times'][columns['spike_clusters'] == 3]
+    assert np.array_equal(spikes, expected)
+    assert get_best_channels(container_dir).shape == (20,)
+
+
+def test_load_sorting_curated(tmp_path, torch_device):
+    n = 2000
+    ops = {
+        'settings': {'filename': tmp_path / 'data.bin', 'data_dir': tmp_path,
+                     'acg_threshold': 0.2, 'ccg_threshold': 0.25},
+        'filename': tmp_path / 'data.bin', 'data_dir': tmp_path,
+        'preprocessing': {}, 'fs': 30000.0
+        }
+    io.save_ops(ops, tmp_path)
+    spike_clusters = np.random.randint(0, 10, n).astype('int32')
+    columns = {
+        'spike_times': np.sort(np.random.randint(0, 10**7, n)).astype('int64'),
+        'spike_clusters': spike_clusters,
+        'kept_spikes': np.ones(n, dtype=bool),
+        'similar_templates': np.random.rand(10, 10).astype('float32'),
+        'is_ref': np.ones(10, dtype=bool),
+        'est_contam_rate': np.zeros(10),
+        }
+    path = tmp_path / io.SortingContainer.FILENAME
+    io.SortingContainer.write(path, columns)
+    results = load_sorting(tmp_path, device=torch_device, lazy=True)
+    assert np.array_equal(results[4], columns['is_ref'])
+
+    # Phy merges clusters 0 and 1 into new cluster 10, so labels from the
+    # container no longer apply and are recomputed.
+    curated = spike_clusters.copy()
+    curated[curated < 2] = 10
+    t = path.stat().st_mtime_ns + 10**9
+    np.save(tmp_path / 'spike_clusters.npy', curated)
+    os.utime(tmp_path / 'spike_clusters.npy', ns=(t, t))
+    ops, st, clu, _, is_ref, est_contam_rate, _ = load_sorting(
+        tmp_path, device=torch_device, lazy=True
+        )
+    assert np.array_equal(np.asarray(clu), curated)
+    assert is_ref.shape == (11,)
+    assert est_contam_rate.shape == (11,)
+
+
+def test_cluster_spike_index(tmp_path):
+    n = 5000
+    spike_times = np.sort(np.random.randint(0, 10**7, n)).astype('int64')
+    spike_clusters = np.random.randint(0, 20, n).astype('int32')
+    # No spikes assigned to cluster 7 or to clusters 20-24.
+    spike_clusters[spike_clusters == 7] = 8
+    order, offsets = io.cluster_spike_index(spike_clusters, n_clusters=25)
+    assert offsets.size == 26
+    assert offsets[-1] == n
+
+    np.save(tmp_path / 'spike_times.npy', spike_times)
+    np.save(tmp_path / 'spike_clusters.npy', spike_clusters)
+    expected = {i: (spike_clusters == i).nonzero()[0] for i in range(25)}
+    # Scan spike_clusters.npy when there is no saved index.
+    for i in [0, 7, 8]:
+        idx = io.load_cluster_spike_idx(tmp_path, i)
+        assert np.array_equal(idx, expected[i])
+
+    io.save_cluster_index(tmp_path, order, offsets)
+    assert io.load_cluster_index(tmp_path)[0] is not None
+    for i in range(25):
+        idx = io.load_cluster_spike_idx(tmp_path, i)
+        assert np.array_equal(idx, expected[i])
+    assert io.load_cluster_spike_idx(tmp_path, 30).size == 0
+
+    spikes, subset = get_cluster_spikes(3, tmp_path)
+    assert np.array_equal(spikes, spike_times[expected[3]])
+    spikes, subset = get_cluster_spikes(3, tmp_path, n_spikes=10,
+                                        mmap_mode=None)
+    assert np.array_equal(spikes, np.sort(spike_times[expected[3]][subset]))
+
+    # After curation (like a merge of 3 and 4 into new cluster 25, and a
+    # split of 5) spike_clusters.npy is rewritten, so the saved index is stale.
+    curated = spike_clusters.copy()
+    curated[np.isin(curated, [3, 4])] = 25
+    curated[(curated == 5) & (np.arange(n) % 2 == 0)] = 26
+    t = (tmp_path / 'spike_clusters.npy').stat().st_mtime_ns + 10**9
+    np.save(tmp_path / 'spike_clusters.npy', curated)
+    # Make sure the modification time changes on file systems with coarse
+    # timestamps, as it would for curation saved later on.
+    os.utime(tmp_path / 'spike_clusters.npy', ns=(t, t))
+    assert io.load_cluster_index(tmp_path) == (None, None)
+    for i in [3, 5, 25, 26]:
+        idx = io.load_cluster_spike_idx(tmp_path, i)
+        assert np.array_equal(idx, (curated == i).nonzero()[0])
+    spikes, _ = get_cluster_spikes(25, tmp_path)
+    assert np.array_equal(spikes, spike_times[curated == 25])
+
+
+def test_spike_trains(tmp_path):
+    n = 20000
+    spike_times = np.sort(np.random.randint(0, 10**6, n)).astype('int64')
+    spike_clusters = np.random.randint(0, 15, n).astype('int32')
+    order, offsets = io.cluster_spike_index(spike_clusters)
+    np.save(tmp_path / 'spike_times.npy', spike_times)
+    np.save(tmp_path / 'spike_clusters.npy', spike_clusters)
+    io.save_cluster_index(tmp_path, order, offsets)
+    trains = SpikeTrains.from_results(tmp_path, bucket_size=100)
+    assert isinstance(trains.order, np.memmap)
+
+    for t0, t1 in [(0, 10), (12345, 56789), (999000, 2*10**6)]:
+        mask = (spike_times >= t0) & (spike_times < t1)
+        times, clu = trains.window(t0, t1)
+        assert np.array_equal(times, spike_times[mask])
+        assert np.array_equal(clu, spike_clusters[mask])
+        times, clu = trains.window(t0, t1, clusters=[2, 5])
+        mask = mask & np.isin(spike_clusters, [2, 5])
+        assert np.array_equal(times, spike_times[mask])
+        assert np.array_equal(clu, spike_clusters[mask])
+
+    events = np.array([1000, 5000, 5100, 800000])
+    window = (-200, 400)
+    rel, ev, clu = trains.align(events, window, clusters=[3, 4])
+    for c in [3, 4]:
+        t = spike_times[spike_clusters == c]
+        for i, e in enumerate(events):
+            expected = t[(t >= e + window[0]) & (t < e + window[1])] - e
+            assert np.array_equal(rel[(ev == i) & (clu == c)], expected)
+
+    # No clusters selected.
+    times, clu = trains.window(0, 10**6, clusters=[])
+    assert times.size == clu.size == 0 and times.dtype == clu.dtype == 'int64'
+    rel, ev, clu = trains.align(events, window, clusters=[])
+    assert rel.size == ev.size == clu.size == 0
+    assert rel.dtype == ev.dtype == clu.dtype == 'int64'
+
+    counts = trains.psth(events, window, 50)
+    assert counts.shape == (15, 4, 12)
+    t = spike_times[spike_clusters == 3]
+    expected, _ = np.histogram(t - events[1], bins=np.arange(-200, 401, 50))
+    assert np.array_equal(counts[3, 1], expected)
+
+    counts = trains.binned_counts(1000, clusters=[0, 1])
+    assert counts.shape == (2, spike_times[-1] // 1000 + 1)
+    assert counts[1].sum() == (spike_clusters == 1).sum()
+
+    # Curated spike_clusters.npy (clusters 1 and 2 merged into new cluster 15)
+    # is used instead of the stale index.
+    curated = spike_clusters.copy()
+    curated[np.isin(curated, [1, 2])] = 15
+    t = (tmp_path / 'spike_clusters.npy').stat().st_mtime_ns + 10**9
+    np.save(tmp_path / 'spike_clusters.npy', curated)
+    os.utime(tmp_path / 'spike_clusters.npy', ns=(t, t))
+    del trains
+    trains = SpikeTrains.from_results(tmp_path)
+    assert trains.n_clusters == 16
+    assert trains.cluster_times(1).size == 0
+    assert np.array_equal(trains.cluster_times(15), spike_times[curated == 15])
+
+    # Results saved only in a sorting container.
+    container_dir = tmp_path / 'container_only'
+    container_dir.mkdir()
+    io.SortingContainer.write(
+        container_dir / io.SortingContainer.FILENAME,
+        {'spike_times': spike_times, 'spike_clusters': spike_clusters}
+        )
+    trains = SpikeTrains.from_results(container_dir)
+    times, clu = trains.window(12345, 56789)
+    mask = (spike_times >= 12345) & (spike_times < 56789)
+    assert np.array_equal(times, spike_times[mask])
+    assert np.array_equal(clu, spike_clusters[mask])
+
+
+def test_ops_io(tmp_path, torch_device):
+    ops = {
+        'settings': {'filename': tmp_path / 'data.bin', 'data_dir': tmp_path,
+                     'tmax': np.inf, 'shift': None},
+        'filename': tmp_path / 'data.bin', 'data_dir': tmp_path,
+        'probe': {'chanMap': np.arange(4), 'xc': np.zeros(4, 'float32')},
+        'preprocessing': {'whiten_mat': torch.eye(4, device=torch_device)},
+        'Wrot': torch.eye(4, device=torch_device),
+        'data_dtype': np.int16, 'fs': 30000.0, 'Nbatches': np.int64(7),
+        'yup': (1, 2), 'empty': np.zeros((0, 3)),
+        }
+    io.save_ops(ops, tmp_path)
+    assert (tmp_path / 'ops' / 'ops.json').is_file()
+    assert (tmp_path / 'ops.npy').is_file()
+
+    for path in [tmp_path, tmp_path / 'ops.npy', tmp_path / 'ops']:
+        loaded = io.load_ops(path, device=torch_device)
+        assert set(loaded.keys()) == set(ops.keys())
+        assert loaded['settings']['tmax'] == np.inf
+        assert loaded['settings']['shift'] is None
+        assert loaded['data_dtype'] is np.int16
+        assert loaded['Nbatches'] == 7
+        assert loaded['yup'] == (1, 2)
+        assert loaded['empty'].shape == (0, 3)
+        assert np.array_equal(loaded['probe']['chanMap'], np.arange(4))
+        assert isinstance(loaded['Wrot'], torch.Tensor)
+        assert torch.equal(loaded['preprocessing']['whiten_mat'],
+                           ops['preprocessing']['whiten_mat'])
+
+    subset = io.load_ops(tmp_path, device=torch_device, keys=['fs', 'probe'])
+    assert set(subset.keys()) == {'fs', 'probe'}
+    assert not isinstance(subset['probe']['xc'], np.memmap)
+
+    # Saving again while previously loaded ops are still referenced.
+    io.save_ops(ops, tmp_path, legacy=False)
+    assert np.array_equal(subset['probe']['chanMap'], np.arange(4))
+
+    # Legacy ops.npy files can still be loaded.
+    shutil.rmtree(tmp_path / 'ops')
+    legacy = io.load_ops(tmp_path / 'ops.npy', device=torch_device)
+    assert isinstance(legacy['Wrot'], torch.Tensor)
+    assert legacy['Nbatches'] == 7
+
+
+class _FakeRecording:
+    """Minimal stand-in for a SpikeInterface RecordingExtractor."""
+    def __init__(self, data):
+        self.data = data
+        self.channel_ids = np.array([f'ch{i}' for i in range(data.shape[1])])
+        self.n_calls = 0
+
+    def get_num_segments(self):
+        return 1
+
+    def get_total_samples(self):
+        return self.data.shape[0]
+
+    def get_sampling_frequency(self):
+        return 30000.0
+
+    def get_dtype(self):
+        return self.data.dtype
+
+    def get_traces(self, start_frame=None, end_frame=None, channel_ids=None,
+                   segment_index=None):
+        self.n_calls += 1
+        X = self.data[start_frame:end_frame]
+        if channel_ids is not None:
+            X = X[:, [list(self.channel_ids).index(c) for c in channel_ids]]
+        return X
+
+
+def _write_cbin(path, data, chunk_size, do_spatial_diff=False,
+                chunk_order='F'):
+    # Same layout as mtscomp: each chunk is diffed over time (and optionally
+    # channels), written in `chunk_order` and zlib-compressed.
+    bounds = list(range(0, data.shape[0], chunk_size)) + [data.shape[0]]
+    offsets = [0]
+    with open(path, 'wb') as f:
+        for i, j in zip(bounds[:-1], bounds[1:]):
+            chunk = np.diff(data[i:j], axis=0, prepend=0).astype(data.dtype)
+            if do_spatial_diff:
+                chunk = np.diff(chunk, axis=1, prepend=0).astype(data.dtype)
+            b = zlib.compress(chunk.tobytes(order=chunk_order))
+            f.write(b)
+            offsets.append(offsets[-1] + len(b))
+    meta = {
+        'algorithm': 'zlib', 'do_time_diff': True,
+        'do_spatial_diff': do_spatial_diff, 'dtype': str(data.dtype),
+        'n_channels': data.shape[1], 'sample_rate': 30000,
+        'chunk_bounds': bounds, 'chunk_offsets': offsets,
+        'chunk_order': chunk_order
+    }
+    with open(path.with_suffix('.ch'), 'w') as f:
+        json.dump(meta, f)
+
+
+@pytest.mark.parametrize('chunk_order', ['F', 'C'])
+@pytest.mark.parametrize('do_spatial_diff', [False, True])
+def test_mtscomp_recording(torch_device, tmp_path, do_spatial_diff,
+                           chunk_order):
+    N, C = (5000, 10)
+    NT = 300
+    nt = 61
+    rng = np.random.default_rng(0)
+    data = rng.integers(-500, 500, size=(N, C)).astype(np.int16)
+    path = tmp_path / 'temp.ap.cbin'
+    _write_cbin(path, data, chunk_size=700, do_spatial_diff=do_spatial_diff,
+                chunk_order=chunk_order)
+    assert io.find_binary(tmp_path) == path
+
+    rec = io.MtscompRecording(path, cache_memory=0)
+    assert rec.shape == (N, C)
+    assert rec.dtype == np.int16
+    assert np.array_equal(rec[:], data)
+    assert np.array_equal(rec[650:1450], data[650:1450])
+    assert np.array_equal(rec[-10:, 3], data[-10:, [3]])
+    assert rec[10:10].shape == (0, C)
+    rec.close()
+
+    raw_path = tmp_path / 'temp.dat'
+    a = np.memmap(raw_path, mode='w+', shape=(N,C), dtype=np.int16)
+    a[:] = data[:]
+    a.flush()
+    del(a)
+
+    bfile = io.BinaryRWFile(raw_path, n_chan_bin=C, device=torch_device,
+                            NT=NT, nt=nt)
+    with io.BinaryRWFile(path, n_chan_bin=C, device=torch_device,
+                         NT=NT, nt=nt, prefetch=2) as bfile2:
+        assert isinstance(bfile2.file_object, io.MtscompRecording)
+        assert bfile.n_batches == bfile2.n_batches
+        for i in range(bfile.n_batches):
+            X1 = bfile.padded_batch_to_torch(i)
+            X2 = bfile2.padded_batch_to_torch(i)
+            assert torch.allclose(X1, X2)
+        stats = bfile2.file_object.cache.stats()
+        # Each chunk is only decompressed once during a sequential pass.
+        assert stats['n_misses'] + stats['n_readahead_hits'] <= rec.n_chunks
+    assert bfile2.file_object.cache._executor is None
+
+
+def test_recording_chunk_cache():
+    data = np.random.randint(-100, 100, (10000, 4)).astype(np.int16)
+    rec = _FakeRecording(data)
+    cached = io.RecordingExtractorAsArray(
+        rec, chunk_size=1000, cache_memory=2**20, n_readahead=1
+        )
+    uncached = io.RecordingExtractorAsArray(_FakeRecording(data),
+                                            chunk_size=1000)
+    assert uncached.cache is None
+
+    # Overlapping, batch-like reads.
+    for t in [0, 940, 1880, 2820, 9500]:
+        X = cached[max(t-61, 0):t+1000+61]
+        assert np.array_equal(X, data[max(t-61, 0):t+1000+61])
+        assert np.array_equal(X, uncached[max(t-61, 0):t+1000+61])
+    assert np.array_equal(cached[500:700, 2], data[500:700, [2]])
+    assert np.array_equal(cached[500:700, 1:3], data[500:700, 1:3])
+    assert cached[5:5].shape == (0, 4)
+
+    stats = cached.cache.stats()
+    assert stats['n_hits'] + stats['n_readahead_hits'] > 0
+    assert stats['n_cached'] <= cached.cache.max_chunks
+    cached.close()
+
+
+class _FakeSegmentedRecording(_FakeRecording):
+    def __init__(self, segments):
+        super().__init__(np.concatenate(segments))
+        self.segments = segments
+
+    def get_num_segments(self):
+        return len(self.segments)
+
+    def get_num_samples(self, segment_index=None):
+        return self.segments[segment_index].shape[0]
+
+    def get_traces(self, start_frame=None, end_frame=None, channel_ids=None,
+                   segment_index=None):
+        return self.segments[segment_index][start_frame:end_frame]
+
+
+def test_spikeinterface_to_binary(tmp_path):
+    segments = [np.random.randint(-100, 100, (n, 3)).astype(np.int16)
+                for n in [2500, 700, 1234]]
+    rec = _FakeSegmentedRecording(segments)
+    filename, N, c, s, fs, _ = io.spikeinterface_to_binary(
+        rec, tmp_path, chunksize=1000, export_probe=False, max_workers=2,
+        max_in_flight=2
+        )
+    assert (N, c, s) == (4434, 3, 3)
+    data = np.fromfile(filename, dtype=np.int16).reshape(-1, 3)
+    assert np.array_equal(data, np.concatenate(segments))
@@ -62,6 +62,34 @@ class TestFiltering:
         assert torch.max(x100) < 0.01
         assert torch.max(x500) > 0.9
 
+    def test_fft_filter(self):
+        engine = kpp.FFTFilter(self.hp_filter)
+        X = torch.randn((4, 6000))
+        # Same result as the complex FFT path used previously, for window
+        # lengths with large prime factors.
+        for n in [6000, 6007]:
+            fwav = kpp.fft_highpass(self.hp_filter, NT=n)
+            x1 = torch.real(ifft(fft(X[:, :n]) * torch.conj(fwav)))
+            x1 = fftshift(x1, dim=-1)
+            x2 = engine.filter(X[:, :n])
+            assert torch.allclose(x1, x2, atol=1e-4)
+        assert len(engine._spectra) == 2
+
+        # Overlap-save matches full-length linear filtering of a zero-padded
+        # window, using truncated taps.
+        n = 5003
+        pad = self.hp_filter.shape[0]
+        Xp = torch.nn.functional.pad(X[:, :n], (pad, pad))
+        fwav = kpp.fft_highpass(self.hp_filter, NT=Xp.shape[1])
+        expected = fftshift(
+            torch.real(ifft(fft(Xp) * torch.conj(fwav))), dim=-1
+            )[:, pad:pad+n]
+        for block_size in [256, 2**14]:
+            engine = kpp.FFTFilter(self.hp_filter, block_size=block_size)
+            x3 = engine.overlap_save(X[:, :n])
+            assert x3.shape == (4, n)
+            assert torch.allclose(x3, expected, atol=1e-3)
+
 
 class TestArtifactRemoval:
     
@@ -86,6 +114,48 @@ class TestArtifactRemoval:
         assert not torch.allclose(bfile2[500:,:], zeros.T)
 
 
+class TestReference:
+
+    @pytest.mark.parametrize('n_chans', [7, 8])
+    def test_channel_median(self, torch_device, n_chans):
+        X = torch.randn((n_chans, 10000), device=torch_device)
+        med = kpp.channel_median(X, block_size=999)
+        assert torch.equal(med, torch.median(X, 0)[0])
+
+    def test_common_reference(self, torch_device):
+        X = torch.randn((12, 3000), device=torch_device)
+        groups = np.repeat([0, 1, 2], 4)
+        car = kpp.CommonReference('median')
+        assert torch.allclose(car(X), X - torch.median(X, 0)[0])
+        car = kpp.CommonReference('mean')
+        assert torch.allclose(car(X), X - X.mean(0))
+
+        Y = kpp.CommonReference('shank_median', groups)(X)
+        Z = kpp.CommonReference('shank_mean', groups)(X)
+        for g in range(3):
+            Xg = X[g*4 : (g+1)*4]
+            assert torch.allclose(Y[g*4 : (g+1)*4], Xg - torch.median(Xg, 0)[0])
+            assert torch.allclose(Z[g*4 : (g+1)*4], Xg - Xg.mean(0))
+
+        with pytest.raises(ValueError):
+            kpp.CommonReference('shank_median')
+        with pytest.raises(ValueError):
+            kpp.CommonReference('trimmed_mean')
+
+    def test_bfile_reference(self, torch_device):
+        a = np.random.randint(-1000, 1000, (1000, 10)).astype(np.float32)
+        groups = np.repeat([0, 1], 5)
+        bfile = io.BinaryFiltered(
+            filename='dummy', n_chan_bin=10, NT=500, device=torch_device,
+            file_object=a, car_mode='shank_mean', channel_groups=groups
+            )
+        X = torch.from_numpy(a[:500].T).to(torch_device)
+        X = X - X.mean(1, keepdim=True)
+        X[:5] -= X[:5].mean(0)
+        X[5:] -= X[5:].mean(0)
+        assert torch.allclose(bfile[:500], X, atol=1e-3)
+
+
 class TestWhitening:
 
     def test_whitening_from_covariance(self, torch_device):
@@ -170,3 +240,101 @@ class TestWhitening:
 #     def test_get_drift_matrix(self):
 #         # TODO
 #         pass
+
+
+def test_whitening_local(torch_device):
+    # Grid of channels with repeated distances, like a typical probe.
+    xc = np.tile([0, 16, 32, 48], 40).astype('float32')
+    yc = np.repeat(np.arange(40) * 20, 4).astype('float32')
+    n_chan = xc.size
+    X = torch.randn((n_chan, 5000), device=torch_device)
+    X[1:] += 0.5 * X[:-1]
+    CC = (X @ X.T) / X.shape[1]
+
+    Wrot = kpp.whitening_local(CC, xc, yc, nrange=32, device=torch_device)
+
+    # Reference: one local whitening matrix per channel.
+    expected = torch.zeros((n_chan, n_chan), device=torch_device)
+    for j in range(n_chan):
+        ds = (xc[j] - xc)**2 + (yc[j] - yc)**2
+        ix = np.argsort(ds)[:32]
+        wrot = kpp.whitening_from_covariance(CC[np.ix_(ix, ix)])
+        expected[j, ix] = wrot[0]
+    assert torch.allclose(Wrot, expected, atol=1e-3, rtol=1e-3)
+
+    ix = kpp.get_neighbor_index(xc, yc, nrange=32)
+    assert ix.shape == (n_chan, 32)
+    assert np.array_equal(ix[:, 0], np.arange(n_chan))
+
+
+def test_sparse_operator(torch_device):
+    n_chan = 64
+    xc = np.tile([0, 16], n_chan // 2).astype('float32')
+    yc = np.repeat(np.arange(n_chan // 2) * 20, 2).astype('float32')
+    # Two shanks, far enough apart that no neighbors cross between them.
+    groups = np.repeat([0, 1], n_chan // 2)
+    yc[groups == 1] += 5000
+    X = torch.randn((n_chan, 2000), device=torch_device)
+    CC = (X @ X.T) / X.shape[1]
+    Wrot = kpp.whitening_local(CC, xc, yc, nrange=8, device=torch_device)
+
+    op = kpp.SparseOperator(Wrot)
+    assert op.mode == 'sparse'
+    assert op.nnz == n_chan * 8
+    assert torch.allclose(op @ X, Wrot @ X, atol=1e-5)
+
+    op = kpp.SparseOperator(Wrot, channel_groups=groups)
+    assert op.mode == 'blocks'
+    assert all(b.mode == 'sparse' for _, b in op.blocks)
+    assert torch.allclose(op @ X, Wrot @ X, atol=1e-5)
+    assert torch.equal(op.to_dense(), Wrot)
+    assert op.to_scipy().nnz == op.nnz
+
+    # Dense matrices stay dense, and can't be split into blocks.
+    W = torch.randn((n_chan, n_chan), device=torch_device)
+    op = kpp.SparseOperator(W, channel_groups=groups)
+    assert op.mode == 'dense'
+    assert torch.allclose(op @ X, W @ X)
+
+
+def test_compiled_fallback(monkeypatch, torch_device):
+    from kilosort import utils
+    X = torch.randn((8, 1000), device=torch_device)
+    expected = -X - (-X).mean(1, keepdim=True)
+    assert torch.allclose(kpp.center_channels(X, True), expected, atol=1e-6)
+    assert utils.compiled(kpp.center_channels, enabled=False) \
+           is kpp.center_channels
+
+    # Compiled functions that fail fall back to eager mode for every call.
+    def broken(*args, **kwargs):
+        raise RuntimeError('compilation failed')
+    monkeypatch.setattr(torch, 'compile', lambda f, **kwargs: broken)
+    monkeypatch.setattr(utils, '_COMPILED', {})
+    f = utils.compiled(kpp.center_channels)
+    assert torch.allclose(f(X, True), expected, atol=1e-6)
+    assert utils._COMPILED[kpp.center_channels] is None
+    assert torch.allclose(f(X, True), expected, atol=1e-6)
+
+
+def test_bin_batch():
+    # Binning spikes one batch at a time, as with drift_only_detection,
+    # should give the same fingerprints as binning the full spike table.
+    rng = np.random.default_rng(0)
+    ops = {
+        'yc': np.arange(96) * 20.0, 'binning_depth': 5, 'Th_universal': 9,
+        'Nbatches': 4
+        }
+    st = np.zeros((1000, 6))
+    st[:,1] = rng.uniform(0, 1900, 1000)
+    st[:,2] = rng.uniform(9, 150, 1000)
+    st[:,4] = rng.integers(0, 4, 1000)
+    F, ysamp = datashift.bin_spikes(ops, st)
+
+    dmin, dmax, ysamp2 = datashift.fingerprint_bins(ops)
+    assert np.array_equal(ysamp, ysamp2)
+    for t in range(ops['Nbatches']):
+        sst = st[st[:,4] == t]
+        F2 = datashift.bin_batch(ops, sst[:,1], sst[:,2], dmin, dmax)
+        assert F2.shape == (dmax, 20)
+        assert np.array_equal(F[t], F2)
+    assert F.sum() > 0
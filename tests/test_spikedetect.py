@@ -1,4 +1,9 @@
-from kilosort.spikedetect import extract_wPCA_wTEMP
+import pytest
+import torch
+
+from kilosort.spikedetect import (
+    extract_wPCA_wTEMP, score_dtype, _drop_rounding_ties
+    )
 
 
 def test_wpca_wtemp(bfile, saved_ops, torch_device):
@@ -9,3 +14,29 @@ def test_wpca_wtemp(bfile, saved_ops, torch_device):
     ops['n_pcs'] = 5
 
     wPCA, wTEMP = extract_wPCA_wTEMP(ops, bfile, device=torch_device)
+
+
+def test_score_dtype(torch_device):
+    assert score_dtype({'settings': {}}) == torch.float32
+    ops = {'settings': {'score_dtype': 'bfloat16'}}
+    assert score_dtype(ops) == torch.bfloat16
+    with pytest.raises(ValueError):
+        score_dtype({'settings': {'score_dtype': 'int8'}})
+
+
+def test_drop_rounding_ties(torch_device):
+    # Templates 0-3 are neighbors, as are 4-7.
+    iC2 = torch.tensor([[0]*4 + [4]*4, [1]*4 + [5]*4, [2]*4 + [6]*4,
+                        [3]*4 + [7]*4], device=torch_device)
+    As = torch.zeros((8, 1000), dtype=torch.bfloat16, device=torch_device)
+    # Same spike detected by templates 1 and 2 (one sample apart) with
+    # scores that rounded to the same value, and by template 3 with a lower
+    # score. Template 5 is not a neighbor, so its spike is kept.
+    As[1, 101] = As[2, 100] = As[5, 100] = 20.0
+    As[3, 100] = 18.0
+    # Equal scores far apart in time are separate spikes.
+    As[0, 995] = As[1, 2] = 15.0
+    xy = torch.tensor([[0, 995], [1, 2], [1, 101], [2, 100], [3, 100],
+                       [5, 100]], device=torch_device)
+    kept = _drop_rounding_ties(xy, As, iC2, nt0=20, block_size=2)
+    assert kept.tolist() == [[0, 995], [1, 2], [2, 100], [3, 100], [5, 100]]